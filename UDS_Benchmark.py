@@ -0,0 +1,319 @@
+import os, sys
+import re
+import json
+import time
+import glob
+import argparse
+import platform
+import subprocess
+import tempfile
+from contextlib import contextmanager
+import pandas as pd
+import numpy as np
+
+import UDS_Crosswalk_Parser as parser
+from UDS_Rule_Compiler import repeating_columns, MAPPING_TYPES
+
+
+# Synthetic UDS3 exports are generated from the UDS3 REDCap dictionary sheets and the value sets of the compiled
+# rules, then run through the parser with every pipeline stage, form and mapping type timed.
+
+RESULTS_VERSION = 1
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000]
+
+# Share of missing cells per column, pipe-merge primaries (A5D2 "a | b" pairs) are missing more often so the fill runs
+MISSING_RATE = 0.2
+MERGE_MISSING_RATE = 0.5
+
+# Free text written to Character fields, the grep() search terms of the rules are mixed in as well
+sample_texts = ['other text', 'none', 'unknown', 'see notes', 'n/a']
+
+
+# Numbers allowed by a conformity such as "2-43", "0-120, 888" or "3, 3.1", long ranges are sampled
+def conformity_values(conformity):
+    values = []
+    for part in re.split(r'[,;]', str(conformity)):
+        bounds = re.fullmatch(r'\s*(-?\d+)\s*(?:-|to)\s*(\d+)\b.*', part)
+        number = re.fullmatch(r'\s*(-?\d+(?:\.\d+)?)\s*', part)
+        if bounds:
+            low, high = int(bounds.group(1)), int(bounds.group(2))
+            values += list(range(low, high + 1, max(1, (high - low) // 50)))
+        elif number:
+            values.append(float(number.group(1)))
+    return values
+
+
+def parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return str(value).strip()
+
+
+def read_dictionaries(folder_path):
+    """
+    Read the UDS3 REDCap dictionary sheet of every crosswalk workbook.
+
+    Returns:
+        dict: lowercase UDS3 column -> list of values, kid###/sib### fields expanded to every family member.
+    """
+    profiles = {}
+    for file_path in sorted(glob.glob(os.path.join(folder_path, "*.xlsx"))):
+        excel_file = pd.ExcelFile(file_path)
+        uds3_sheet = [name for name in excel_file.sheet_names if re.match(r'.*? UDS3 REDCap', name)][0]
+        uds3_rdcp = pd.read_excel(excel_file, sheet_name=uds3_sheet, header=1)
+        uds3_rdcp.columns = uds3_rdcp.columns.str.lower()
+
+        for name, data_type, conformity, levels in uds3_rdcp[['uds3 data element name', 'data type', 'conformity', 'response levels']].itertuples(index=False):
+            name = str(name).strip().lower()
+            # Response levels first, then the conformity range, free text for the character fields
+            if isinstance(levels, str) and levels.strip():
+                values = [parse_value(level) for level in levels.split('|') if level.strip()]
+            elif data_type == 'Character':
+                values = list(sample_texts)
+            else:
+                values = conformity_values(conformity)
+
+            if name.startswith(('kid###', 'sib###')):
+                for col in repeating_columns(name):
+                    profiles[col] = values
+            elif '#' not in name:
+                profiles[name] = values
+    return profiles
+
+
+def column_profiles(folder_path, plan):
+    """
+    Value sets for every UDS3 column of the dictionaries and every column referenced by the rules.
+
+    The UDS3 values of the response maps and structured IF conditions are added to the dictionary levels
+    so rules match, and grep() terms are written into text fields so the search paths are exercised.
+    """
+    profiles = {col: list(values) for col, values in read_dictionaries(folder_path).items()}
+
+    def add(col, values):
+        # Combined names such as "alienlml | alienlmr" are read column by column, missing cells are generated anyway
+        if ' | ' in col or ' & ' in col:
+            return
+        known = profiles.setdefault(col, [])
+        known += [value for value in values if value not in known and value not in ('NA', '<BLANK>', '')
+                  and not re.search(r' [&|] ', str(value))]
+
+    for rule in plan.rules():
+        columns = list(rule.merge_columns or (repeating_columns(rule.uds3_var) if rule.is_repeating else [rule.uds3_var]))
+        for col in columns:
+            add(col, [parse_value(value) for value, _ in rule.exact_pairs])
+            add(col, [f"{term} {text}" for search_terms, _ in rule.grep_rules for term in search_terms for text in sample_texts[:1]])
+        for struct_rule in rule.structured:
+            for cond in struct_rule.or_conditions + struct_rule.and_conditions:
+                for col, value in cond.terms:
+                    add(col, [parse_value(value)])
+
+    # Values the dictionary dtype schema would reject are dropped, as a REDCap export cannot hold them
+    for col, dtype in plan.schema.items():
+        if col in profiles and dtype != 'str':
+            profiles[col] = [value for value in profiles[col] if isinstance(value, float)
+                             and (dtype == 'float64' or value.is_integer())]
+
+    # Header fields outside the dictionaries, e.g. a1_form_dt, a1_ex_ini or visityr_a1
+    for col in plan.columns | set(profiles):
+        if not profiles.get(col):
+            if col.endswith('_dt'):
+                profiles[col] = ['2019-01-02', '2020-11-30', '2022-06-15']
+            elif col.endswith('_ini'):
+                profiles[col] = ['AB', 'CD', 'EF']
+            elif 'yr' in col:
+                profiles[col] = [2015.0, 2019.0, 2023.0]
+            else:
+                profiles[col] = [float(value) for value in range(10)]
+    return profiles
+
+
+def generate_uds3(profiles, merge_primaries, rows, seed=0):
+    """
+    Build a synthetic UDS3 export.
+
+    Args:
+        profiles (dict): Column -> value set, from column_profiles.
+        merge_primaries (set): Primary columns of the " | " merge rules, missing more often.
+        rows (int): Number of rows.
+        seed (int): Seed of the random generator, the same seed gives the same data.
+
+    Returns:
+        pd.DataFrame: UDS3 data with unique adc_sub_id keys.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for col, values in sorted(profiles.items()):
+        numbers = [value for value in values if isinstance(value, float)]
+        # Numeric value sets stay numeric, anything with text is written as text
+        if len(numbers) == len(values) and numbers:
+            column = rng.choice(np.array(numbers), rows)
+            # Whole-number codes are written as 3 rather than 3.0, as REDCap exports them
+            if all(value.is_integer() for value in numbers):
+                column = pd.array(column.astype(np.int64), dtype="Int64")
+        else:
+            column = rng.choice(np.array([str(value) for value in values] or sample_texts, dtype=object), rows)
+        missing = rng.random(rows) < (MERGE_MISSING_RATE if col in merge_primaries else MISSING_RATE)
+        columns[col] = pd.Series(column).mask(missing)
+
+    columns['adc_sub_id'] = pd.Series([f"P{i:07d}" for i in range(rows)])
+    return pd.DataFrame(columns)
+
+
+class StageTimer:
+    """Wall time per pipeline function and per (form, mapping type), collected while its wrappers are installed."""
+
+    def __init__(self):
+        self.stages = {}
+        self.forms = {}
+
+    def add(self, totals, key, seconds):
+        totals[key] = totals.get(key, 0.0) + seconds
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(self.stages, name, time.perf_counter() - start)
+        return timed
+
+    def wrap_mappings(self, func):
+        # Every process_mappings call gets the rules of one JSON file and mapping type
+        def timed(run, rules):
+            start = time.perf_counter()
+            try:
+                return func(run, rules)
+            finally:
+                if rules:
+                    self.add(self.forms.setdefault(rules[0].form, {}), rules[0].mapping_type, time.perf_counter() - start)
+        return timed
+
+    def mapping_types(self):
+        return {mapping_type: sum(form.get(mapping_type, 0.0) for form in self.forms.values()) for mapping_type in MAPPING_TYPES}
+
+
+@contextmanager
+def timed_pipeline(timer):
+    # The parser calls its stages through module globals and CrosswalkRun methods, so wrapping them there times the real code path
+    functions = {name: getattr(parser, name) for name in ["format_uds3", "data_crosscheck", "replace_nan_and_na", "process_and_save_data"]}
+    methods = {name: getattr(parser.CrosswalkRun, name) for name in ["process_all_jsons", "process_mappings"]}
+    for name, func in functions.items():
+        setattr(parser, name, timer.wrap(name, func))
+    for name, func in methods.items():
+        setattr(parser.CrosswalkRun, name, timer.wrap_mappings(func) if name == "process_mappings" else timer.wrap(name, func))
+    try:
+        yield timer
+    finally:
+        for name, func in functions.items():
+            setattr(parser, name, func)
+        for name, func in methods.items():
+            setattr(parser.CrosswalkRun, name, func)
+
+
+def run_pipeline(csv_path, engine, data_order_path, output_file):
+    # One full migration as the command line runs it, returns the timer
+    with timed_pipeline(StageTimer()) as timer:
+        start = time.perf_counter()
+        nacc = parser.read_uds3_csv(csv_path, engine.read_options(csv_path))
+        timer.add(timer.stages, "read_uds3_csv", time.perf_counter() - start)
+
+        uds4_df = engine.transform(nacc)
+        parser.process_and_save_data(data_order_path, uds4_df, output_file)
+        timer.add(timer.stages, "total", time.perf_counter() - start)
+    return timer
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous_path, results):
+    # Ratio of every stage against a previous results file, > 1 is slower
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {run["rows"]: run for run in json.load(f)["runs"]}
+
+    for run in results["runs"]:
+        if run["rows"] not in previous:
+            continue
+        print(f"\n{run['rows']} rows vs {previous_path}")
+        for section in ["stages", "mapping_types"]:
+            for name, seconds in run[section].items():
+                before = previous[run["rows"]][section].get(name)
+                if before:
+                    print(f"  {name:<28} {before:9.3f}s -> {seconds:9.3f}s  x{seconds / before:5.2f}")
+
+
+def print_summary(run):
+    print(f"\n{run['rows']} rows x {run['columns']} columns")
+    for section in ["stages", "mapping_types"]:
+        print(f" {section}")
+        for name, seconds in run[section].items():
+            print(f"  {name:<28} {seconds:9.3f}s")
+    print(" slowest forms")
+    slowest = sorted(((seconds, form, mapping_type) for form, types in run["forms"].items()
+                      for mapping_type, seconds in types.items()), reverse=True)[:5]
+    for seconds, form, mapping_type in slowest:
+        print(f"  {form} {mapping_type}: {seconds:.3f}s")
+
+
+########################### Main Process #############################################
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark the UDS3 to UDS4 crosswalk on synthetic UDS3 data")
+    arg_parser.add_argument("json_folder_path", nargs="?", default="./Crosswalk")
+    arg_parser.add_argument("data_order_path", nargs="?", default="./UDS4Data_ColumnOrder.txt")
+    arg_parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS,
+                            help="Sizes of the synthetic UDS3 exports, 10k, 100k and 1M rows by default")
+    arg_parser.add_argument("--repeat", type=int, default=1, help="Runs per size, the fastest run is reported")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--data-dir", default=None,
+                            help="Keep the synthetic CSVs here and reuse them, a temporary folder by default")
+    arg_parser.add_argument("--output", default="uds_benchmark_results.json", help="Machine-readable results")
+    arg_parser.add_argument("--compare", default=None, help="A previous results file to compare against")
+    args = arg_parser.parse_args()
+
+    engine = parser.CrosswalkEngine.from_folder(args.json_folder_path)
+    plan = engine.plan
+    profiles = column_profiles(args.json_folder_path, plan)
+    merge_primaries = {rule.merge_columns[0] for rule in plan.rules() if rule.merge_columns}
+
+    with tempfile.TemporaryDirectory(prefix="uds_benchmark_") as work_dir:
+        data_dir = args.data_dir or work_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+        results = {"version": RESULTS_VERSION, "commit": git_commit(), "plan_key": plan.key, "seed": args.seed,
+                   "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                   "platform": platform.platform(), "runs": []}
+
+        # Smallest size first, peak memory is the high-water mark of this process
+        for rows in sorted(args.rows):
+            csv_path = os.path.join(data_dir, f"synthetic_uds3_{rows}_{args.seed}.csv")
+            if not os.path.exists(csv_path):
+                print(f"Generating {rows} synthetic UDS3 rows...")
+                generate_uds3(profiles, merge_primaries, rows, args.seed).to_csv(csv_path, index=False)
+
+            timers = [run_pipeline(csv_path, engine, args.data_order_path, os.path.join(work_dir, "uds4_benchmark.csv"))
+                      for _ in range(max(1, args.repeat))]
+            timer = min(timers, key=lambda timer: timer.stages["total"])
+
+            peak = parser.peak_memory_mb()
+            run = {"rows": rows, "columns": len(profiles) + 1, "stages": timer.stages,
+                   "mapping_types": timer.mapping_types(), "forms": timer.forms,
+                   "rows_per_second": rows / timer.stages["total"], "peak_memory_mb": peak}
+            results["runs"].append(run)
+            print_summary(run)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f"\nBenchmark results saved in {args.output}")
+
+    if args.compare:
+        compare_results(args.compare, results)
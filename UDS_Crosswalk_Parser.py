@@ -1,646 +1,1882 @@
-import re
-import json
-import sys, os
-import warnings
-import pandas as pd
-import numpy as np
-import io
-
-# Ignore all warnings
-warnings.filterwarnings("ignore")
-
-
-if len(sys.argv) > 3:
-	# Inputs -- 1. UDS3 Recap Data path, 2.Json Crosswalk folder path, 3. UDS3_Data_Elements_list
-    uds3_data_path, json_folder_path, data_order_path = sys.argv[1],sys.argv[2],sys.argv[3]
-elif sys.stdin and sys.stdin.isatty(): 
-  print("Running interactively, be sure to update paths in Main Process")
-  uds3_data_path = json_folder_path = data_order_path = None
-
-else:
-    print("Please Provide the UDS3_data, Json Crosswalk Folder and Data Order paths")
-
-
-def load_json_files(directory):
-    json_files = [f for f in os.listdir(directory) if f.endswith('.json')]
-    mapping_data = {}
-    
-    for json_file in json_files:
-        with open(os.path.join(directory, json_file), 'r',encoding='utf-8') as f:
-            mapping_data[json_file] = json.load(f)
-    
-    return mapping_data
-
-
-def process_repeating_variables(uds3_var, uds4_var, uds3_df, uds4_df, response_map=None):
-    kid_sib_pattern = re.compile(r'(kid|sib)')
-    match = kid_sib_pattern.search(uds3_var)
-    
-    if not match:
-        return
-    
-    word = match.group(1)
-    rng = 15 if word == 'kid' else 20
-
-    # Clean up base variable names
-    base_var = uds3_var.replace(word, '').replace('#', '')
-    base_var1 = uds4_var.replace(word, '').replace('#', '')
-
-    for i in range(1, rng + 1):
-        new_uds3_col = f"{word}{i}{base_var}"
-        new_uds4_col = f"{word}{i}{base_var1}"
-
-        if new_uds3_col not in uds3_df.columns:
-            continue
-
-        if response_map:
-            # Create a mapping function to speed up value replacement
-            col_values = uds3_df[new_uds3_col].astype(str)
-            mapped_values = col_values.map(lambda val: response_map[val] if val in response_map else "NA")
-
-            # Handle unmatched values
-            if not new_uds4_col.endswith("tpr"):
-                mapped_values[~mapped_values.isin(response_map.values())] = col_values
-
-            uds4_df[new_uds4_col] = mapped_values
-        else:
-            # Directly copy the values if no response map
-            uds4_df[new_uds4_col] = uds3_df[new_uds3_col]
-
-
-def process_mappings(mapping_data, mapping_type):
-    """
-    Process mappings from UDS3 to UDS4 based on the specified mapping type.
-
-    Args:
-        mapping_data (dict): The dictionary containing mapping configurations.
-        mapping_type (str): The type of mapping to process (e.g., 'Direct_Mappings').
-    """
-    filled_indices = [] # special tracking for diabetes column present in A5D2 Form
-
-    # Iterate through each mapping entry for the given mapping type
-    for mapping in mapping_data.get(mapping_type, []):
-        
-        # Extract and normalize UDS3 and UDS4 variable names to lowercase
-        uds3_var = mapping["UDS3_variable"].lower()
-        uds4_var = mapping["UDS4_variable"].lower()
-
-        # Resolve UDS3 variable names using a data dictionary, if available
-        uds3_var = data_dict.get(uds3_var, uds3_var)
-        
-        # Initialize structured mappings list
-        structured_mappings = []
-
-        # Handle different mapping types
-        if mapping_type == 'Direct_Mappings':
-            # Extract response level and conformity mappings for direct mappings
-            response_levels = [m for m in mapping["crosswalk_remappings"] if m.get("mapping_type", "").startswith("Response LEVELS")]
-
-            conformity = [m for m in mapping["crosswalk_remappings"] if m["mapping_type"] == "Conformity"]
-        else:
-            # Extract response level, conformity, and structured mappings for non-direct mappings
-            response_levels = [m for m in mapping["crosswalk_mappings"] if m.get("mapping_type", "").startswith("Response LEVELS")]
-
-            conformity = [m for m in mapping["crosswalk_mappings"] if m["mapping_type"] == "Conformity"]
-            structured_mappings = [m for m in mapping.get("crosswalk_mappings", []) if m["mapping_type"] == "Structured mapping"]
-  
-
-        # Special Case: Handling cases where uds3_var has two columns separated by " | " - useful for sheets like A5D2,B1 and B8
-        if "|" in uds3_var and not structured_mappings:
-            
-            # Split the uds3_var into two columns based on " | " separator
-            uds3_vars = uds3_var.split(" | ")
-
-            # Ensure there are exactly two columns after splitting
-            if len(uds3_vars) == 2:
-                primary_col, secondary_col = uds3_vars[0], uds3_vars[1]
-
-                # Check if both primary and secondary columns exist in the uds3_df DataFrame
-                if primary_col in uds3_df.columns and secondary_col in uds3_df.columns:
-                
-                # This is a special variable where we dont want to have/impute the uds4 data with value of 0
-                    if uds4_var == "diabtype":
-                        # Creating a mask where primary_col is NA or null, and secondary_col is NOT 0
-                        mask = (uds3_df[primary_col].isnull() | (uds3_df[primary_col] == "NA")) & (uds3_df[secondary_col] != 0)
-                    
-                    else:
-                        # Handle both NaN and 'NA' cases
-                        mask = uds3_df[primary_col].isnull() | (uds3_df[primary_col] == "NA")
-                        
-                        if uds4_var == 'diabetes':
-                            fill_mask = mask & (uds3_df[secondary_col] == 2)
-                            # Store the index positions where the fill happens with value 2
-                            filled_indices = uds3_df.index[fill_mask].tolist()
-
-                    # Filling up the missing values in primary_col with secondary_col values
-                    uds3_df.loc[mask, primary_col] = uds3_df.loc[mask, secondary_col]   
-                    # Set uds3_var to primary_col as it will be used for the next steps
-                    uds3_var = primary_col
-                    
-                # If only the primary column exists in uds3_df
-                elif primary_col in uds3_df.columns:
-                    uds3_var = primary_col  # Use primary_col for further operations
-
-                # If only the secondary column exists in uds3_df
-                else:
-                    uds3_var = secondary_col  # Use secondary_col for further operations  
-              
-        
-        # Case -1 : Response levels and no conformity
-        # This block handles mapping responses when there are response levels, but no conformity flag is set
-        if response_levels and not conformity and uds3_var in uds3_df.columns:
-            # Create a dictionary mapping each UDS3 value to its corresponding UDS4 value from response_levels
-            response_map = {str(item["UDS3_value"]): str(item["UDS4_value"]) 
-                            for mapping in response_levels for item in mapping["mappings"]}
-
-            # Iterate through each mapping between UDS3 value and UDS4 value
-            for uds3_value, uds4_value in response_map.items():
-                # Skip values containing "|" or "grep(" as they are not to be mapped
-                if "|" not in uds3_value and "grep(" not in uds3_value:
-                    
-                    # If the UDS4 variable exists in the UDS4 DataFrame
-                    if uds4_var in uds4_df.columns:
-                        # .isna() is not capturing the missing rows due to '<NA>', replacing the values of '<NA>' object type to pd.NA
-                        uds4_df[uds4_var] = uds4_df[uds4_var].replace(['<NA>', 'null'], pd.NA).astype('string')
-                        
-                        # Identify rows in UDS4 where the value is missing (NaN)
-                        stm = uds4_df[uds4_var].isna()
-
-                        # Map the UDS3 value to the UDS4 value where the UDS4 value is missing
-                        uds4_df.loc[stm & (uds3_df[uds3_var].astype(str) == uds3_value), uds4_var] = uds4_value
-                    else:
-                        # If the UDS4 variable doesn't exist, just map the UDS3 value to the UDS4 variable
-                        uds4_df.loc[uds3_df[uds3_var].astype(str) == uds3_value, uds4_var] = uds4_value
-
-        # Check if there are any structured mappings to process
-        # case -2: structured mappings i.e, Dates and calculated fields
-        elif structured_mappings:
-            # Iterate through each structured mapping entry
-            for struct_map in structured_mappings:
-                for mapping_entry in struct_map["mappings"]:
-                    # Extract UDS3 and UDS4 values from the mapping entry
-                    uds3_value = mapping_entry["UDS3_value"]
-                    uds4_value = mapping_entry["UDS4_value"]
-
-                    # Handling conditional IF-ELSE structured mappings
-                    if "IF(" in uds3_value:
-                        # Split the UDS3 variables to handle multiple conditions
-                        uds3_vars = uds3_var.split(" | ")
-
-                        response_map = {str(item["UDS3_value"]): str(item["UDS4_value"]) 
-                                        for mapping in response_levels 
-                                        for item in mapping["mappings"]}
-
-                        # Separate OR and AND conditions to control processing order
-                        or_conditions = {k: v for k, v in response_map.items() if "|" in k}
-                        and_conditions = {k: v for k, v in response_map.items() if "&" in k}
-
-                        # Process OR conditions first
-                        for uds3_value, uds4_value in or_conditions.items():
-                            operator = "|"
-                            values = uds3_value.split(f" {operator} ")
-
-                            condition = False  # Start with False for OR logic
-                            for col, val in zip(uds3_vars, values):
-                                # Handle NULL or missing values
-                                if val in ["NA", "None"]:
-                                    condition |= uds3_df[col].isna() | (uds3_df[col].astype(str).str.upper().isin(["NA"]))
-                                else:
-                                    # Match exact values
-                                    condition |= (uds3_df[col].astype(str) == val)
-
-                            # Apply the transformation by updating the UDS4 dataframe
-                            uds4_df.loc[condition, uds4_var] = uds4_value
-
-                        # Process AND conditions second (these will overwrite OR conditions where applicable)
-                        for uds3_value, uds4_value in and_conditions.items():
-                            operator = "&"
-                            values = uds3_value.split(f" {operator} ")
-
-                            condition = True  # Start with True for AND logic
-                            for col, val in zip(uds3_vars, values):
-                                # Handle NULL or missing values
-                                if val in ["NA", "None"]:
-                                    condition &= uds3_df[col].isna() | (uds3_df[col].astype(str).str.upper().isin(["NA"]))
-                                else:
-                                    # Match exact values
-                                    condition &= (uds3_df[col].astype(str) == val)
-
-                            # Apply the transformation by updating the UDS4 dataframe
-                            uds4_df.loc[condition, uds4_var] = uds4_value
-                        
-                    # Identify separator: OR ('|') or AND ('&')
-                    if "|" in uds3_value:
-                        separator = "|"
-                        operator = np.logical_or
-                    elif "&" in uds3_value:
-                        separator = "&"
-                        operator = np.logical_and
-                    else:
-                        separator = None
-                        operator = None
-
-                    # Handling multiple UDS3 variables with OR / AND conditions
-                    if separator:
-                        uds3_vars = [var.strip() for var in uds3_var.split(f" {separator} ")]
-                        uds3_values = [var.strip() for var in uds3_value.split(f" {separator} ")]
-
-                        # Ensure all UDS3 columns exist in the DataFrame
-                        if all(col in uds3_df.columns for col in uds3_vars):
-            
-                            conditions = [(uds3_df[col].astype(str) == val) for col, val in zip(uds3_vars, uds3_values)]
-                            # Apply OR or AND depending on the separator
-                            if separator == '|':
-                                mask = np.logical_or.reduce(conditions)
-                            else:
-                                mask = np.logical_and.reduce(conditions)
-
-                            # Only update where conditions match
-                            if uds4_var in uds4_df.columns:
-                                missing_mask = uds4_df[uds4_var].isna()  # Handle missing (NA) values in uds4_df
-                                #uds4_df.loc[missing_mask & mask, uds4_var] = uds4_value
-                
-                                uds4_df.loc[missing_mask & mask, uds4_var] = pd.to_numeric(uds4_value, errors='coerce')
-                            else:
-                                uds4_df.loc[mask, uds4_var] = uds4_value
-
-                    else:
-                        # Handling structured mathematical mappings (e.g., "PDAGE + BIRTHYR" → "PDYR - BIRTHYR")
-                        if any(op in uds3_value for op in ["+", "-", "*", "/"]):
-                            uds3_cols = [col.lower() for col in re.findall(r'[A-Za-z0-9_]+', uds4_value)]
-
-                            # Check if the UDS4 variable exists in struct_map1
-                            if uds4_var in struct_map1:
-                                struct_col = struct_map1[uds4_var]
-
-                                # Ensure struct_col exists in uds3_df and filter out rows where it's non-zero
-                                if struct_col in uds3_df.columns:
-                                    non_zero_mask = uds3_df[struct_col] != 0  # Mask for non-zero rows
-
-                                    if non_zero_mask.any():  # Proceed only if there's at least one non-zero value
-                                        # Ensure all columns exist before computing
-                                        if all(col in uds3_df.columns for col in uds3_cols):
-                                            # Replace the UDS4 expression with UDS3 column values
-                                            uds3_expr = uds4_value.replace("–", "-").strip().lower()
-                                
-                                            for col in uds3_cols:
-                                                uds3_expr = uds3_expr.replace(col, 
-                                                                              f"uds3_df.loc[non_zero_mask, '{col}'].fillna(0)")
-
-                                            # Ensure non_zero_mask is passed into eval() explicitly
-                                            try:
-                                                uds3_computed = eval(uds3_expr, {"uds3_df": uds3_df,
-                                                                                 "np": np, "non_zero_mask": non_zero_mask})
-                                            except Exception as e:
-                                                print(f"Error evaluating UDS3 expression {uds3_expr}: {e}")
-                                                uds3_computed = None
-
-                                            # Assign computed values to uds4_df
-                                            if uds3_computed is not None:
-                                                lev_mask = uds3_df[uds3_var]!=9999
-                                                uds4_df.loc[lev_mask & non_zero_mask, uds4_var] = uds3_computed.astype(int)
-                                                
-                                                # Replace rows where uds3_var is 9999 with 999
-                                                replace_mask = uds3_df[uds3_var] == 9999
-                                                uds4_df.loc[replace_mask, uds4_var] = 999
-
-
-                    # This block handles the "paste()" function which is used to combine multiple columns into a single string
-                    if "paste(" in uds4_value:
-                        # Extracts the column names from inside the paste() function by removing "paste(" and ")" 
-                        # and splitting the remaining string by commas
-                        comp_raw = uds4_value.replace("paste(", "").replace(")", "").split(',')
-
-                        # Processes each component by stripping whitespace, converting to lowercase
-                        # Only keeps components that contain at least one alphanumeric character
-                        columns = [comp.strip().lower() for comp in comp_raw if any(c.isalnum() for c in comp.strip())]
-
-                        # Checks if all the extracted column names exist in the uds3_df dataframe
-                        if all(comp in uds3_df.columns for comp in columns):
-                            # If all columns exist, creates a new column in uds4_df by concatenating values from the 
-                            # first three columns in the list, separated by "/" characters
-                            # Values are converted to strings to ensure they can be concatenated
-                            uds4_df[uds4_var] = (
-                                uds3_df[columns[0]].astype(str) + "/" +
-                                uds3_df[columns[1]].astype(str) + "/" +
-                                uds3_df[columns[2]].astype(str)
-                            )
-
-                        else:
-                            # If not all columns exist, tries to extract a suffix from the second column name
-                            # The regex looks for 1-2 underscores followed by a pattern like 'a2' or 'a5d2'
-                            match = re.search(r'_{1,2}([a-d]\d*(d2)?)$', columns[1]) 
-
-                            # If a suffix is found
-                            if match:
-                                # Extracts the suffix (e.g., 'b5' or 'a5d2')
-                                suffix = match.group(1)
-
-                                # Special handling for suffixes containing 'd2'
-                                if 'd2' in suffix: 
-                                    # Uses only 'd2' instead of the full suffix (e.g., 'a5d2')
-                                    sf = 'd2'
-                                    # Creates a column name by appending '_form_dt' to the simplified suffix
-                                    mapped_column = f"{sf}_form_dt"
-                                    # Assigns values from the mapped column in uds3_df to the new column in uds4_df  
-                                    uds4_df[uds4_var] = uds3_df[mapped_column]
-                                else:
-                                    # For other suffixes, constructs a column name with the suffix and '_form_dt'
-                                    # Then assigns values from this column in uds3_df to the new column in uds4_df
-                                    uds4_df[uds4_var] = uds3_df[f"{suffix}_form_dt"]                  
-                        
-
-        # Case 3: No Response LEVELS, copy values directly
-        # This block handles the case where there are no response levels defined, and simply copies the values from uds3 to uds4
-        elif not response_levels and mapping_type!='Structured_Transformations':
-           
-            # Check if uds3_var exists in the uds3_df DataFrame
-            if uds3_var in uds3_df.columns:
-                # If uds4_var exists in the uds4_df DataFrame, copy values only where uds4_var is NA
-                if uds4_var in uds4_df.columns:
-                    mm = uds4_df[uds4_var].isna()  # Identify rows where uds4_var is missing (NA)
-                    uds4_df.loc[mm, uds4_var] = uds3_df[uds3_var]  # Copy corresponding values from uds3_df to uds4_df where uds4_var is NaN
-                else:
-                    # If uds4_var doesn't exist in uds4_df, directly assign the entire column from uds3_df to uds4_df
-                    uds4_df[uds4_var] = uds3_df[uds3_var]
-
-        # Case 4: Conformity check
-        # This block handles cases where conformity is checked, i.e., ensuring UDS3 and UDS4 values match based on predefined mappings
-        elif conformity:
-            # Extract all UDS3 conformity values into a set
-            uds3_conformity_values = set(item["UDS3_value"] for mapping in conformity for item in mapping["mappings"])
-
-            # Extract all UDS4 conformity values into a set
-            uds4_conformity_values = set(item["UDS4_value"] for mapping in conformity for item in mapping["mappings"])
-
-            # Extract all notes associated with the conformity mappings
-            note = set(item["note"] for mapping in conformity for item in mapping["mappings"])
-            
-            uds3_processed_values = set()
-
-            for value in uds3_conformity_values:
-                
-                value = str(value)
-
-                if "|" in value:
-                    # Split and keep the first part
-                    first_part = value.split("|")[0].strip()
-                    uds3_processed_values.add(first_part)
-                
-                elif "Any" in value:
-
-                    uds3_processed_values.add(value.rstrip("."))
-                    
-                else:
-                    uds3_processed_values.add(value)
-
-            # Check if UDS3 and UDS4 conformity values match
-            if uds3_processed_values == uds4_conformity_values:
-                
-                if uds3_var in a3_list:
-                    process_repeating_variables(uds3_var, uds4_var, uds3_df, uds4_df)
-
-                # If notes contain "MAX(", it indicates we need to handle special cases (e.g., max across multiple columns)
-                elif "MAX(" in str(note):
-                    note_str = str(note).strip("{}'")  # Clean up the note string by removing unwanted characters
-                    cols = re.findall(r'\b\w+\b', note_str)  # Extract column names from the note string
-                    uds3_vars = [col.lower() for col in cols[1:]]  # Convert column names to lowercase (ignoring the first column)
-
-                    # If all extracted columns exist in uds3_df, calculate the maximum value across them
-                    if all(col in uds3_df.columns for col in uds3_vars):
-                        uds4_df[uds4_var] = uds3_df[uds3_vars].max(axis=1)
-                
-                # If uds3_var exists in uds3_df, directly copy its values to uds4_df
-                elif uds3_var in uds3_df.columns:
-                    if uds4_var in uds4_df:
-                        mask = uds4_df[uds4_var].isna()
-                        uds4_df.loc[mask, uds4_var] = uds3_df[uds3_var]
-
-                        if uds4_var=='diabetes':
-                            uds4_df[uds4_var] = uds4_df[uds4_var].replace({3: 1})
-                            uds4_df.loc[filled_indices, uds4_var] = 1
-                    
-                    else: 
-                       
-                        uds4_df[uds4_var] = uds3_df[uds3_var]
-            
-            else:
-                # If conformity values don't match, create a mapping from UDS3 values to UDS4 values based on response_levels
-                response_map = {str(item["UDS3_value"]): str(item["UDS4_value"]) 
-                                for mapping in response_levels for item in mapping["mappings"]}
-                
-                if uds3_var in a3_list:
-                    process_repeating_variables(uds3_var, uds4_var, uds3_df, uds4_df,response_map)
-
-                # Handle conformity mappings, including both UDS4 conformity and UDS3 response levels
-                elif uds3_var in uds3_df.columns:
-                    
-                    # Apply exact single-value mappings first (e.g., 2 -> 1)
-                    for uds3_value, uds4_value in response_map.items():
-    
-                        # Skip UDS3 values containing "|" or "grep("
-                        if "|" not in uds3_value and "grep(" not in uds3_value:
-                            # If UDS3 column has float type, convert and map
-                            if pd.api.types.is_float_dtype(uds3_df[uds3_var]):
-                                float_uds3_value = float(uds3_value)
-                                uds4_df.loc[uds3_df[uds3_var] == float_uds3_value, uds4_var] = uds4_value
-                            
-                                # special case for dysarth, postinst and impnomci columns
-                            elif uds3_value == 'None':
-                                uds4_df.loc[pd.isnull(uds3_df[uds3_var]), uds4_var] = uds4_value
-    
-                            else:
-                                # Otherwise, map based on string values
-                                uds4_df.loc[uds3_df[uds3_var].astype(str) == uds3_value, uds4_var] = uds4_value
-           
-
-                        else:
-                            # Skip columns with names ending in "sec" or "ter" (those are not mapped)
-                            if not (uds3_var.endswith("sec") or uds3_var.endswith("ter")):
-                                # Handle cases with logical OR conditions (e.g., "1 | 3 | 4 | 5 | 50 | 99" -> None)
-                                values = uds3_value.split(" | ")  # Split values by " | " separator
-                                uds4_df.loc[uds3_df[uds3_var].astype(str).isin(values), uds4_var] = uds4_value
-    
-
-                    # Handling grep-based text searches (e.g., grep("guatemalan", HISPORX))
-                    for uds3_value, uds4_value in response_map.items():
-                        if "grep(" in uds3_value:
-                            # Extract the search terms from the grep function
-                            search_terms = re.search(r'grep\("(.*?)",', uds3_value).group(1).lower().split(" or ")
-                            # Apply the search terms to find matching rows in uds3_df
-                            match_mask = uds3_df[uds3_var].astype(str).str.lower().apply(lambda x: any(term in x for term in search_terms))
-                            uds4_df.loc[match_mask, uds4_var] = uds4_value
-                            
-
-                    # If the mapping type is not 'Structured_Transformations' or 'High_Complexity', preserve non-mapped values
-                    if mapping_type not in ['Structured_Transformations','High_Complexity']:
-                        # Ensure all values from uds3_df are preserved in uds4_df where they are not mapped
-                        if response_map:
-                            if "grep(" not in uds3_value and uds3_var!='cancer':
-                                uds4_df.loc[~uds4_df[uds4_var].isin(response_map.values()), uds4_var] = uds3_df[uds3_var].astype(str)              
-
-
-
-# Main Function to process the JSON files and apply crosswalk logic to them
-def process_all_jsons(directory):
-    
-    # Load the JSON files from the specified directory
-    mapping_data = load_json_files(directory)
-    
-    # Iterate through each JSON file in the loaded mapping data
-    for json_file, json_data in mapping_data.items():
-        print(f"Processing {json_file}...")  # Log the current JSON file being processed
-
-        # Define the list of mapping types to process for each JSON file
-        mapping_types = ["Direct_Mappings", "Conditional_Consistency", "Structured_Transformations", "High_Complexity"]
-        
-        # Loop through each mapping type and process it
-        for mapping_type in mapping_types:
-            print(f"  Processing {mapping_type} mappings...")  # Log the current mapping type being processed
-            process_mappings(json_data, mapping_type)  # Call the function to process mappings for the given type
-        
-        print(f"Completed processing {json_file}")  # Log that processing of the current JSON file is complete
-
-# Function to replace 'NaN' or '<NA>' values in a DataFrame with 'NA'
-def replace_nan_and_na(df):
-    return df.applymap(lambda x: "NA" if (pd.isna(x) or x == "<NA>") else x)  # Apply replacement to all elements in the DataFrame
-
-# Cross-checking the data in the uds4_df DataFrame and handling missing values based on a3_stop_dict
-def data_crosscheck(uds4_df):
-    # Iterate through each column (uds4_var) in the uds4_df DataFrame
-    for uds4_var in uds4_df.columns:
-        # Check if the current column name (uds4_var) exists in a3_stop_dict
-        if uds4_var in a3_stop_dict:
-            # Create a boolean mask to identify rows where the value in the column is missing
-            logic_mask = uds4_df[uds4_var].isna()
-            
-            # For rows where the value is missing, replace it with the corresponding value from a3_stop_dict
-            # The mapping in a3_stop_dict provides the replacement value for that particular variable
-            uds4_df.loc[logic_mask, a3_stop_dict[uds4_var]] = pd.NA
-        
-        elif uds4_var in recode_rules:
-                recode_map = recode_rules[uds4_var]
-                uds4_df[uds4_var] = uds4_df[uds4_var].replace(recode_map)
-
-
-def process_and_save_data(file_path, final_df, output_file):
-    # Load UDS4 data elements from the provided file and convert them to lowercase
-    with open(file_path, 'r') as file:
-        loaded_uds4_data_elements = [line.strip().lower() for line in file.readlines()]
-    
-    # Filter valid columns from final_df based on the loaded UDS4 data elements
-    valid_columns = [col for col in loaded_uds4_data_elements if col in final_df.columns]
-    
-    # Reorder the DataFrame to include only the valid columns
-    final_filtered_df = final_df[valid_columns]
-    
-    # Save the filtered DataFrame to a CSV file with UTF-8-SIG encoding to avoid character corruption
-    final_filtered_df.to_csv(output_file, index=False, na_rep="NA", encoding='utf-8-sig')
-
-
-# Define the categories and their respective suffixes
-categories = {
-    'a': [1, 2, 3, 4,5],
-    'b': [1, 4, 5, 6, 7, 8, 9],
-    'c': [2],
-    'd': [1,2]
-}
-
-data_dict = {}
-
-for category, numbers in categories.items():
-    for num in numbers:
-        key_suffix = f"__{category}{num}"
-        data_dict[f'ptid{key_suffix}'] = 'adc_sub_id'
-        data_dict[f'formver{key_suffix}'] = 'form_ver_num'
-        data_dict[f'adcid{key_suffix}'] = 'adc_cntr_id'
-        data_dict[f'visitnum{key_suffix}'] = f'{category}{num}_visit_day'
-        data_dict[f'initials{key_suffix}'] = f'{category}{num}_ex_ini'
-
-a3_stop_dict = {
-    'mometpr': ['mommeval', 'momageo'],
-    'dadetpr': ['dadmeval', 'dadageo'],
-    **{f'kid{i}etpr': [f'kid{i}meval', f'kid{i}age'] for i in range(1, 16)},
-    **{f'sib{i}etpr': [f'sib{i}meval', f'sib{i}age'] for i in range(1, 21)}
-}
-
-struct_map1 = {'hrtattage':'cvhatt','strokage':'cbstroke','pdage':'pd','lasttbi':'tbi','pdothrage':'pdothr','tiaage':'cbtia'}
-
-a3_list = ['sib###yob', 'sib###agd','sib###pdx','sib###ago','sib###moe',
-           'kid###yob', 'kid###agd','kid###pdx','kid###ago','kid###moe']
-
-recode_rules = {"csfad": {np.nan: 0},"taupet": {np.nan: 0}, "cdommem": {np.nan: 0},"mci": {np.nan: 0},
-                "cdomattn": {np.nan: 0},"cdomexec": {np.nan: 0},"cdomlang": {np.nan: 0},"cdomvisu": {np.nan: 0}}
-
-
-########################### Main Process #############################################
-
-# #Define paths for interactive running
-
-#uds3_data_path = r'C:\PATH\TO\UDS3\<UDS3_data_file>.csv'
-#json_folder_path = r'C:\PATH\TO\JSON\FOLDER'
-#data_order_path = r'C:\PATH\TO\ORDER\FOLDER\<dataOrder_file>.txt'
-
-if uds3_data_path is None or json_folder_path is None or data_order_path is None:
-    print("Cannot able to find the paths in Main Process")
-    exit()
-
-# Provide UDS3 data as input - try to provide the label data
-nacc = pd.read_csv(uds3_data_path)
-print(f"UDS3_data has {nacc.shape[0]} rows and {nacc.shape[1]} columns")
-
-# Defining the UDS4 data frame
-uds4_df = pd.DataFrame()
-
-# Convert float-like strings to integers and pad with zeros
-cols_to_format = (['momprdx', 'dadprdx'] +
-    [f"sib{i}pdx" for i in range(1, 21)] + [f"kid{i}pdx" for i in range(1, 16)])
-
-# Filter only existing columns
-existing_cols = [col for col in cols_to_format if col in nacc.columns]
-
-# Apply formatting
-nacc[existing_cols] = nacc[existing_cols].applymap(lambda x: f"{float(x):03.0f}" if pd.notnull(x) else "NA")
-
-# Copying the nacc_data to uds3_df
-uds3_df = nacc.copy()
-uds3_df.columns = uds3_df.columns.str.lower()
-
-# Data Type conversion to match the values
-float_columns = uds3_df.select_dtypes(include=['float']).columns
-
-for col in float_columns:
-    # Convert to numeric, coerce errors to NaN
-    uds3_df[col] = pd.to_numeric(uds3_df[col], errors='coerce')
-
-    # Replace infinities with NaN
-    uds3_df[col] = uds3_df[col].replace([np.inf, -np.inf], np.nan)
-
-    # Check if all remaining values are safe for integer conversion
-    if uds3_df[col].dropna().apply(float.is_integer).all():
-        uds3_df[col] = uds3_df[col].astype("Int64")  # Convert to nullable integer
-    else:
-        print(f"Skipping column '{col}' due to non-integer values.")
-
-# Final process 
-directory = json_folder_path
-
-# Process all the json data
-process_all_jsons(directory)
-
-# Data Validation - Correcting the UDS4 data
-data_crosscheck(uds4_df)
-
-# Saving the appropriate data
-final_df = replace_nan_and_na(uds4_df)
-
-# File name to save
-uds4_file_name = "uds4_redcap_data_py.csv"
-# Saving the ordered data
-process_and_save_data(
-    data_order_path, 
-    final_df, 
-    uds4_file_name)
-
-print("Your Data Migration from UDS3 to UDS4 is Completed")
-print(f"The UDS4 Data is saved in the current folder with name - {uds4_file_name}")
+import re
+import json
+import sys, os
+import argparse
+import warnings
+import pandas as pd
+import numpy as np
+import io
+import time
+import hashlib
+import tempfile
+import glob
+import contextlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from UDS_Rule_Compiler import compile_rules, condition_columns, evaluate_expression, BoolOp, Missing, MAPPING_TYPES
+from UDS_Output_Writer import OUTPUT_WRITERS, open_writer, output_name, read_output
+from UDS_Rule_Profile import RuleProfile
+from UDS_Memory_Budget import MemoryBudget, MemoryBudgetExceeded, peak_memory_mb
+
+
+class UDS4Columns:
+    """
+    Column buffer standing in for the UDS4 DataFrame while the rules run.
+
+    Each UDS4 column is kept as its own Series on the UDS3 index instead of being inserted into a
+    growing, fragmented DataFrame, and build() assembles them in one go.  Supports the DataFrame
+    operations the rules use: `col in buffer`, `buffer.columns`, `buffer[col]`, `buffer[col] = values`
+    and `buffer.loc[rows, col] = values`.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.data = {}
+        # Columns whose values the buffer owns; assigned columns may share their values (e.g. with the UDS3 data)
+        # and are only copied when a .loc write would change them in place
+        self.owned = set()
+        self.loc = _ColumnLocIndexer(self)
+
+    @property
+    def columns(self):
+        return self.data.keys()
+
+    def __contains__(self, col):
+        return col in self.data
+
+    def __getitem__(self, col):
+        return self.data[col]
+
+    def __setitem__(self, col, values):
+        # Held without copying the values, a new Series object so renaming it never reaches the UDS3 frame
+        if isinstance(values, pd.Series):
+            values = values.copy(deep=False) if values.index.equals(self.index) else values.reindex(self.index)
+        else:
+            values = pd.Series(values, index=self.index)
+        values.name = col
+        self.data[col] = values
+        self.owned.discard(col)
+
+    def build(self):
+        return pd.DataFrame(self.data, index=self.index)
+
+
+class _ColumnLocIndexer:
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __setitem__(self, key, values):
+        rows, col = key
+        # A one column frame goes through the same .loc path as the full frame did, so new columns
+        # and upcasts (e.g. text into a float column) get the same dtypes
+        if col in self.buffer.data:
+            # Copy on the first write, later writes must never reach the UDS3 frame
+            values_before = self.buffer.data[col]
+            frame = (values_before if col in self.buffer.owned else values_before.copy()).to_frame()
+        else:
+            frame = pd.DataFrame(index=self.buffer.index)
+        frame.loc[rows, col] = values
+        self.buffer.data[col] = frame[col]
+        self.buffer.owned.add(col)
+
+
+class ProfiledUDS4Columns(UDS4Columns):
+    """UDS4Columns reporting every write to the rule profile, only used with --profile."""
+
+    def __init__(self, index, profile):
+        super().__init__(index)
+        self.profile = profile
+        self.loc = _ProfiledLocIndexer(self)
+
+    def __setitem__(self, col, values):
+        self.profile.before_write(col, self.data.get(col))
+        super().__setitem__(col, values)
+        self.profile.rows_matched += int(self.data[col].notna().sum())
+
+
+class _ProfiledLocIndexer(_ColumnLocIndexer):
+    def __setitem__(self, key, values):
+        rows, col = key
+        self.buffer.profile.before_write(col, self.buffer.data.get(col))
+        super().__setitem__(key, values)
+        rows = np.asarray(rows)
+        self.buffer.profile.rows_matched += int(rows.sum()) if rows.dtype == bool else rows.size
+
+
+def process_repeating_variables(uds3_var, uds4_var, uds3_df, uds4_df, response_map=None):
+    """
+    Migrate a kid###/sib### family history variable for every family member present, as one block.
+
+    The member columns are read as one 2-D block of text, dictionary-encoded together, and the response
+    map with its unmatched-value passthrough is resolved once per distinct value instead of per column.
+
+    Args:
+        uds3_var (str): UDS3 pattern e.g. 'kid###yob'.
+        uds4_var (str): UDS4 pattern.
+        uds3_df (pd.DataFrame): UDS3 data.
+        uds4_df (UDS4Columns): The UDS4 columns being built.
+        response_map (dict): str(UDS3 value) -> UDS4 value, None copies the columns as they are.
+    """
+    kid_sib_pattern = re.compile(r'(kid|sib)')
+    match = kid_sib_pattern.search(uds3_var)
+    
+    if not match:
+        return
+    
+    word = match.group(1)
+    rng = 15 if word == 'kid' else 20
+
+    # Clean up base variable names
+    base_var = uds3_var.replace(word, '').replace('#', '')
+    base_var1 = uds4_var.replace(word, '').replace('#', '')
+
+    # Member columns present in the UDS3 data, paired with their UDS4 column
+    pairs = [(f"{word}{i}{base_var}", f"{word}{i}{base_var1}") for i in range(1, rng + 1)
+             if f"{word}{i}{base_var}" in uds3_df.columns]
+    if not pairs:
+        return
+
+    if not response_map:
+        # Directly copy the values if no response map
+        for new_uds3_col, new_uds4_col in pairs:
+            uds4_df[new_uds4_col] = uds3_df[new_uds3_col]
+        return
+
+    # One block for every member, encoded once across all of them as codes (rows x members) into its text levels
+    columns = [uds3_df[new_uds3_col] for new_uds3_col, _ in pairs]
+    if len({col.dtype for col in columns}) == 1 and pd.api.types.is_integer_dtype(columns[0]):
+        # Integers have a single text form, so only the distinct values are converted to text
+        codes, uniques = pd.factorize(pd.concat(columns, ignore_index=True), use_na_sentinel=False)
+        levels = pd.Series(uniques, dtype=columns[0].dtype).astype(str).to_numpy(dtype=object)
+        codes = codes.reshape(len(columns), -1).T
+    else:
+        # Text conversion first, as missing values (None, NaN) and floats (0.0, -0.0) can share a code but not a text
+        block = pd.concat(columns, axis=1).astype(str).to_numpy(dtype=object)
+        codes, levels = pd.factorize(block.ravel())
+        codes = codes.reshape(block.shape)
+
+    # Unmapped values keep their UDS3 text, unless the column is an etpr or the map itself gives "NA"
+    keep_unmatched = not base_var1.endswith("tpr") and "NA" not in set(response_map.values())
+    mapped = np.array([response_map[val] if val in response_map else (val if keep_unmatched else "NA") for val in levels],
+                      dtype=object)[codes]
+
+    for j, (_, new_uds4_col) in enumerate(pairs):
+        uds4_df[new_uds4_col] = mapped[:, j]
+
+
+class CrosswalkRun:
+    """
+    State of one crosswalk pass over a UDS3 frame: the UDS3 data, the UDS4 column buffer the rules
+    write to, and the per-column encodings the rules share.  Created by CrosswalkEngine.transform.
+    """
+
+    def __init__(self, uds3_df, profile=None, guards=None, verbose=True):
+        self.uds3_df = uds3_df
+        self.uds4_df = UDS4Columns(uds3_df.index) if profile is None else ProfiledUDS4Columns(uds3_df.index, profile)
+        self.profile = profile
+        # Dictionary-encoded UDS3 columns, built on first use and shared by every rule reading the column
+        self.encoded = {}
+        # Lowercased levels and grep term matches per UDS3 column
+        self.grep = {}
+        # Boolean row masks of the compiled structured conditions, shared by every rule and form
+        self.masks = {}
+        # UDS4 columns computed up front by another backend (see CrosswalkEngine.precompute), by UDS4 variable
+        self.precomputed = {}
+        # Structured math rule guards decided on the whole export when this frame is only part of it (see math_guards)
+        self.guards = guards or {}
+        # Report the structured math expressions that fail to evaluate
+        self.verbose = verbose
+
+    def encode_column(self, col):
+        """
+        Dictionary-encode a UDS3 column once so rules compare against its few distinct values instead of every row.
+
+        Args:
+            col (str): The UDS3 column name.
+
+        Returns:
+            tuple: (codes, levels, nulls) where levels[codes] reproduces uds3_df[col].astype(str)
+                and nulls flags the levels that came from missing cells.
+        """
+        if col not in self.encoded:
+            series = self.uds3_df[col]
+            str_codes, str_levels = pd.factorize(series.astype(str))
+            # Split each string level by missingness so 'None' mappings stay exact
+            codes, keys = pd.factorize(str_codes * 2 + series.isna().to_numpy())
+            self.encoded[col] = (codes, np.asarray(str_levels, dtype=object)[keys // 2], (keys % 2).astype(bool))
+        return self.encoded[col]
+
+    def overlay_column(self, col, rows, values):
+        """
+        Replace a UDS3 column of the run with a copy where `rows` take `values`, typed as a .loc write would.
+
+        The run's frame shares its columns with the caller's data, so the column is replaced instead of
+        written in place.  Later rules read the overlay.
+        """
+        frame = self.uds3_df[col].copy().to_frame()
+        frame.loc[rows, col] = values
+        self.uds3_df[col] = frame[col]
+        self.forget_column(col)
+
+    def forget_column(self, col):
+        # A rewritten UDS3 column invalidates its encoding, grep matches and every condition mask reading it
+        self.encoded.pop(col, None)
+        self.grep.pop(col, None)
+        self.masks = {expression: mask for expression, mask in self.masks.items() if col not in condition_columns(expression)}
+
+    def string_view(self, col):
+        # Cached equivalent of uds3_df[col].astype(str)
+        codes, levels, _ = self.encode_column(col)
+        return pd.Series(levels[codes], index=self.uds3_df.index)
+
+    def condition_mask(self, expression):
+        """
+        Evaluate a compiled condition (Equals, Missing or BoolOp) to a boolean row mask, computed once per run.
+
+        Equals and Missing are decided once per encoded level of the column and broadcast to the rows.
+
+        Args:
+            expression: Condition tree from the rule compiler.
+
+        Returns:
+            np.ndarray: One bool per UDS3 row.
+        """
+        if expression not in self.masks:
+            if isinstance(expression, BoolOp):
+                reduce = np.logical_or if expression.operator == "|" else np.logical_and
+                mask = reduce.reduce([self.condition_mask(operand) for operand in expression.operands])
+            else:
+                codes, levels, nulls = self.encode_column(expression.col)
+                if isinstance(expression, Missing):
+                    # Missing cells, or the text "NA" in any case
+                    level_mask = nulls | np.array([level.upper() == "NA" for level in levels], dtype=bool)
+                else:
+                    level_mask = levels == expression.value
+                mask = np.asarray(level_mask, dtype=bool)[codes]
+            self.masks[expression] = mask
+        return self.masks[expression]
+
+    def match_levels(self, col, predicates):
+        """
+        Find, for every row, the last predicate matching the row's encoded UDS3 value.
+
+        Args:
+            col (str): The UDS3 column name.
+            predicates (list): Functions taking (levels, nulls) arrays and returning a boolean array over the levels.
+
+        Returns:
+            np.ndarray: Index of the winning predicate per row, -1 where nothing matched.
+        """
+        codes, levels, nulls = self.encode_column(col)
+        winner = np.full(len(levels), -1)
+        for i, predicate in enumerate(predicates):
+            winner[predicate(levels, nulls)] = i
+        return winner[codes]
+
+    def grep_levels(self, col, terms, pattern):
+        """
+        Find which encoded levels of a UDS3 column contain each grep search term.
+
+        The levels are lowercased once per column and the combined pattern of every term
+        used on the column picks the levels worth checking term by term.
+
+        Args:
+            col (str): The UDS3 column name.
+            terms (list): Lowercase search terms, all the terms used on the column.
+            pattern (re.Pattern): Alternation of the terms.
+
+        Returns:
+            dict: Search term to a boolean array over the levels.
+        """
+        if col not in self.grep:
+            _, levels, _ = self.encode_column(col)
+            self.grep[col] = (pd.Series(levels, dtype=object).str.lower(), {}, pattern)
+        lowered, hits, _ = self.grep[col]
+
+        new_terms = [term for term in terms if term not in hits]
+        if new_terms:
+            candidates = np.flatnonzero(lowered.str.contains(pattern.pattern, regex=True).to_numpy())
+            for term in new_terms:
+                hit = np.zeros(len(lowered), dtype=bool)
+                hit[candidates] = lowered.iloc[candidates].str.contains(term, regex=False).to_numpy()
+                hits[term] = hit
+        return hits
+
+    def process_mappings(self, rules):
+        """
+        Process compiled mappings from UDS3 to UDS4 for a single JSON file and mapping type.
+
+        Args:
+            rules (list): The CrosswalkRule objects compiled for one JSON file and mapping type.
+        """
+        filled_indices = [] # special tracking for diabetes column present in A5D2 Form
+
+        # Iterate through each compiled mapping entry
+        for position, rule in enumerate(rules):
+            uds3_var = rule.uds3_var
+            uds4_var = rule.uds4_var
+            response_map = rule.response_map
+            path = "none"  # Code path the rule takes, reported by --profile
+            if self.profile is not None:
+                self.profile.start()
+
+            # Column already computed by the selected backend, assigned in rule order like any other write
+            if uds4_var in self.precomputed:
+                self.uds4_df[uds4_var] = self.precomputed[uds4_var]
+                if self.profile is not None:
+                    self.profile.stop(rule, position, "precomputed", self.uds4_df)
+                continue
+
+            # Special Case: Handling cases where uds3_var has two columns separated by " | " - useful for sheets like A5D2,B1 and B8
+            if rule.merge_columns:
+                primary_col, secondary_col = rule.merge_columns
+
+                # Check if both primary and secondary columns exist in the self.uds3_df DataFrame
+                if primary_col in self.uds3_df.columns and secondary_col in self.uds3_df.columns:
+
+                # This is a special variable where we dont want to have/impute the uds4 data with value of 0
+                    if uds4_var == "diabtype":
+                        # Creating a mask where primary_col is NA or null, and secondary_col is NOT 0
+                        mask = (self.uds3_df[primary_col].isnull() | (self.uds3_df[primary_col] == "NA")) & (self.uds3_df[secondary_col] != 0)
+
+                    else:
+                        # Handle both NaN and 'NA' cases
+                        mask = self.uds3_df[primary_col].isnull() | (self.uds3_df[primary_col] == "NA")
+
+                        if uds4_var == 'diabetes':
+                            fill_mask = mask & (self.uds3_df[secondary_col] == 2)
+                            # Store the index positions where the fill happens with value 2
+                            filled_indices = self.uds3_df.index[fill_mask].tolist()
+
+                    # Filling up the missing values in primary_col with secondary_col values, as a new column
+                    # overlaying the primary one, the UDS3 data as read is never written to
+                    self.overlay_column(primary_col, mask, self.uds3_df.loc[mask, secondary_col])
+                    # Set uds3_var to primary_col as it will be used for the next steps
+                    uds3_var = primary_col
+
+                # If only the primary column exists in self.uds3_df
+                elif primary_col in self.uds3_df.columns:
+                    uds3_var = primary_col  # Use primary_col for further operations
+
+                # If only the secondary column exists in self.uds3_df
+                else:
+                    uds3_var = secondary_col  # Use secondary_col for further operations
+
+
+            # Case -1 : Response levels and no conformity
+            # This block handles mapping responses when there are response levels, but no conformity flag is set
+            if rule.has_levels and not rule.has_conformity and uds3_var in self.uds3_df.columns:
+                path = "case 1"
+
+                # Values containing "|" or "grep(" are not mapped
+                pairs = rule.exact_pairs
+
+                if pairs:
+                    # One lookup over the encoded UDS3 levels, the last matching UDS3 value wins
+                    winner = self.match_levels(uds3_var, [lambda levels, nulls, k=k: levels == k for k, _ in pairs])
+                    matched = winner >= 0
+
+                    # '<NA>' and 'null' written by all but the last pair are read back as missing by the next pair
+                    outputs = np.array([pd.NA if (v in ('<NA>', 'null') and i < len(pairs) - 1) else v
+                                        for i, (_, v) in enumerate(pairs)], dtype=object)
+                    mapped = np.where(matched, outputs[winner], None)
+
+                    # If the UDS4 variable exists in the UDS4 DataFrame
+                    if uds4_var in self.uds4_df.columns:
+                        # .isna() is not capturing the missing rows due to '<NA>', replacing the values of '<NA>' object type to pd.NA
+                        uds4_col = self.uds4_df[uds4_var].replace(['<NA>', 'null'], pd.NA).astype('string')
+
+                        # Map the UDS3 value to the UDS4 value only where the UDS4 value is missing
+                        fill = uds4_col.isna().to_numpy() & matched
+                        uds4_col[fill] = mapped[fill]
+                        self.uds4_df[uds4_var] = uds4_col
+
+                    elif len(pairs) == 1:
+                        # If the UDS4 variable doesn't exist, just map the UDS3 value to the UDS4 variable
+                        self.uds4_df.loc[pd.Series(matched, index=self.uds3_df.index), uds4_var] = pairs[0][1]
+
+                    else:
+                        self.uds4_df[uds4_var] = pd.Series(mapped, index=self.uds3_df.index, dtype=object).astype('string')
+
+            # Check if there are any structured mappings to process
+            # case -2: structured mappings i.e, Dates and calculated fields
+            elif rule.structured:
+                paths = []
+                for struct_rule in rule.structured:
+                    paths += [step for step in self.process_structured(struct_rule, uds3_var, uds4_var) if step not in paths]
+                path = "+".join(paths) or "structured"
+
+            # Case 3: No Response LEVELS, copy values directly
+            # This block handles the case where there are no response levels defined, and simply copies the values from uds3 to uds4
+            elif not rule.has_levels and rule.mapping_type!='Structured_Transformations':
+                path = "copy"
+
+                # Check if uds3_var exists in the self.uds3_df DataFrame
+                if uds3_var in self.uds3_df.columns:
+                    # If uds4_var exists in the self.uds4_df DataFrame, copy values only where uds4_var is NA
+                    if uds4_var in self.uds4_df.columns:
+                        mm = self.uds4_df[uds4_var].isna()  # Identify rows where uds4_var is missing (NA)
+                        self.uds4_df.loc[mm, uds4_var] = self.uds3_df[uds3_var]  # Copy corresponding values from self.uds3_df to self.uds4_df where uds4_var is NaN
+                    else:
+                        # If uds4_var doesn't exist in self.uds4_df, directly assign the entire column from self.uds3_df to self.uds4_df
+                        self.uds4_df[uds4_var] = self.uds3_df[uds3_var]
+
+            # Case 4: Conformity check
+            # This block handles cases where conformity is checked, i.e., ensuring UDS3 and UDS4 values match based on predefined mappings
+            elif rule.has_conformity:
+
+                path = "conformity"
+
+                # Check if UDS3 and UDS4 conformity values match
+                if rule.conformity_match:
+
+                    if rule.is_repeating:
+                        path = "repeating"
+                        process_repeating_variables(uds3_var, uds4_var, self.uds3_df, self.uds4_df)
+
+                    # If notes contain "MAX(", it indicates we need to handle special cases (e.g., max across multiple columns)
+                    elif rule.max_columns is not None:
+                        path = "max"
+                        # If all extracted columns exist in self.uds3_df, calculate the maximum value across them
+                        if all(col in self.uds3_df.columns for col in rule.max_columns):
+                            self.uds4_df[uds4_var] = self.uds3_df[rule.max_columns].max(axis=1)
+
+                    # If uds3_var exists in self.uds3_df, directly copy its values to self.uds4_df
+                    elif uds3_var in self.uds3_df.columns:
+                        if uds4_var in self.uds4_df:
+                            mask = self.uds4_df[uds4_var].isna()
+                            self.uds4_df.loc[mask, uds4_var] = self.uds3_df[uds3_var]
+
+                            if uds4_var=='diabetes':
+                                self.uds4_df[uds4_var] = self.uds4_df[uds4_var].replace({3: 1})
+                                self.uds4_df.loc[filled_indices, uds4_var] = 1
+
+                        else:
+
+                            self.uds4_df[uds4_var] = self.uds3_df[uds3_var]
+
+                else:
+                    # If conformity values don't match, map UDS3 values to UDS4 values based on response_levels
+                    if rule.is_repeating:
+                        path = "repeating"
+                        process_repeating_variables(uds3_var, uds4_var, self.uds3_df, self.uds4_df,response_map)
+
+                    # Handle conformity mappings, including both UDS4 conformity and UDS3 response levels
+                    elif uds3_var in self.uds3_df.columns:
+
+                        # Apply exact single-value mappings (e.g., 2 -> 1) and multi-value mappings in order, later ones win
+                        predicates, outputs = [], []
+                        float_col = pd.api.types.is_float_dtype(self.uds3_df[uds3_var])
+
+                        for uds3_value, uds4_value, values in rule.level_pairs:
+
+                            if values is None:
+                                # If UDS3 column has float type, compare as floats
+                                if float_col:
+                                    float_uds3_value = rule.float_values.get(uds3_value)
+                                    if float_uds3_value is None:
+                                        float_uds3_value = float(uds3_value)
+                                    predicates.append(lambda levels, nulls, f=float_uds3_value:
+                                                      pd.to_numeric(pd.Series(levels), errors='coerce').to_numpy() == f)
+
+                                    # special case for dysarth, postinst and impnomci columns
+                                elif uds3_value == 'None':
+                                    predicates.append(lambda levels, nulls: nulls)
+
+                                else:
+                                    # Otherwise, map based on string values
+                                    predicates.append(lambda levels, nulls, k=uds3_value: levels == k)
+
+                            # Skip columns with names ending in "sec" or "ter" (those are not mapped)
+                            elif not (uds3_var.endswith("sec") or uds3_var.endswith("ter")):
+                                # Handle cases with logical OR conditions (e.g., "1 | 3 | 4 | 5 | 50 | 99" -> None)
+                                predicates.append(lambda levels, nulls, v=values: pd.Series(levels).isin(v).to_numpy())
+
+                            else:
+                                continue
+                            outputs.append(uds4_value)
+
+                        if predicates:
+                            winner = self.match_levels(uds3_var, predicates)
+                            matched = winner >= 0
+                            outputs = np.array(outputs, dtype=object)
+
+                            if uds4_var in self.uds4_df.columns:
+                                if matched.any():
+                                    self.uds4_df.loc[pd.Series(matched, index=self.uds3_df.index), uds4_var] = outputs[winner[matched]]
+                            else:
+                                uds4_col = np.full(len(matched), np.nan, dtype=object)
+                                uds4_col[matched] = outputs[winner[matched]]
+                                self.uds4_df[uds4_var] = pd.Series(uds4_col, index=self.uds3_df.index)
+
+                        # Handling grep-based text searches (e.g., grep("guatemalan", HISPORX))
+                        if rule.grep_rules:
+                            path = "conformity+grep"
+                            # One match over the lowercased levels, a row takes the value of the last grep rule it matches
+                            hits = self.grep_levels(uds3_var, rule.grep_terms, rule.grep_pattern)
+                            predicates = [lambda levels, nulls, t=search_terms: np.logical_or.reduce([hits[term] for term in t])
+                                          for search_terms, _ in rule.grep_rules]
+                            winner = self.match_levels(uds3_var, predicates)
+                            matched = winner >= 0
+                            outputs = np.array([uds4_value for _, uds4_value in rule.grep_rules], dtype=object)
+
+                            if matched.any():
+                                self.uds4_df.loc[pd.Series(matched, index=self.uds3_df.index), uds4_var] = outputs[winner[matched]]
+                            elif uds4_var not in self.uds4_df.columns:
+                                self.uds4_df.loc[pd.Series(matched, index=self.uds3_df.index), uds4_var] = outputs[0]
+
+                        # Ensure all values from self.uds3_df are preserved in self.uds4_df where they are not mapped
+                        if rule.preserve_unmapped and uds3_var!='cancer':
+                            self.uds4_df.loc[~self.uds4_df[uds4_var].isin(response_map.values()), uds4_var] = self.string_view(uds3_var)
+
+            if self.profile is not None:
+                self.profile.stop(rule, position, path, self.uds4_df)
+
+    def evaluate_math(self, struct_rule, rows):
+        # The compiled expression evaluated once over the selected rows, missing values count as 0
+        columns = {col: self.uds3_df[col].to_numpy(dtype="float64", na_value=0)[rows] for col in struct_rule.math_columns}
+        return evaluate_expression(struct_rule.math_tree, columns).astype(int)
+
+    def process_structured(self, struct_rule, uds3_var, uds4_var):
+        # Returns the code paths taken, for --profile
+        paths = ["structured IF"] if struct_rule.or_conditions or struct_rule.and_conditions else []
+
+        # Handling conditional IF-ELSE structured mappings
+        # Process OR conditions first, AND conditions second (these will overwrite OR conditions where applicable)
+        for cond in struct_rule.or_conditions + struct_rule.and_conditions:
+            # Apply the transformation by updating the UDS4 dataframe
+            self.uds4_df.loc[self.condition_mask(cond.expression), uds4_var] = cond.uds4_value
+
+        # Handling multiple UDS3 variables with OR / AND conditions
+        if struct_rule.separator:
+            paths.append("separator")
+            uds4_value = struct_rule.separator_value
+
+            # Ensure all UDS3 columns exist in the DataFrame
+            if all(col in self.uds3_df.columns for col in struct_rule.separator_columns):
+
+                # Exact matches combined by OR or AND depending on the separator
+                mask = self.condition_mask(struct_rule.separator_expression)
+
+                # Only update where conditions match
+                if uds4_var in self.uds4_df.columns:
+                    missing_mask = self.uds4_df[uds4_var].isna().to_numpy()  # Handle missing (NA) values in self.uds4_df
+                    self.uds4_df.loc[missing_mask & mask, uds4_var] = pd.to_numeric(uds4_value, errors='coerce')
+                else:
+                    self.uds4_df.loc[mask, uds4_var] = uds4_value
+
+        # Handling structured mathematical mappings (e.g., "PDAGE + BIRTHYR" → "PDYR - BIRTHYR")
+        elif struct_rule.math_expression is not None:
+            paths.append("math")
+            struct_col = struct_rule.math_struct_column
+
+            # Ensure struct_col exists in self.uds3_df and filter out rows where it's non-zero
+            if struct_col in self.uds3_df.columns and struct_rule.math_tree is not None:
+                non_zero_mask = (self.uds3_df[struct_col] != 0).to_numpy(dtype=bool, na_value=False)  # Mask for non-zero rows
+
+                # Proceed only if there's at least one non-zero value; a frame that is part of an export takes the
+                # decision of the whole export, so its rows come out as they do in a single run
+                guard = self.guards.get((uds4_var, struct_rule.math_expression))
+                if non_zero_mask.any() if guard is None else all(guard):
+                    # Ensure all columns exist before computing
+                    if all(col in self.uds3_df.columns for col in struct_rule.math_columns):
+                        try:
+                            uds3_computed = self.evaluate_math(struct_rule, non_zero_mask)
+                        except Exception as e:
+                            if self.verbose:
+                                print(f"Error evaluating UDS3 expression {struct_rule.math_expression}: {e}")
+                            uds3_computed = None
+
+                        # Assign computed values to self.uds4_df
+                        if uds3_computed is not None:
+                            lev_mask = (self.uds3_df[uds3_var] != 9999).to_numpy(dtype=bool, na_value=False)
+                            self.uds4_df.loc[lev_mask & non_zero_mask, uds4_var] = uds3_computed[lev_mask[non_zero_mask]]
+
+                            # Replace rows where uds3_var is 9999 with 999
+                            replace_mask = self.uds3_df[uds3_var] == 9999
+                            self.uds4_df.loc[replace_mask, uds4_var] = 999
+
+        # This block handles the "paste()" function which is used to combine multiple columns into a single string
+        if struct_rule.paste_columns:
+            paths.append("paste")
+            columns = struct_rule.paste_columns
+
+            # Checks if all the extracted column names exist in the self.uds3_df dataframe
+            if all(comp in self.uds3_df.columns for comp in columns):
+                # If all columns exist, creates a new column in self.uds4_df by concatenating values from the
+                # first three columns in the list, separated by "/" characters
+                self.uds4_df[uds4_var] = (
+                    self.uds3_df[columns[0]].astype(str) + "/" +
+                    self.uds3_df[columns[1]].astype(str) + "/" +
+                    self.uds3_df[columns[2]].astype(str)
+                )
+
+            # Otherwise fall back to the form date column matching the suffix (e.g. a2_form_dt or d2_form_dt)
+            elif struct_rule.paste_fallback:
+                self.uds4_df[uds4_var] = self.uds3_df[struct_rule.paste_fallback]
+
+        return paths
+
+    # Main Function to process the compiled rule plan and apply crosswalk logic to it
+    def process_all_jsons(self, plan, verbose=True):
+
+        # Iterate through each JSON file in the compiled plan
+        for json_file, mapping_types in plan.forms.items():
+            if verbose:
+                print(f"Processing {json_file}...")  # Log the current JSON file being processed
+
+            # Loop through each mapping type and process it
+            for mapping_type in MAPPING_TYPES:
+                if verbose:
+                    print(f"  Processing {mapping_type} mappings...")  # Log the current mapping type being processed
+                self.process_mappings(mapping_types[mapping_type])  # Call the function to process mappings for the given type
+
+            if verbose:
+                print(f"Completed processing {json_file}")  # Log that processing of the current JSON file is complete
+
+
+# Row-independent structured math rules for exports migrated in parts
+def math_guards(uds3_df, plan, guards=None):
+    """
+    Record what decides whether each structured math rule runs: a non-zero struct column in some row, and the
+    expression evaluating without error over the frame's columns.
+
+    A single run decides both on the whole export, so a part of it (a chunk, a partition, the changed rows) passes
+    the guards of the whole export to CrosswalkRun instead of deciding them on its own rows.
+
+    Args:
+        uds3_df (pd.DataFrame): UDS3 data formatted by format_uds3, the whole export or one part of it.
+        plan (RulePlan): The compiled crosswalk rules.
+        guards (dict): Guards of the parts already scanned, combined with this one.
+
+    Returns:
+        dict: (UDS4 variable, math expression) -> (any non-zero row, evaluated without error).
+    """
+    guards = dict(guards or {})
+    run = CrosswalkRun(uds3_df)
+    for rule in plan.rules():
+        for struct_rule in rule.structured:
+            columns = [struct_rule.math_struct_column] + struct_rule.math_columns
+            if (struct_rule.separator or struct_rule.math_expression is None or struct_rule.math_tree is None
+                    or not all(col in uds3_df.columns for col in columns)):
+                continue
+            non_zero_mask = (uds3_df[struct_rule.math_struct_column] != 0).to_numpy(dtype=bool, na_value=False)
+            try:
+                run.evaluate_math(struct_rule, non_zero_mask)
+                evaluated = True
+            except Exception:
+                evaluated = False
+            key = (rule.uds4_var, struct_rule.math_expression)
+            non_zero, ok = guards.get(key, (False, True))
+            guards[key] = (non_zero or bool(non_zero_mask.any()), ok and evaluated)
+    return guards
+
+
+def guard_columns(plan):
+    # Lowercase UDS3 columns math_guards reads
+    return {col for rule in plan.rules() for struct_rule in rule.structured if struct_rule.math_expression is not None
+            for col in [struct_rule.math_struct_column] + struct_rule.math_columns}
+
+
+# Function to replace 'NaN' or '<NA>' values in a DataFrame with 'NA'
+# (float_columns, when given, are the columns whose whole numbers are written as floats, decided on the whole
+# export by ExportRendering for a frame that is only part of it)
+def replace_nan_and_na(df, float_columns=None):
+    columns = {}
+    for col, values in df.items():
+        # Column-wise masks instead of a per-cell lambda, '<NA>' text can only sit in object or string columns
+        mask = values.isna().to_numpy()
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            mask |= (values == "<NA>").to_numpy(dtype=bool, na_value=False)
+        if float_columns is not None and col in float_columns and values.dtype != "float64":
+            values = pd.to_numeric(values, errors="coerce").astype("float64")
+        # Only columns holding missing values are converted to object
+        if mask.any():
+            # Nullable numbers with missing values come out as floats (5 -> 5.0), as the element-wise map gave them
+            if (float_columns is None and isinstance(values.dtype, pd.api.extensions.ExtensionDtype)
+                    and values.dtype.kind in "iuf"):
+                values = values.astype("float64")
+            values = values.astype(object).mask(mask, "NA")
+        columns[col] = values
+
+    return pd.DataFrame(columns, index=df.index, columns=df.columns)
+
+
+class ExportRendering:
+    """
+    How the numbers of each UDS4 column are written when an export is migrated in parts (chunks, partitions,
+    changed rows), decided over every part as a single run over the whole export decides it.
+
+    A single run writes the whole numbers of a numeric column as floats (5.0) when the column is float or
+    misses a value in any row, and keeps each value of a column holding text as it is.  A part only sees its
+    own rows, so it can type a column differently (Int64 without missing values, int64 where only some rows of
+    the export are filled, object where none are); add() records what each part holds.
+
+    Args:
+        text, numbers, floats (iterable): Columns already known to hold text, a numeric dtype or float values.
+    """
+
+    def __init__(self, text=(), numbers=(), floats=()):
+        self.text, self.numbers, self.floats = set(text), set(numbers), set(floats)
+        self.missing = set()
+        # UDS4 column -> number of parts holding it, a part without the column writes it as missing
+        self.parts = {}
+        self.count = 0
+
+    def add(self, uds4_df):
+        self.count += 1
+        for col, values in uds4_df.items():
+            self.parts[col] = self.parts.get(col, 0) + 1
+            if values.dtype == object:
+                kind = pd.api.types.infer_dtype(values, skipna=True)
+                if kind in ("string", "mixed", "mixed-integer", "bytes"):
+                    self.text.add(col)
+                elif kind in ("floating", "mixed-integer-float"):
+                    self.floats.add(col)
+            elif isinstance(values.dtype, pd.StringDtype):
+                self.text.add(col)
+            elif values.dtype.kind in "iuf":
+                self.numbers.add(col)
+                if values.dtype.kind == "f":
+                    self.floats.add(col)
+            if values.hasnans:
+                self.missing.add(col)
+
+    @property
+    def columns(self):
+        # Every column some part produced, in the order first seen
+        return list(self.parts)
+
+    def float_columns(self):
+        # Numeric columns without text that hold a float or miss a value somewhere in the export
+        absent = {col for col, parts in self.parts.items() if parts < self.count}
+        return (self.numbers - self.text) & (self.floats | self.missing | absent)
+
+# Cross-checking the data in the uds4_df DataFrame and handling missing values based on a3_stop_dict
+def data_crosscheck(uds4_df):
+    """
+    Apply the A3 etpr stop rules and the missing value recodes to the UDS4 data.
+
+    The missingness of every etpr column present is taken as one block mask, and each family
+    member's meval/age columns are blanked where their etpr is missing.
+
+    Args:
+        uds4_df (pd.DataFrame or UDS4Columns): The UDS4 data, corrected in place.
+    """
+    # One missing-value mask per etpr column (mom, dad, kid1..15, sib1..20) present in the data
+    etpr_columns = [col for col in uds4_df.columns if col in a3_stop_dict]
+    if etpr_columns:
+        stopped = np.column_stack([uds4_df[col].isna().to_numpy() for col in etpr_columns])
+
+        # For rows where the etpr value is missing, the member's a3_stop_dict columns are set missing too
+        # (one column at a time through .loc, which types them exactly as the multi-column .loc did)
+        for j, uds4_var in enumerate(etpr_columns):
+            for stop_var in a3_stop_dict[uds4_var]:
+                uds4_df.loc[stopped[:, j], stop_var] = pd.NA
+
+    for uds4_var in [col for col in uds4_df.columns if col in recode_rules]:
+        recode_map = recode_rules[uds4_var]
+        uds4_df[uds4_var] = uds4_df[uds4_var].replace(recode_map)
+
+
+def load_data_order(file_path):
+    # Load UDS4 data elements from the provided file and convert them to lowercase
+    with open(file_path, 'r') as file:
+        return [line.strip().lower() for line in file.readlines()]
+
+
+def process_and_save_data(file_path, final_df, output_file, valid_columns=None, writer=None, output_format="csv",
+                          float_columns=None):
+    """
+    Project the UDS4 data onto the UDS4 column order, normalize missing values to 'NA' and write it.
+
+    Args:
+        file_path (str): The UDS4 data order file.
+        final_df (pd.DataFrame): The migrated UDS4 data.
+        output_file (str): Output path, used when no writer is given.
+        valid_columns (list): Output columns in order, loaded from file_path when not given.
+        writer (OutputWriter): An open writer, chunks are appended to it.
+        output_format (str): 'csv', 'parquet' or 'feather', used when no writer is given.
+        float_columns (set): Columns whose whole numbers are written as floats when final_df is part of an
+            export, see ExportRendering.  Decided on final_df when not given.
+    """
+    # Filter valid columns from final_df based on the loaded UDS4 data elements
+    if valid_columns is None:
+        valid_columns = [col for col in load_data_order(file_path) if col in final_df.columns]
+    
+    # Reorder the DataFrame to include only the valid columns before normalizing, columns a chunk did not produce are written as NA
+    final_filtered_df = replace_nan_and_na(final_df.reindex(columns=valid_columns), float_columns)
+    
+    # CSV is saved with UTF-8-SIG encoding to avoid character corruption
+    if writer is None:
+        with open_writer(output_file, output_format) as writer:
+            writer.write(final_filtered_df)
+    else:
+        writer.write(final_filtered_df)
+
+
+# Projection and dtypes for reading the UDS3 CSV, from the compiled plan
+def uds3_read_options(file_path, plan, extra_columns=(), verbose=True, header=None):
+    """
+    Plan the UDS3 CSV read so only columns some rule references are parsed, typed with the dictionary schema.
+
+    Referenced columns missing from the CSV are reported before any data is read.
+
+    Args:
+        file_path (str): The UDS3 CSV.
+        plan (RulePlan): The compiled crosswalk rules.
+        extra_columns (iterable): Lowercase columns to read as well, e.g. the incremental row keys.
+        verbose (bool): Report the projection and the missing referenced columns.
+        header (list): The column names, read from the CSV when not given (e.g. for a Parquet export).
+
+    Returns:
+        dict: read_csv keyword arguments (usecols and dtype), header names keep the case of the CSV.
+    """
+    if header is None:
+        header = pd.read_csv(file_path, nrows=0).columns
+    usecols = [col for col in header if col.lower() in plan.columns or col.lower() in extra_columns]
+    if verbose:
+        print(f"Reading {len(usecols)} of {len(header)} UDS3 columns, the rest are not referenced by any rule")
+
+    missing = sorted(plan.columns - {col.lower() for col in header})
+    if missing and verbose:
+        print(f"{len(missing)} UDS3 columns referenced by the rules are not in the data: {', '.join(missing)}")
+
+    return {"usecols": usecols,
+            "dtype": {col: plan.schema[col.lower()] for col in usecols if col.lower() in plan.schema}}
+
+
+def read_csv_typed(file_path, read_options, chunksize=None):
+    # pandas parses nullable Int64 columns several times slower than floats, so they are parsed as float64 and cast after;
+    # a fractional value still raises (TypeError) as the Int64 parser would
+    int_columns = [col for col, dtype in read_options.get("dtype", {}).items() if dtype == "Int64"]
+    options = dict(read_options, dtype={**read_options.get("dtype", {}), **dict.fromkeys(int_columns, "float64")})
+
+    def cast(df):
+        if not int_columns:
+            return df
+        columns = dict(df.items())
+        for col in int_columns:
+            values = columns[col].to_numpy()
+            missing = np.isnan(values)
+            present = values[~missing]
+            if (present % 1 != 0).any() or (np.abs(present) >= 2 ** 63).any():
+                raise TypeError(f"column {col} holds non-integer values")
+            columns[col] = pd.arrays.IntegerArray(np.where(missing, 0, values).astype(np.int64), missing)
+        return pd.DataFrame(columns, index=df.index)
+
+    if chunksize:
+        return (cast(chunk) for chunk in pd.read_csv(file_path, chunksize=chunksize, **options))
+    return cast(pd.read_csv(file_path, **options))
+
+
+# Text pandas parses as a number and as an integer, DuckDB's casts alone also accept e.g. 1_000 or 0x1A
+NUMBER_PATTERN = r'\s*[+-]?((\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|[iI][nN][fF]([iI][nN][iI][tT][yY])?)\s*'
+INTEGER_PATTERN = r'\s*[+-]?\d+\s*'
+# pandas' CSV parser types the columns per block of rows, the largest power of two under this many cells
+PARSER_BLOCK_CELLS = 2 ** 20
+
+
+def parser_block_rows(width):
+    # Rows per block pandas' CSV parser types on its own, for a CSV of `width` columns
+    block_rows = 1
+    while block_rows * 2 < PARSER_BLOCK_CELLS // width:
+        block_rows *= 2
+    return block_rows
+
+
+def parse_blocks(values, block_rows):
+    """
+    Type the blocks of a column mixing text and numbers as pandas' CSV parser does: blocks whose cells are
+    all numbers hold Python ints (integers, no missing cells) or floats, the other blocks keep their text.
+
+    Args:
+        values (np.ndarray): Object array of the column's text, NaN for missing, starting at a block boundary.
+        block_rows (int): Rows per parser block, see parser_block_rows.
+    """
+    text = pd.Series(values, dtype=object)
+    present = text.notna().to_numpy()
+    numbers = text.str.fullmatch(NUMBER_PATTERN).fillna(False).to_numpy(dtype=bool)
+    integers = text.str.fullmatch(INTEGER_PATTERN).fillna(False).to_numpy(dtype=bool)
+    for start in range(0, len(values), block_rows):
+        block = slice(start, start + block_rows)
+        if not present[block].any() or (numbers[block] != present[block]).any():
+            continue
+        if (integers[block] == present[block]).all():
+            # Integer cells are parsed as integers, then as floats when the block misses a cell (so -0 is 0.0)
+            parsed = [int(value) if isinstance(value, str) else value for value in values[block]]
+            values[block] = parsed if present[block].all() else [float(value) for value in parsed]
+        else:
+            values[block] = [float(value) for value in values[block]]
+    return values
+
+
+def read_uds3_csv(file_path, read_options, verbose=True):
+    """
+    Read the UDS3 CSV with the options from uds3_read_options, reporting a fallback to inferred types when verbose.
+
+    Returns:
+        pd.DataFrame: The UDS3 data, read with inferred types when it does not fit the schema.
+    """
+    try:
+        return read_csv_typed(file_path, read_options)
+    except (ValueError, TypeError) as e:
+        if verbose:
+            print(f"UDS3 data does not match the dictionary dtypes ({e}), reading with inferred types")
+        # File objects (e.g. a service payload) are rewound for the second read
+        if hasattr(file_path, "seek"):
+            file_path.seek(0)
+        return pd.read_csv(file_path, usecols=read_options["usecols"])
+
+
+# Float-like pdx codes converted to integers and padded with zeros by format_uds3
+PDX_COLUMNS = (['momprdx', 'dadprdx'] +
+    [f"sib{i}pdx" for i in range(1, 21)] + [f"kid{i}pdx" for i in range(1, 16)])
+
+
+def pad_codes(values):
+    # Vectorized f"{float(x):03.0f}" for the pdx codes, missing codes are written as 'NA'
+    numbers = pd.to_numeric(values).astype("float64")
+    codes = np.round(numbers.fillna(0).to_numpy()).astype(np.int64).astype(str)
+    return pd.Series(codes, index=values.index, dtype=object).str.zfill(3).mask(numbers.isna(), "NA")
+
+
+# Prepare the UDS3 data read from the CSV for the crosswalk
+def format_uds3(nacc, int_columns=None, verbose=True):
+    """
+    Zero-pad the pdx codes, lowercase the column names and convert integer-valued float columns to Int64.
+
+    Args:
+        nacc (pd.DataFrame): UDS3 data as read from the CSV.
+        int_columns (set): Lowercase numeric columns to hold as Int64, decided on the whole export
+            (chunked and multiprocess modes).  When None each column is checked here.
+        verbose (bool): Report the float columns kept as floats when checking them here.
+
+    Returns:
+        pd.DataFrame: The UDS3 data frame used by the rules.
+    """
+    # A shallow copy shares the column values with the caller's frame, which is left as read: every change below
+    # (and the merge overlays of the rules) replaces a whole column, and lowercasing the names copies no data
+    uds3_df = nacc.copy(deep=False)
+
+    # Filter only existing columns and apply formatting
+    for col in [col for col in PDX_COLUMNS if col in uds3_df.columns]:
+        uds3_df[col] = pad_codes(uds3_df[col])
+    uds3_df.columns = uds3_df.columns.str.lower()
+
+    # Data Type conversion to match the values, column by column without per-value calls
+    for col in uds3_df.select_dtypes(include=['float']).columns:
+        # Replace infinities with NaN
+        values = uds3_df[col].to_numpy(dtype="float64", na_value=np.nan)
+        values = np.where(np.isinf(values), np.nan, values)
+
+        # Check if all remaining values are safe for integer conversion
+        if int_columns is not None:
+            holds_integers = col in int_columns
+        else:
+            present = values[~np.isnan(values)]
+            holds_integers = bool((present == np.floor(present)).all())
+            if not holds_integers and verbose:
+                print(f"Skipping column '{col}' due to non-integer values.")
+
+        # Convert to nullable integer
+        uds3_df[col] = pd.Series(values, index=uds3_df.index).astype("Int64") if holds_integers else values
+
+    # Integer columns are nullable only when the data has missing values, as an inferred read gives them
+    for col in uds3_df.select_dtypes(include=['integer']).columns:
+        nullable = col in int_columns if int_columns is not None else uds3_df[col].hasnans
+        dtype = "Int64" if nullable else "int64"
+        if uds3_df[col].dtype != dtype:
+            uds3_df[col] = uds3_df[col].astype(dtype)
+
+    return uds3_df
+
+
+# Rules the alternative backends (--engine) run column-wise, their results are precomputed UDS4 columns
+
+# Spellings of "NA" a Missing condition accepts besides missing cells, the UDS3 text upper-cased must be "NA"
+NA_SPELLINGS = ["NA", "Na", "nA", "na"]
+
+
+def written_columns(rule):
+    # UDS4 columns a rule can write, kid###/sib### rules write one per family member
+    if not rule.is_repeating:
+        return [rule.uds4_var]
+    word = re.search(r'(kid|sib)', rule.uds3_var).group(1)
+    base_var = rule.uds4_var.replace(word, '').replace('#', '')
+    return [f"{word}{i}{base_var}" for i in range(1, (15 if word == 'kid' else 20) + 1)]
+
+
+def rule_kind(rule):
+    """
+    How a backend can execute a compiled rule column-wise, None when it has to run in pandas.
+
+    Mirrors the branches of CrosswalkRun.process_mappings: 'levels' for a non-matching conformity with
+    response levels, 'separator' and 'paste' for a single structured mapping doing only that.
+    """
+    if rule.merge_columns or rule.is_repeating or (rule.has_levels and not rule.has_conformity):
+        return None
+
+    if rule.structured:
+        if len(rule.structured) != 1:
+            return None
+        struct_rule = rule.structured[0]
+        if struct_rule.or_conditions or struct_rule.and_conditions or struct_rule.math_expression is not None:
+            return None
+        if struct_rule.separator and not struct_rule.paste_columns:
+            return "separator"
+        if struct_rule.paste_columns and not struct_rule.separator:
+            return "paste"
+        return None
+
+    if (rule.has_conformity and not rule.conformity_match and rule.max_columns is None
+            and (rule.has_levels or rule.mapping_type == 'Structured_Transformations')
+            and any(values is None or not (rule.uds3_var.endswith("sec") or rule.uds3_var.endswith("ter"))
+                    for _, _, values in rule.level_pairs)):
+        return "levels"
+    return None
+
+
+def rule_inputs(rule, kind):
+    # UDS3 columns a column-wise rule reads
+    if kind == "levels":
+        return [rule.uds3_var]
+    struct_rule = rule.structured[0]
+    return struct_rule.separator_columns if kind == "separator" else struct_rule.paste_columns[:3]
+
+
+def column_rules(plan):
+    """
+    The rules of a plan the alternative backends (--engine) execute column-wise, with their rule_kind.
+
+    A rule qualifies when it is the only writer of its UDS4 column (so no other rule reads or fills it
+    in between) and reads no UDS3 column that a pipe-merge rule overlays while the rules run.
+    """
+    rules = list(plan.rules())
+    writers = Counter(col for rule in rules for col in written_columns(rule))
+    overlaid = {rule.merge_columns[0] for rule in rules if rule.merge_columns}
+
+    selected = []
+    for rule in rules:
+        kind = rule_kind(rule)
+        if kind and writers[rule.uds4_var] == 1 and not overlaid & set(rule_inputs(rule, kind)):
+            selected.append((rule, kind))
+    return selected
+
+
+def text_column(uds3_df, col):
+    """
+    Whether a backend can reproduce the pandas text (astype(str)) of a UDS3 column.
+
+    Integer columns render as digits with '<NA>' for missing values and text columns as themselves
+    with 'nan'; float columns are left to pandas, as the backends and Python format floats differently.
+    """
+    values = uds3_df[col]
+    if pd.api.types.is_integer_dtype(values):
+        return True
+    return values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ("string", "empty")
+
+
+class CrosswalkEngine:
+    """
+    The UDS3 to UDS4 crosswalk over a compiled rule plan, safe to import and use from other code.
+
+    Every transform works on its own CrosswalkRun, so one engine migrates any number of frames
+    (whole exports, chunks or partitions) and engines over different plans can be used side by side.
+
+    Example:
+        engine = CrosswalkEngine.from_folder("./Crosswalk")
+        uds4_df = engine.transform(pd.read_csv("uds3_data.csv"))
+
+    Args:
+        plan (RulePlan): The compiled crosswalk rules, see UDS_Rule_Compiler.compile_rules.
+        profile (RuleProfile): Collects per-rule timings over every transform when given.
+        verbose (bool): Log the progress through each JSON file.
+        memory (MemoryBudget): Checks the process memory after every stage when given.
+    """
+
+    def __init__(self, plan, profile=None, verbose=False, memory=None):
+        self.plan = plan
+        self.profile = profile
+        self.verbose = verbose
+        self.memory = memory
+
+    def check_memory(self, stage):
+        # Memory at the end of a stage against --max-memory, nothing to do without a budget
+        if self.memory is not None:
+            self.memory.check(stage)
+
+    @classmethod
+    def from_folder(cls, json_folder_path, cache_dir=None, **kwargs):
+        # Compile (or load the cached plan of) a folder of JSON crosswalk files
+        return cls(compile_rules(json_folder_path, cache_dir), **kwargs)
+
+    def read_options(self, file_path, extra_columns=(), verbose=True):
+        return uds3_read_options(file_path, self.plan, extra_columns, verbose)
+
+    def count_rows(self, file_path):
+        # Rows of the UDS3 export, for the --max-memory estimate
+        return count_csv_rows(file_path)
+
+    def precompute(self, uds3_df):
+        """
+        UDS4 columns computed before the rules run, by UDS4 variable.  The pandas engine computes none,
+        alternative backends (e.g. UDS_Polars_Backend.py) return the columns of the rules they execute.
+        """
+        return {}
+
+    def transform(self, nacc, int_columns=None, verbose=None, precomputed=None, guards=None):
+        """
+        Apply the compiled crosswalk to one frame of UDS3 data, the frame itself is left unchanged.
+
+        Args:
+            nacc (pd.DataFrame): UDS3 data as read from the CSV, the whole export or a single chunk.
+            int_columns (set): Passed on to format_uds3.
+            verbose (bool): Overrides the engine's verbose setting for this frame, when False nothing is printed.
+            precomputed (dict): UDS4 columns a backend already computed for these rows, see precompute.
+            guards (dict): Structured math guards of the whole export when the frame is part of it, see math_guards.
+
+        Returns:
+            pd.DataFrame: The UDS4 data, missing values are normalized when it is saved (see process_and_save_data).
+        """
+        verbose = self.verbose if verbose is None else verbose
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            run = CrosswalkRun(format_uds3(nacc, int_columns, verbose), self.profile, guards, verbose)
+            self.check_memory("format")
+
+            # The rules write to a column buffer, assembled into the UDS4 data frame once every rule has run
+            start = time.perf_counter()
+            run.precomputed = self.precompute(run.uds3_df) if precomputed is None else precomputed
+            run.process_all_jsons(self.plan, verbose)
+
+            # Data Validation - Correcting the UDS4 data
+            data_crosscheck(run.uds4_df)
+            self.check_memory("rules")
+            uds4_df = run.uds4_df.build()
+            self.check_memory("build")
+
+            if verbose:
+                peak = peak_memory_mb()
+                print(f"Built the UDS4 frame with {uds4_df.shape[1]} columns in {time.perf_counter() - start:.2f}s, "
+                      f"{uds4_df.memory_usage(deep=False).sum() / 1024 ** 2:.1f} MB"
+                      + (f", peak process memory {peak:.1f} MB" if peak is not None else ""))
+
+        return uds4_df
+
+
+# Execution backends selectable with --engine
+ENGINES = ["pandas", "polars", "duckdb"]
+
+
+def engine_class(name):
+    # The alternative backends and their libraries are only imported when selected
+    if name == "polars":
+        from UDS_Polars_Backend import PolarsCrosswalkEngine
+        return PolarsCrosswalkEngine
+    if name == "duckdb":
+        from UDS_DuckDB_Backend import DuckDBCrosswalkEngine
+        return DuckDBCrosswalkEngine
+    return CrosswalkEngine
+
+
+def non_integer_columns(df):
+    # Float columns holding finite values with a fractional part, these are not converted to Int64
+    non_integer = set()
+    for col in df.select_dtypes(include=['float']).columns:
+        values = df[col].to_numpy()
+        values = values[np.isfinite(values)]
+        if (values != np.floor(values)).any():
+            non_integer.add(col)
+    return non_integer
+
+
+def export_int_columns(nacc, verbose=True):
+    # Lowercase numeric columns held as Int64 when the whole export is migrated at once, for migrating a subset of rows
+    non_integer = non_integer_columns(nacc)
+    for col in non_integer if verbose else []:
+        print(f"Skipping column '{col.lower()}' due to non-integer values.")
+    int_columns = {col.lower() for col in nacc.select_dtypes(include=['float']).columns if col not in non_integer}
+    int_columns |= {col.lower() for col in nacc.select_dtypes(include=['integer']).columns if nacc[col].hasnans}
+    return int_columns
+
+
+def count_csv_rows(file_path):
+    # Data rows of a CSV counted from its line breaks (quoted multi-line text counts extra), for the memory estimate
+    rows, last = 0, b'\n'
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            rows += block.count(b'\n')
+            last = block[-1:]
+    return max(rows + (last != b'\n') - 1, 0)
+
+
+# Pre-scan used by the chunked mode so every chunk is typed as a single full read would type it
+def scan_csv_types(file_path, chunksize, read_options):
+    """
+    Read the UDS3 CSV once, chunk by chunk, and record how each column is typed across all chunks.
+
+    Args:
+        file_path (str): The UDS3 CSV.
+        chunksize (int): Rows per chunk.
+        read_options (dict): Columns and schema dtypes, see uds3_read_options.
+
+    Returns:
+        tuple: (read_dtypes, int_columns, mixed, rows) - dtypes to read every chunk with, the lowercase
+            numeric columns to hold as Int64, the columns holding text that are typed per parser block
+            (see read_chunks), and the number of data rows.
+    """
+    kinds, non_integer, missing, rows = {}, set(), set(), 0
+
+    for chunk in read_csv_typed(file_path, read_options, chunksize):
+        rows += len(chunk)
+        non_integer |= non_integer_columns(chunk)
+        missing |= {col for col in chunk.select_dtypes(include=['integer']).columns if chunk[col].hasnans}
+        for col, dtype in chunk.dtypes.items():
+            kinds.setdefault(col, set()).add(dtype.kind)
+
+    read_dtypes, int_columns, mixed = dict(read_options.get("dtype", {})), set(), set()
+    for col, col_kinds in kinds.items():
+        # Integer chunks next to float chunks are read as float
+        if col_kinds <= {'i', 'f'}:
+            if len(col_kinds) > 1:
+                read_dtypes[col] = 'float64'
+            if 'f' in col_kinds:
+                if col in non_integer:
+                    print(f"Skipping column '{col.lower()}' due to non-integer values.")
+                else:
+                    int_columns.add(col.lower())
+            elif col in missing:
+                int_columns.add(col.lower())
+        # Text is read as text, a full read types the column per parser block, which need not line up with the chunks
+        elif 'O' in col_kinds and col not in read_dtypes:
+            read_dtypes[col] = str
+            mixed.add(col)
+        elif len(col_kinds) > 1:
+            read_dtypes[col] = str
+
+    return read_dtypes, int_columns, mixed, rows
+
+
+def read_chunks(file_path, read_options, chunksize, mixed=(), block_rows=None):
+    """
+    Read the UDS3 CSV in chunks of `chunksize` rows, typed as a single read of the whole file types them.
+
+    The `mixed` columns are read as text and typed per parser block (see parse_blocks), so the file is then
+    read in whole blocks and cut into chunks after.
+    """
+    if not mixed:
+        yield from read_csv_typed(file_path, read_options, chunksize)
+        return
+
+    pending = None
+    for blocks in read_csv_typed(file_path, read_options, -(-chunksize // block_rows) * block_rows):
+        for col in mixed:
+            blocks[col] = parse_blocks(blocks[col].to_numpy(dtype=object, copy=True), block_rows)
+        pending = blocks if pending is None else pd.concat([pending, blocks])
+        while len(pending) >= chunksize:
+            yield pending.iloc[:chunksize]
+            pending = pending.iloc[chunksize:]
+    if pending is not None and len(pending):
+        yield pending
+
+
+def save_parts(parts, engine, data_order_path, output_file, output_format="csv"):
+    """
+    Write the UDS4 data of an export migrated in parts (chunks, batches) as a single run over the whole export writes it.
+
+    The parts are spilled to a temporary folder next to the output while ExportRendering records what their
+    columns hold.  The output columns (every column some part produced, in the UDS4 order) and the rendering of
+    whole numbers are then decided for the whole export and the parts are written in order.
+
+    Args:
+        parts (iterable): The migrated UDS4 frames, in row order.
+        engine (CrosswalkEngine): Checks the memory budget after every part written.
+        data_order_path (str): The UDS4 data order file.
+        output_file (str): The output path.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+    """
+    rendering = ExportRendering()
+    with tempfile.TemporaryDirectory(prefix=".uds4_parts_", dir=os.path.dirname(os.path.abspath(output_file))) as folder:
+        paths = []
+        for uds4_df in parts:
+            rendering.add(uds4_df)
+            paths.append(os.path.join(folder, f"part_{len(paths)}.pkl"))
+            uds4_df.to_pickle(paths[-1])
+
+        valid_columns = [col for col in load_data_order(data_order_path) if col in rendering.parts]
+        float_columns = rendering.float_columns()
+        with open_writer(output_file, output_format) as writer:
+            for path in paths:
+                process_and_save_data(data_order_path, pd.read_pickle(path), output_file, valid_columns, writer,
+                                      float_columns=float_columns)
+                os.remove(path)
+                engine.check_memory("write")
+
+
+def migrate_in_chunks(uds3_data_path, engine, data_order_path, output_file, chunksize, output_format="csv"):
+    """
+    Stream the UDS3 CSV through the crosswalk in row chunks and write the ordered chunks to the output file.
+
+    Peak memory depends on the chunk size, not on the number of rows in the export.  Typing, the structured
+    math guards, the output columns and the rendering of whole numbers are decided on the whole export, so the
+    output is the one a single run writes.
+
+    Returns:
+        int: The number of rows migrated.
+    """
+    read_options = engine.read_options(uds3_data_path)
+    try:
+        read_dtypes, int_columns, mixed, rows = scan_csv_types(uds3_data_path, chunksize, read_options)
+    except (ValueError, TypeError) as e:
+        print(f"UDS3 data does not match the dictionary dtypes ({e}), reading with inferred types")
+        read_options = {"usecols": read_options["usecols"]}
+        read_dtypes, int_columns, mixed, rows = scan_csv_types(uds3_data_path, chunksize, read_options)
+    print(f"UDS3_data has {rows} rows, processing in chunks of {chunksize} rows")
+    block_rows = parser_block_rows(len(pd.read_csv(uds3_data_path, nrows=0).columns))
+    engine.check_memory("scan")
+
+    # The structured math guards of the whole export, from a read of the columns they use
+    usecols = [col for col in read_options["usecols"] if col.lower() in guard_columns(engine.plan)]
+    guards = {}
+    if usecols:
+        guard_options = {"usecols": usecols, "dtype": {col: read_dtypes[col] for col in usecols if col in read_dtypes}}
+        for nacc in read_chunks(uds3_data_path, guard_options, chunksize, mixed & set(usecols), block_rows):
+            guards = math_guards(format_uds3(nacc, int_columns), engine.plan, guards)
+
+    def chunks():
+        done = 0
+        typed_options = {"usecols": read_options["usecols"], "dtype": read_dtypes}
+        for i, nacc in enumerate(read_chunks(uds3_data_path, typed_options, chunksize, mixed, block_rows)):
+            engine.check_memory("read")
+            yield engine.transform(nacc, int_columns, verbose=False, guards=guards)
+            done += len(nacc)
+            print(f"  Chunk {i + 1}: {done} of {rows} rows migrated")
+
+    save_parts(chunks(), engine, data_order_path, output_file, output_format)
+    return rows
+
+
+# Incremental state layout version and the default participant / visit keys
+INCREMENTAL_STATE_VERSION = 2
+INCREMENTAL_KEYS = ["adc_sub_id", "redcap_event_name"]
+
+a3_stop_dict = {
+    'mometpr': ['mommeval', 'momageo'],
+    'dadetpr': ['dadmeval', 'dadageo'],
+    **{f'kid{i}etpr': [f'kid{i}meval', f'kid{i}age'] for i in range(1, 16)},
+    **{f'sib{i}etpr': [f'sib{i}meval', f'sib{i}age'] for i in range(1, 21)}
+}
+
+recode_rules = {"csfad": {np.nan: 0},"taupet": {np.nan: 0}, "cdommem": {np.nan: 0},"mci": {np.nan: 0},
+                "cdomattn": {np.nan: 0},"cdomexec": {np.nan: 0},"cdomlang": {np.nan: 0},"cdomvisu": {np.nan: 0}}
+
+
+# Shared-memory input for the multiprocess mode
+def share_frame(nacc, folder):
+    """
+    Write the UDS3 frame as a memory-mappable Arrow IPC file so worker processes read it without pickled copies.
+
+    Args:
+        nacc (pd.DataFrame): UDS3 data as read from the CSV.
+        folder (str): Folder for the Arrow file, ideally RAM backed (e.g. /dev/shm).
+
+    Returns:
+        tuple: (arrow path, columns Arrow cannot hold e.g. mixed numbers and text, object columns)
+    """
+    import pyarrow as pa
+
+    arrays, names, fallback = [], [], []
+    for col in nacc.columns:
+        try:
+            arrays.append(pa.Array.from_pandas(nacc[col]))
+            names.append(col)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            fallback.append(col)
+    table = pa.Table.from_arrays(arrays, names=names)
+
+    arrow_path = os.path.join(folder, "uds3_data.arrow")
+    with pa.OSFile(arrow_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    object_columns = [col for col in names if nacc[col].dtype == object]
+    return arrow_path, fallback, object_columns
+
+
+def migrate_partition(arrow_path, start, stop, columns, fallback_df, object_columns, int_columns, engine, guards=None):
+    """
+    Worker entry point: migrate rows [start, stop) of the shared UDS3 frame.
+
+    Returns:
+        pd.DataFrame: The UDS4 rows for the partition, indexed by their original row positions, as migrated
+            (normalized by the parent once every partition is back).
+    """
+    import pyarrow as pa
+
+    # Memory-mapped and zero-copy until the partition is converted to pandas
+    with pa.memory_map(arrow_path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        nacc = table.slice(start, stop - start).to_pandas()
+    del table
+
+    # Arrow hands back missing text as None, the CSV reader gives NaN
+    for col in object_columns:
+        nacc[col] = nacc[col].where(nacc[col].notna(), np.nan)
+
+    for col in fallback_df.columns:
+        nacc[col] = fallback_df[col].to_numpy()
+
+    nacc = nacc[columns]
+    nacc.index = pd.RangeIndex(start, stop)
+
+    return engine.transform(nacc, int_columns, verbose=False, guards=guards)
+
+
+def migrate_in_parallel(uds3_data_path, engine, workers):
+    """
+    Split the UDS3 data into row partitions and run the full crosswalk pipeline in a process pool.
+
+    The input is shared through a memory-mapped Arrow file and the UDS4 partitions are
+    reassembled in the original row order.  The structured math guards, the output columns and the rendering
+    of whole numbers are decided on the whole export, so the output is the one a single run writes.
+
+    Args:
+        uds3_data_path (str): The UDS3 CSV.
+        engine (CrosswalkEngine): The crosswalk, sent to every worker.
+        workers (int): Number of worker processes.
+
+    Returns:
+        pd.DataFrame: The UDS4 data.
+    """
+    nacc = read_uds3_csv(uds3_data_path, engine.read_options(uds3_data_path))
+    print(f"UDS3_data has {nacc.shape[0]} rows and {nacc.shape[1]} columns, processing with {workers} workers")
+    engine.check_memory("read")
+
+    # Int64 conversion is decided on the whole frame so every partition is typed alike
+    int_columns = export_int_columns(nacc)
+
+    # The structured math guards of the whole export, passed to every partition
+    plan_columns = guard_columns(engine.plan)
+    guards = math_guards(format_uds3(nacc[[col for col in nacc.columns if col.lower() in plan_columns]], int_columns),
+                         engine.plan)
+
+    rows, columns = len(nacc), list(nacc.columns)
+    bounds = np.linspace(0, rows, workers + 1).astype(int)
+    shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    with tempfile.TemporaryDirectory(dir=shm_dir) as folder:
+        arrow_path, fallback, object_columns = share_frame(nacc, folder)
+        fallback_df = nacc[fallback]
+        del nacc
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(migrate_partition, arrow_path, start, stop, columns,
+                                   fallback_df.iloc[start:stop], object_columns, int_columns, engine, guards)
+                       for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+            parts = [future.result() for future in futures]
+
+    # Partitions may differ in columns created only when data is present and in how their numbers are typed, so
+    # each one is normalized with every column of the export and the number rendering decided over all of them
+    rendering = ExportRendering()
+    for part in parts:
+        rendering.add(part)
+    float_columns = rendering.float_columns()
+    final_df = pd.concat([replace_nan_and_na(part.reindex(columns=rendering.columns), float_columns) for part in parts])
+    engine.check_memory("combine")
+    return final_df
+
+
+# Incremental mode, only new or changed UDS3 rows are migrated
+def load_state(state_path):
+    # Previous incremental state, None when missing or unreadable
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if state.get("version") == INCREMENTAL_STATE_VERSION else None
+    except (OSError, ValueError) as e:
+        if os.path.exists(state_path):
+            print(f"Ignoring unreadable incremental state {state_path}: {e}")
+        return None
+
+
+def save_state(state_path, state):
+    # Written to a temporary file first so an interrupted run never leaves a partial state
+    tmp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def format_numbers(df, rendering):
+    # Changed rows are migrated apart from the copied ones, so the whole numbers of numeric columns are written as
+    # floats (5.0) or integers here, as a full run decides it: floats when a value is missing or float in any row
+    for col in (rendering.numbers - rendering.text) & set(df.columns):
+        values = df[col].where(df[col].notna(), "NA").astype(str)
+        if col in rendering.floats or (values == "NA").any():
+            df[col] = values.mask(values.str.fullmatch(r"-?\d+"), values + ".0")
+        else:
+            df[col] = values.str.replace(r"\.0$", "", regex=True)
+    return df
+
+
+def migrate_incrementally(uds3_data_path, engine, data_order_path, output_file, state_path,
+                          key_columns=INCREMENTAL_KEYS, output_format="csv"):
+    """
+    Migrate only the UDS3 rows that are new or changed since the last incremental run.
+
+    Every row is fingerprinted as the rules see it and keyed by the participant / visit columns.
+    Unchanged rows are copied from the previous output without running any rules, rows no longer in
+    the UDS3 data are dropped, and the merged output keeps the row order of the UDS3 CSV.  The state
+    is tied to the rule plan, the data order, the UDS3 columns and dtypes and the output format;
+    when any of them change, or there is no usable state, every row is migrated.
+
+    Args:
+        uds3_data_path (str): The UDS3 CSV.
+        engine (CrosswalkEngine): The crosswalk.
+        data_order_path (str): The UDS4 data order file.
+        output_file (str): The UDS4 output, also the previous output merged into.
+        state_path (str): JSON file holding the row keys and fingerprints of the previous run.
+        key_columns (list): Lowercase UDS3 columns identifying a row; those present in the CSV are used.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+    """
+    nacc = read_uds3_csv(uds3_data_path, engine.read_options(uds3_data_path, key_columns))
+    print(f"UDS3_data has {nacc.shape[0]} rows and {nacc.shape[1]} columns")
+    engine.check_memory("read")
+
+    # Typing and the structured math guards are decided on the whole export so migrated rows come out as in a full run
+    int_columns = export_int_columns(nacc)
+    uds3_view = format_uds3(nacc, int_columns)
+    guards = math_guards(uds3_view, engine.plan)
+
+    keys = [col for col in nacc.columns if col.lower() in key_columns]
+    if keys:
+        row_keys = nacc[keys[0]].astype(str).str.cat([nacc[col].astype(str) for col in keys[1:]], sep="\x1f")
+    if not keys or row_keys.duplicated().any():
+        print(f"The key columns {list(key_columns)} do not identify every UDS3 row, migrating all rows without state")
+        process_and_save_data(data_order_path, engine.transform(nacc, int_columns), output_file, output_format=output_format)
+        return
+
+    # 64-bit hash of every row's values, dtypes and columns go into the settings hash
+    fingerprints = pd.Series(pd.util.hash_pandas_object(uds3_view, index=False).to_numpy(), index=row_keys.to_numpy())
+    with open(data_order_path, 'rb') as f:
+        settings = hashlib.sha256(f.read())
+    settings.update(json.dumps([engine.plan.key, output_format, list(map(str, uds3_view.columns)),
+                                list(map(str, uds3_view.dtypes))]).encode('utf-8'))
+    settings = settings.hexdigest()
+
+    state = load_state(state_path)
+    previous = None
+    if state is not None and state["settings"] == settings and os.path.exists(output_file):
+        previous = pd.Series(state["fingerprints"], index=state["keys"], dtype="uint64")
+        changed = ~fingerprints.index.isin(previous.index)
+        changed[~changed] = previous[fingerprints.index[~changed]].to_numpy() != fingerprints[~changed].to_numpy()
+    else:
+        print("No matching incremental state, migrating all rows")
+        changed = np.ones(len(nacc), dtype=bool)
+
+    parts = []
+    # What the columns held in the rows migrated by earlier runs, the copied rows are only text
+    rendering = ExportRendering(**state["rendering"]) if previous is not None else ExportRendering()
+    if changed.any():
+        migrated = engine.transform(nacc[changed], int_columns, guards=guards)
+        rendering.add(migrated)
+        parts.append(replace_nan_and_na(migrated, float_columns=set()).set_axis(row_keys[changed]))
+    if previous is not None and not changed.all():
+        # Unchanged rows are copied as written last time
+        kept = read_output(output_file, output_format).set_axis(previous.index)
+        parts.append(kept.loc[row_keys[~changed]])
+
+    removed = 0 if previous is None else int((~previous.index.isin(row_keys)).sum())
+    print(f"Incremental run: {changed.sum()} new or changed rows migrated, {(~changed).sum()} copied, {removed} removed")
+
+    final_df = format_numbers(pd.concat(parts).reindex(row_keys), rendering)
+    engine.check_memory("merge")
+    process_and_save_data(data_order_path, final_df, output_file, output_format=output_format)
+    engine.check_memory("write")
+    save_state(state_path, {"version": INCREMENTAL_STATE_VERSION, "settings": settings,
+                            "rendering": {"text": sorted(rendering.text), "numbers": sorted(rendering.numbers),
+                                          "floats": sorted(rendering.floats)},
+                            "keys": row_keys.tolist(), "fingerprints": fingerprints.tolist()})
+
+
+def preflight(engine, uds3_data_path, chunksize=None):
+    # --max-memory estimate from the rows and the projected columns, before any data is read
+    if engine.memory is not None:
+        engine.memory.preflight(engine.count_rows(uds3_data_path),
+                                len(engine.read_options(uds3_data_path, verbose=False)["usecols"]),
+                                chunksize or getattr(engine, "batch_rows", None))
+
+
+# Batch mode, many UDS3 exports (e.g. one per center) migrated by one invocation with the rules compiled once
+def batch_inputs(pattern):
+    # The CSV files of a directory, or the files matching a glob pattern, in name order
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.csv")
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+def batch_outputs(uds3_paths, output_dir, output_format="csv"):
+    """
+    Output file of every UDS3 export: <export name>_uds4 in output_dir.
+
+    Raises:
+        ValueError: Two exports with the same file name (from different folders) would write the same output.
+    """
+    outputs = {path: os.path.join(output_dir, output_name(f"{os.path.splitext(os.path.basename(path))[0]}_uds4", output_format))
+               for path in uds3_paths}
+    clashes = [name for name, count in Counter(outputs.values()).items() if count > 1]
+    if clashes:
+        raise ValueError(f"Several UDS3 exports would be written to {clashes[0]}, rename them or migrate them separately")
+    return outputs
+
+
+def migrate_batch_file(uds3_data_path, engine, data_order_path, output_file, chunksize=None, output_format="csv"):
+    """
+    Worker entry point of the batch mode: migrate one export as the single-file command line does.
+
+    Progress messages go to a .log file next to the output, and an error stops this export only.
+
+    Returns:
+        dict: The rows migrated, the seconds taken and the error message, None when it succeeded.
+    """
+    start = time.perf_counter()
+    rows, error = None, None
+    with open(f"{os.path.splitext(output_file)[0]}.log", "w") as log, contextlib.redirect_stdout(log):
+        try:
+            preflight(engine, uds3_data_path, chunksize)
+            if hasattr(engine, "migrate_file"):
+                rows = engine.migrate_file(uds3_data_path, data_order_path, output_file, chunksize, output_format)
+            elif chunksize:
+                rows = migrate_in_chunks(uds3_data_path, engine, data_order_path, output_file, chunksize, output_format)
+            else:
+                nacc = read_uds3_csv(uds3_data_path, engine.read_options(uds3_data_path))
+                rows = len(nacc)
+                engine.check_memory("read")
+                process_and_save_data(data_order_path, engine.transform(nacc, verbose=False), output_file,
+                                      output_format=output_format)
+                engine.check_memory("write")
+        except Exception as e:
+            rows, error = None, f"{type(e).__name__}: {e}"
+            print(error)
+    return {"rows": rows, "seconds": time.perf_counter() - start, "error": error}
+
+
+def migrate_batch(uds3_paths, engine, data_order_path, output_dir, workers, chunksize=None, output_format="csv"):
+    """
+    Migrate many UDS3 exports in a process pool, one output per export, and print the timing of each.
+
+    Args:
+        uds3_paths (list): The UDS3 exports.
+        engine (CrosswalkEngine): The crosswalk, compiled once and sent to every worker.
+        data_order_path (str): The UDS4 data order file.
+        output_dir (str): Folder for the outputs and their .log files, created when missing.
+        workers (int): Exports migrated at once.
+        chunksize (int): Stream every export in chunks of this many rows.
+        output_format (str): 'csv', 'parquet' or 'feather'.
+
+    Returns:
+        int: The number of exports that failed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = batch_outputs(uds3_paths, output_dir, output_format)
+    workers = max(1, min(workers, len(uds3_paths)))
+    print(f"Migrating {len(uds3_paths)} UDS3 exports with {workers} workers into {output_dir}")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {path: pool.submit(migrate_batch_file, path, engine, data_order_path, output_file, chunksize, output_format)
+                   for path, output_file in outputs.items()}
+        results = {}
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                # The worker process itself died, e.g. killed out of memory
+                results[path] = {"rows": None, "seconds": float("nan"), "error": f"{type(e).__name__}: {e}"}
+            print(f"  {os.path.basename(path)}: " + (results[path]["error"] or f"done in {results[path]['seconds']:.1f}s"))
+
+    print(f"\nBatch summary ({len(uds3_paths)} exports, {workers} workers, {time.perf_counter() - start:.1f}s)")
+    print(f"{'export':<40} {'rows':>8} {'seconds':>8}  output")
+    for path, result in results.items():
+        rows = f"{result['rows']}" if result["rows"] is not None else "-"
+        status = f"FAILED, see {os.path.splitext(outputs[path])[0]}.log" if result["error"] else os.path.basename(outputs[path])
+        print(f"{os.path.basename(path):<40} {rows:>8} {result['seconds']:8.1f}  {status}")
+    return sum(result["error"] is not None for result in results.values())
+
+
+########################### Main Process #############################################
+
+def main(argv=None):
+    """Command line entry point, a thin wrapper building a CrosswalkEngine and running the selected mode."""
+
+    # Ignore all warnings
+    warnings.filterwarnings("ignore")
+
+    # Inputs -- 1. UDS3 Recap Data path, 2.Json Crosswalk folder path, 3. UDS3_Data_Elements_list
+    arg_parser = argparse.ArgumentParser(description="Migrate UDS3 REDCap data to UDS4 using the JSON crosswalk rules",
+                                         allow_abbrev=False)
+    arg_parser.add_argument("uds3_data_path", nargs="?")
+    arg_parser.add_argument("json_folder_path", nargs="?")
+    arg_parser.add_argument("data_order_path", nargs="?")
+    arg_parser.add_argument("--chunksize", type=int, default=None,
+                            help="Read the UDS3 CSV in chunks of this many rows so memory stays bounded on large exports")
+    arg_parser.add_argument("--workers", type=int, default=None,
+                            help="Split the UDS3 rows across this many worker processes")
+    arg_parser.add_argument("--output-format", choices=list(OUTPUT_WRITERS), default="csv",
+                            help="Write the UDS4 data as CSV (default), Parquet or Feather")
+    arg_parser.add_argument("--incremental", action="store_true",
+                            help="Only migrate UDS3 rows that are new or changed since the last incremental run")
+    arg_parser.add_argument("--state-file", default=None,
+                            help="Incremental state file, defaults to the output name with .state.json")
+    arg_parser.add_argument("--key-columns", default=",".join(INCREMENTAL_KEYS),
+                            help="Comma separated UDS3 columns identifying a participant visit in incremental mode")
+    arg_parser.add_argument("--profile", action="store_true",
+                            help="Time every rule and save a per-rule report next to the output")
+    arg_parser.add_argument("--profile-top", type=int, default=20, help="Rules listed in the --profile table")
+    arg_parser.add_argument("--max-memory", type=float, default=None, metavar="MB",
+                            help="Memory budget in MB: the run is estimated before reading and stops after any stage over it")
+    arg_parser.add_argument("--engine", choices=ENGINES, default="pandas",
+                            help="Run the rules with pandas (default), the multi-threaded Polars backend or streamed "
+                                 "out of core through DuckDB (CSV or Parquet input)")
+    arg_parser.add_argument("--output-dir", default=None,
+                            help="Batch mode: migrate every CSV of the uds3_data_path folder (or glob pattern) into this "
+                                 "folder, --workers exports at once")
+    args = arg_parser.parse_args(argv)
+
+    if args.data_order_path:
+        uds3_data_path, json_folder_path, data_order_path = args.uds3_data_path, args.json_folder_path, args.data_order_path
+    elif sys.stdin and sys.stdin.isatty(): 
+      print("Running interactively, be sure to update paths in Main Process")
+      uds3_data_path = json_folder_path = data_order_path = None
+
+    else:
+        print("Please Provide the UDS3_data, Json Crosswalk Folder and Data Order paths")
+        uds3_data_path = json_folder_path = data_order_path = None
+
+    # #Define paths for interactive running
+
+    #uds3_data_path = r'C:\PATH\TO\UDS3\<UDS3_data_file>.csv'
+    #json_folder_path = r'C:\PATH\TO\JSON\FOLDER'
+    #data_order_path = r'C:\PATH\TO\ORDER\FOLDER\<dataOrder_file>.txt'
+
+    if uds3_data_path is None or json_folder_path is None or data_order_path is None:
+        print("Cannot able to find the paths in Main Process")
+        return
+
+    if args.output_dir and (args.incremental or args.profile):
+        print("--output-dir cannot be combined with --incremental or --profile")
+        return
+
+    if args.chunksize and args.workers and not args.output_dir:
+        print("Please use either --chunksize or --workers, not both")
+        return
+
+    if args.incremental and (args.chunksize or args.workers):
+        print("--incremental cannot be combined with --chunksize or --workers")
+        return
+
+    if args.profile and args.workers and args.workers > 1:
+        print("--profile cannot be combined with --workers, the rules run in other processes")
+        return
+
+    if args.engine != "pandas" and args.workers and args.workers > 1 and not args.output_dir:
+        print(f"--engine {args.engine} cannot be combined with --workers, the backend already uses every core")
+        return
+
+    try:
+        engine_type = engine_class(args.engine)
+    except ImportError as e:
+        print(f"--engine {args.engine} needs the {e.name} package, install it with: pip install {e.name}")
+        return
+
+    # Compile the JSON crosswalk rules, reusing the cached plan when unchanged
+    engine = engine_type.from_folder(json_folder_path, profile=RuleProfile() if args.profile else None, verbose=True,
+                                         memory=MemoryBudget(args.max_memory) if args.max_memory else None)
+
+    if args.output_dir:
+        # Batch mode, the compiled rules are shared by every export
+        uds3_paths = batch_inputs(uds3_data_path)
+        if not uds3_paths:
+            print(f"No UDS3 CSV files found in {uds3_data_path}")
+            return
+        try:
+            failed = migrate_batch(uds3_paths, engine, data_order_path, args.output_dir,
+                                   args.workers or os.cpu_count() or 1, args.chunksize, args.output_format)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        if failed:
+            print(f"{failed} of {len(uds3_paths)} UDS3 exports failed")
+            sys.exit(1)
+        print(f"Your Data Migration from UDS3 to UDS4 is Completed, the UDS4 Data is saved in {args.output_dir}")
+        return
+
+    # File name to save
+    uds4_file_name = output_name("uds4_redcap_data_py", args.output_format)
+
+    try:
+        # Estimated from the rows and the projected columns before any data is read
+        preflight(engine, uds3_data_path, args.chunksize)
+
+        if args.incremental:
+            # Migrate new or changed rows only and merge them into the previous output
+            migrate_incrementally(uds3_data_path, engine, data_order_path, uds4_file_name,
+                                  args.state_file or f"{os.path.splitext(uds4_file_name)[0]}.state.json",
+                                  [col.strip().lower() for col in args.key_columns.split(",") if col.strip()],
+                                  args.output_format)
+
+        elif args.engine == "duckdb":
+            # DuckDB scans the UDS3 file and streams it through the rules in batches of --chunksize rows
+            engine.migrate_file(uds3_data_path, data_order_path, uds4_file_name, args.chunksize, args.output_format)
+
+        elif args.chunksize:
+            # Stream the UDS3 data in chunks, appending the ordered output as we go
+            migrate_in_chunks(uds3_data_path, engine, data_order_path, uds4_file_name, args.chunksize, args.output_format)
+
+        else:
+            if args.workers and args.workers > 1:
+                # Row partitions migrated in a process pool, reassembled in the original order
+                final_df = migrate_in_parallel(uds3_data_path, engine, args.workers)
+
+            else:
+                # Provide UDS3 data as input - try to provide the label data
+                nacc = read_uds3_csv(uds3_data_path, engine.read_options(uds3_data_path))
+                print(f"UDS3_data has {nacc.shape[0]} rows and {nacc.shape[1]} columns")
+                engine.check_memory("read")
+
+                # Apply the crosswalk and validate
+                final_df = engine.transform(nacc)
+
+            # Saving the ordered data
+            process_and_save_data(
+                data_order_path, 
+                final_df, 
+                uds4_file_name,
+                output_format=args.output_format)
+            engine.check_memory("write")
+
+    except MemoryBudgetExceeded as e:
+        print(e)
+        if engine.memory.stages:
+            engine.memory.report()
+        sys.exit(1)
+
+    if engine.memory is not None:
+        engine.memory.report()
+
+    if engine.profile is not None:
+        # Per-rule report next to the output, slowest rules printed
+        profile_file = f"{os.path.splitext(uds4_file_name)[0]}.profile.json"
+        engine.profile.save(profile_file)
+        engine.profile.print_top(args.profile_top)
+        print(f"Rule profile saved in {profile_file}")
+
+    print("Your Data Migration from UDS3 to UDS4 is Completed")
+    print(f"The UDS4 Data is saved in the current folder with name - {uds4_file_name}")
+
+
+if __name__ == "__main__":
+    main()
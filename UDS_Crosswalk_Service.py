@@ -0,0 +1,350 @@
+import os, sys
+import io
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+import pandas as pd
+import numpy as np
+
+from UDS_Crosswalk_Parser import (CrosswalkEngine, export_int_columns, format_uds3, guard_columns, load_data_order,
+                                  math_guards, read_uds3_csv, replace_nan_and_na)
+from UDS_Output_Writer import to_arrow_table
+
+
+# Long-running migration service: the compiled rules stay loaded, UDS3 batches arrive as CSV or Arrow over
+# local HTTP (or a Unix socket) and small concurrent requests are migrated together.
+
+CSV_TYPE = "text/csv"
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+
+# Latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 1000
+
+
+class ServiceStats:
+    """Request, batch and row counters with latency percentiles, safe to update from the handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = self.errors = self.rows = self.batches = self.batch_rows = 0
+        self.busy = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def request(self, rows, seconds, failed=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += failed
+            self.rows += rows
+            self.latencies.append(seconds)
+
+    def batch(self, requests, rows, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batch_rows += rows
+            self.busy += seconds
+
+    def report(self, queued=0):
+        with self.lock:
+            uptime = time.time() - self.started
+            latencies = np.array(self.latencies) * 1000
+            percentiles = ({f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+                           if len(latencies) else {})
+            return {
+                "uptime_seconds": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "rows": self.rows,
+                "batches": self.batches,
+                "requests_per_batch": self.requests / self.batches if self.batches else None,
+                "rows_per_batch": self.batch_rows / self.batches if self.batches else None,
+                "queued_requests": queued,
+                "latency_ms": dict(percentiles, mean=float(latencies.mean()) if len(latencies) else None),
+                "rows_per_second_busy": self.batch_rows / self.busy if self.busy else None,
+                "rows_per_second_uptime": self.rows / uptime if uptime else None,
+            }
+
+
+class MigrationRequest:
+    def __init__(self, nacc):
+        self.nacc = nacc
+        # Requests with the same columns are coalesced, their typing is only decided on the batch worker
+        self.columns = tuple(nacc.columns)
+        self.future = Future()
+
+    def prepare(self, plan):
+        """
+        Type the payload and decide its structured math guards as a standalone run of it would, once per request.
+
+        Integer columns migrate alike with and without gaps (int64, Int64), so the signature only separates
+        requests whose other column dtypes or math rule decisions differ: those cannot share a transform.
+        """
+        self.int_columns = export_int_columns(self.nacc, verbose=False)
+        columns = guard_columns(plan)
+        guards = math_guards(format_uds3(self.nacc[[col for col in self.nacc.columns if col.lower() in columns]],
+                                         self.int_columns, verbose=False), plan)
+        self.guards = {key: (all(guard),) for key, guard in guards.items()}
+        kinds = tuple("integer" if col.lower() in self.int_columns or self.nacc[col].dtype.kind in "iu"
+                      else self.nacc[col].dtype.kind for col in self.nacc.columns)
+        self.signature = (kinds, tuple(sorted(self.guards.items())))
+
+
+class BatchQueue:
+    """
+    Coalesces concurrent requests into one frame per batch and migrates it on a single worker thread.
+
+    A batch collects requests for up to `window` seconds after the first one arrives, or until
+    `max_rows` rows are queued.  Requests with the same columns are typed and guarded one by one on the
+    worker (see MigrationRequest.prepare), those typed alike are concatenated, migrated by one transform
+    with their guards and split back into their own rows, so each gets the rows a standalone run gives
+    it.  A batch the rules fail on is migrated one request at a time.
+
+    Args:
+        engine (CrosswalkEngine): The warm crosswalk.
+        stats (ServiceStats): Updated after every batch.
+        window (float): Seconds to wait for more requests once one is queued, 0 migrates each request alone.
+        max_rows (int): Rows that close a batch early.
+    """
+
+    def __init__(self, engine, stats, window=0.02, max_rows=50_000):
+        self.engine = engine
+        self.stats = stats
+        self.window = window
+        self.max_rows = max_rows
+        self.pending = queue.Queue()
+        threading.Thread(target=self.run, name="uds-batch-worker", daemon=True).start()
+
+    def submit(self, nacc):
+        request = MigrationRequest(nacc)
+        self.pending.put(request)
+        return request.future
+
+    def collect(self):
+        batch = [self.pending.get()]
+        rows = len(batch[0].nacc)
+        deadline = time.monotonic() + self.window
+        while rows < self.max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            rows += len(request.nacc)
+        return batch
+
+    def run(self):
+        while True:
+            groups = {}
+            for request in self.collect():
+                groups.setdefault(request.columns, []).append(request)
+            for requests in groups.values():
+                self.coalesce(requests)
+
+    def coalesce(self, requests):
+        # Requests with the same columns, split into the batches one transform migrates as they migrate alone
+        if len(requests) == 1:
+            self.migrate(requests)
+            return
+        batches = {}
+        for request in requests:
+            try:
+                request.prepare(self.engine.plan)
+            except Exception:
+                # Migrated alone, the error it stops with is the request's answer
+                self.migrate([request])
+                continue
+            batches.setdefault(request.signature, []).append(request)
+        for batch in batches.values():
+            self.migrate(batch)
+
+    def migrate(self, requests):
+        start = time.perf_counter()
+        try:
+            if len(requests) == 1:
+                nacc = requests[0].nacc
+                uds4_df = self.engine.transform(nacc, verbose=False)
+            else:
+                nacc = pd.concat([request.nacc for request in requests], ignore_index=True)
+                int_columns = set().union(*(request.int_columns for request in requests))
+                uds4_df = self.engine.transform(nacc, int_columns, verbose=False, guards=requests[0].guards)
+        except Exception as e:
+            # A request the rules fail on must not fail the others, each is migrated alone
+            if len(requests) > 1:
+                for request in requests:
+                    self.migrate([request])
+                return
+            requests[0].future.set_exception(e)
+            return
+
+        bounds = np.cumsum([0] + [len(request.nacc) for request in requests])
+        for request, begin, end in zip(requests, bounds[:-1], bounds[1:]):
+            request.future.set_result(uds4_df.iloc[begin:end].reset_index(drop=True))
+        self.stats.batch(len(requests), len(nacc), time.perf_counter() - start)
+
+
+class CrosswalkService:
+    """
+    The warm engine, data order and batch queue shared by every connection.
+
+    Args:
+        engine (CrosswalkEngine): The crosswalk, compiled once at startup.
+        data_order_path (str): The UDS4 data order file, loaded once.
+        window (float), max_rows (int): Batching, see BatchQueue.
+    """
+
+    def __init__(self, engine, data_order_path, window=0.02, max_rows=50_000):
+        self.engine = engine
+        self.data_order = load_data_order(data_order_path)
+        self.stats = ServiceStats()
+        self.batches = BatchQueue(engine, self.stats, window, max_rows)
+
+    def read_payload(self, body, content_type):
+        # CSV payloads get the same projection and dictionary dtypes as the command line
+        if content_type.startswith(ARROW_TYPE):
+            import pyarrow as pa
+            nacc = pa.ipc.open_stream(body).read_all().to_pandas()
+            # Arrow hands back missing text as None, the CSV reader gives NaN
+            for col in nacc.columns[nacc.dtypes == object]:
+                nacc[col] = nacc[col].where(nacc[col].notna(), np.nan)
+            return nacc[[col for col in nacc.columns if col.lower() in self.engine.plan.columns]]
+        return read_uds3_csv(io.BytesIO(body), self.engine.read_options(io.BytesIO(body), verbose=False), verbose=False)
+
+    def render(self, uds4_df, content_type):
+        # Projected and normalized exactly as process_and_save_data writes it
+        output = replace_nan_and_na(uds4_df.reindex(columns=[col for col in self.data_order if col in uds4_df.columns]))
+        if content_type.startswith(ARROW_TYPE):
+            import pyarrow as pa
+            sink = pa.BufferOutputStream()
+            table = to_arrow_table(output)
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return sink.getvalue().to_pybytes()
+        return output.to_csv(index=False, na_rep="NA").encode("utf-8")
+
+    def migrate(self, body, content_type, accept=None):
+        start, rows = time.perf_counter(), 0
+        try:
+            nacc = self.read_payload(body, content_type)
+            rows = len(nacc)
+            uds4_df = self.batches.submit(nacc).result()
+            response_type = accept if accept in (CSV_TYPE, ARROW_TYPE) else (ARROW_TYPE if content_type.startswith(ARROW_TYPE) else CSV_TYPE)
+            payload = self.render(uds4_df, response_type)
+        except Exception:
+            self.stats.request(rows, time.perf_counter() - start, failed=True)
+            raise
+        self.stats.request(rows, time.perf_counter() - start)
+        return payload, response_type
+
+
+class CrosswalkRequestHandler(BaseHTTPRequestHandler):
+    # POST /migrate with a CSV or Arrow stream body, GET /stats and GET /health
+    protocol_version = "HTTP/1.1"
+
+    def send(self, status, payload, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status, data):
+        self.send(status, json.dumps(data).encode("utf-8"))
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.service.stats.report(self.server.service.batches.pending.qsize()))
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok", "plan_key": self.server.service.engine.plan.key})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/migrate":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload, content_type = self.server.service.migrate(body, self.headers.get("Content-Type", CSV_TYPE),
+                                                                self.headers.get("Accept"))
+        except Exception as e:
+            self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send(200, payload, content_type)
+
+    def address_string(self):
+        # Unix socket peers have no host/port
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        self.server_name, self.server_port = "localhost", 0
+
+
+def serve(service, host="127.0.0.1", port=8765, socket_path=None, verbose=False):
+    """
+    Serve a CrosswalkService until interrupted, over a Unix socket when socket_path is given.
+    """
+    if socket_path:
+        server = UnixHTTPServer(socket_path, CrosswalkRequestHandler)
+        where = f"unix socket {socket_path}"
+    else:
+        server = ThreadingHTTPServer((host, port), CrosswalkRequestHandler)
+        where = f"http://{host}:{server.server_port}"
+    server.service, server.verbose = service, verbose
+
+    print(f"UDS crosswalk service listening on {where} (POST /migrate, GET /stats, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+########################### Main Process #############################################
+
+if __name__ == "__main__":
+
+    # Ignore all warnings
+    warnings.filterwarnings("ignore")
+    # Stop cleanly (closing the server and removing the socket) on SIGTERM as on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    arg_parser = argparse.ArgumentParser(description="Serve the UDS3 to UDS4 crosswalk with the rules kept in memory")
+    arg_parser.add_argument("json_folder_path")
+    arg_parser.add_argument("data_order_path")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--socket", default=None, help="Listen on this Unix socket instead of TCP")
+    arg_parser.add_argument("--batch-window-ms", type=float, default=20,
+                            help="Wait this long for concurrent requests to migrate together, 0 disables coalescing")
+    arg_parser.add_argument("--max-batch-rows", type=int, default=50_000, help="Rows that close a batch early")
+    arg_parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = arg_parser.parse_args()
+
+    engine = CrosswalkEngine.from_folder(args.json_folder_path)
+    service = CrosswalkService(engine, args.data_order_path, args.batch_window_ms / 1000, args.max_batch_rows)
+    serve(service, args.host, args.port, args.socket, args.verbose)
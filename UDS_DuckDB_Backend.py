@@ -0,0 +1,383 @@
+import numpy as np
+import pandas as pd
+import duckdb
+
+from UDS_Crosswalk_Parser import (CrosswalkEngine, INTEGER_PATTERN, NA_SPELLINGS, NUMBER_PATTERN, PDX_COLUMNS, column_rules,
+                                  count_csv_rows, format_uds3, guard_columns, math_guards, parse_blocks, parser_block_rows,
+                                  rule_inputs, save_parts, text_column, uds3_read_options)
+from UDS_Rule_Compiler import BoolOp, Missing
+
+
+# DuckDB execution backend (--engine duckdb) for exports larger than memory.  DuckDB scans the UDS3 CSV or Parquet
+# file on every core, types each column as pandas would type the whole export, and evaluates the column-wise rules
+# (see column_rules in UDS_Crosswalk_Parser.py) as SQL CASE expressions in the same SELECT.  The result is streamed
+# in batches through the remaining pandas rules and data_crosscheck and appended to the ordered UDS4 output, so no
+# step holds the whole export.
+
+# Rows per batch handed from DuckDB to the pandas rules, --chunksize overrides it
+BATCH_ROWS = 100_000
+
+# Cells pandas' CSV reader takes as missing (its default na_values)
+PANDAS_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+                    'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+BOOLEAN_VALUES = ['True', 'TRUE', 'true', 'False', 'FALSE', 'false']
+# Cell counts per UDS3 column that column_type decides on
+STAT_NAMES = ["present", "numbers", "integers", "exact", "whole", "infinite", "booleans"]
+
+
+def quote(name):
+    # SQL identifier
+    return '"' + name.replace('"', '""') + '"'
+
+
+def literal(value):
+    # SQL text literal
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def is_parquet(file_path):
+    return isinstance(file_path, str) and file_path.lower().endswith((".parquet", ".pq"))
+
+
+def scan_source(file_path, header=None):
+    # DuckDB query reading the export as text, CSV cells pandas takes as missing are NULL; DuckDB trims the CSV
+    # header names, so the header as pandas reads it is passed in
+    if is_parquet(file_path):
+        return f"(SELECT COLUMNS(*)::VARCHAR FROM read_parquet({literal(file_path)}))"
+    names = f", names=[{', '.join(map(literal, header))}]" if header is not None else ""
+    return (f"read_csv({literal(file_path)}, header=true, all_varchar=true, delim=',', quote='\"', escape='\"', "
+            f"nullstr=[{', '.join(map(literal, PANDAS_NA_VALUES))}]{names})")
+
+
+class SqlRules:
+    """
+    Builds the SQL expressions of the rules selected by column_rules, with the semantics of CrosswalkRun.
+
+    Args:
+        columns (dict): Lowercase UDS3 column -> SQL reference to its typed values.
+        integer (set): Lowercase UDS3 columns holding integers, the others hold text.
+    """
+
+    def __init__(self, columns, integer):
+        self.columns = columns
+        self.integer = integer
+
+    def text(self, col):
+        # pandas astype(str)
+        if col in self.integer:
+            return f"coalesce(CAST({self.columns[col]} AS VARCHAR), '<NA>')"
+        return f"coalesce({self.columns[col]}, 'nan')"
+
+    def equals(self, col, value):
+        # Rows whose text is exactly `value`, integer columns are compared as numbers
+        ref = self.columns[col]
+        if col in self.integer:
+            if value == "<NA>":
+                return f"{ref} IS NULL"
+            try:
+                number = int(value)
+            except ValueError:
+                return "false"
+            if str(number) != value or abs(number) >= 2 ** 63:
+                return "false"
+            return f"coalesce({ref} = {number}, false)"
+        if value == "nan":
+            return f"({ref} IS NULL OR coalesce({ref} = 'nan', false))"
+        return f"coalesce({ref} = {literal(value)}, false)"
+
+    def is_in(self, col, values):
+        return "(" + " OR ".join(self.equals(col, value) for value in dict.fromkeys(values)) + ")"
+
+    def condition(self, expression):
+        # Equals, Missing and BoolOp trees as CrosswalkRun.condition_mask evaluates them
+        if isinstance(expression, BoolOp):
+            joiner = " OR " if expression.operator == "|" else " AND "
+            return "(" + joiner.join(self.condition(operand) for operand in expression.operands) + ")"
+        if isinstance(expression, Missing):
+            ref = self.columns[expression.col]
+            if expression.col in self.integer:
+                return f"{ref} IS NULL"
+            return f"({ref} IS NULL OR coalesce({ref} IN ({', '.join(map(literal, NA_SPELLINGS))}), false))"
+        return self.equals(expression.col, expression.value)
+
+    def last_match(self, cases, otherwise):
+        # The output of the last matching (condition, value) case, CASE takes the first so they are reversed
+        return ("CASE " + " ".join(f"WHEN {condition} THEN {literal(value)}" for condition, value in cases[::-1])
+                + f" ELSE {otherwise} END")
+
+    def levels(self, rule):
+        # Non-matching conformity: response levels, then grep() searches, then the unmapped UDS3 text
+        col = rule.uds3_var
+        cases = []
+        for uds3_value, uds4_value, values in rule.level_pairs:
+            if values is None:
+                cases.append((f"{self.columns[col]} IS NULL" if uds3_value == 'None' else self.equals(col, uds3_value), uds4_value))
+            elif not (col.endswith("sec") or col.endswith("ter")):
+                cases.append((self.is_in(col, values), uds4_value))
+        expression = self.last_match(cases, "CAST(NULL AS VARCHAR)")
+
+        if rule.grep_rules:
+            lowered = f"lower({self.text(col)})"
+            cases = [("(" + " OR ".join(f"contains({lowered}, {literal(term)})" for term in search_terms) + ")", uds4_value)
+                     for search_terms, uds4_value in rule.grep_rules]
+            expression = self.last_match(cases, expression)
+
+        if rule.preserve_unmapped and col != 'cancer':
+            mapped = ", ".join(literal(value) for value in dict.fromkeys(rule.response_map.values()))
+            expression = f"CASE WHEN ({expression}) IN ({mapped}) THEN ({expression}) ELSE {self.text(col)} END"
+        return expression
+
+    def separator(self, rule):
+        struct_rule = rule.structured[0]
+        return (f"CASE WHEN {self.condition(struct_rule.separator_expression)} "
+                f"THEN {literal(struct_rule.separator_value)} ELSE CAST(NULL AS VARCHAR) END")
+
+    def paste(self, rule):
+        return " || '/' || ".join(self.text(col) for col in rule.structured[0].paste_columns[:3])
+
+
+def text_values(array):
+    # Arrow text to an object array with NaN for missing, as read_csv gives it
+    values = array.to_numpy(zero_copy_only=False).astype(object)
+    values[array.is_null().to_numpy(zero_copy_only=False)] = np.nan
+    return values
+
+
+def column_type(stats, dtype):
+    """
+    The pandas type of a UDS3 column over the whole export, from the scan statistics.
+
+    Mirrors read_csv_typed (schema dtypes, or inference) followed by format_uds3: numbers that are all
+    whole become int64, or Int64 when the column has missing values, other numbers float64.
+
+    Args:
+        stats (dict): Counts of rows and of present, number, integer, exact integer, whole, infinite and boolean cells.
+        dtype (str): The schema dtype, None when the column is inferred.
+
+    Returns:
+        str: 'text', 'mixed' (text and numbers, see parse_blocks), 'int64' (exact integers),
+            'whole' (int64 through float64), 'Int64', 'float64', or None
+            when the values do not fit the schema dtype, or pandas would infer a type not reproduced here
+            (booleans, integers beyond int64).
+    """
+    present, missing = stats["present"], stats["rows"] - stats["present"]
+    if dtype == 'str':
+        return 'text'
+    if dtype is not None:
+        if stats["numbers"] < present or (dtype == 'Int64' and stats["whole"] < present):
+            return None
+    elif stats["numbers"] < present:
+        if present and stats["booleans"] == present:
+            return None
+        return 'mixed' if stats["numbers"] else 'text'
+    elif stats["integers"] > stats["exact"]:
+        return None
+    elif present and stats["integers"] == present and not missing:
+        return 'int64'
+    if stats["whole"] == present - stats["infinite"]:
+        return 'Int64' if missing or stats["infinite"] else 'whole'
+    return 'float64'
+
+
+class DuckDBCrosswalkEngine(CrosswalkEngine):
+    """
+    CrosswalkEngine streaming a UDS3 file through DuckDB, see migrate_file.
+
+    transform() on an in-memory frame runs the column-wise rules as SQL over it and the rest in pandas.
+    """
+    batch_rows = BATCH_ROWS
+
+    def __init__(self, plan, **kwargs):
+        super().__init__(plan, **kwargs)
+        self.column_rules = column_rules(plan)
+
+    def connect(self):
+        # Half of a --max-memory budget is left to DuckDB, which spills to disk beyond it
+        config = {"memory_limit": f"{self.memory.limit_mb / 2:.0f}MB"} if self.memory is not None else {}
+        return duckdb.connect(config=config)
+
+    def header(self, file_path):
+        # Column names of the export, as pandas reads them for a CSV
+        if not is_parquet(file_path):
+            return list(pd.read_csv(file_path, nrows=0).columns)
+        with self.connect() as con:
+            return [row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {scan_source(file_path)}").fetchall()]
+
+    def read_options(self, file_path, extra_columns=(), verbose=True):
+        if not is_parquet(file_path):
+            return super().read_options(file_path, extra_columns, verbose)
+        return uds3_read_options(file_path, self.plan, extra_columns, verbose, header=self.header(file_path))
+
+    def count_rows(self, file_path):
+        if not is_parquet(file_path):
+            return count_csv_rows(file_path)
+        with self.connect() as con:
+            return con.execute(f"SELECT count(*) FROM {scan_source(file_path)}").fetchone()[0]
+
+    def rule_expressions(self, builder, usable):
+        # (uds4_var, SQL) of every column-wise rule whose UDS3 columns are all usable
+        return [(rule.uds4_var, getattr(builder, kind)(rule)) for rule, kind in self.column_rules
+                if all(usable.get(col) for col in rule_inputs(rule, kind))]
+
+    def precompute(self, uds3_df):
+        usable = {col: text_column(uds3_df, col) for col in {col for rule, kind in self.column_rules
+                                                             for col in rule_inputs(rule, kind)} if col in uds3_df.columns}
+        integer = {col for col, ok in usable.items() if ok and pd.api.types.is_integer_dtype(uds3_df[col])}
+        expressions = self.rule_expressions(SqlRules({col: quote(col) for col in usable}, integer), usable)
+        if not expressions:
+            return {}
+
+        with self.connect() as con:
+            con.register("uds3", uds3_df[[col for col, ok in usable.items() if ok]])
+            table = con.execute("SELECT " + ", ".join(f"{sql} AS {quote(name)}" for name, sql in expressions)
+                                + " FROM uds3").to_arrow_table()
+        return {name: pd.Series(text_values(table[name]), index=uds3_df.index, dtype=object) for name, _ in expressions}
+
+    def scan_types(self, con, source, usecols):
+        """
+        Count, per UDS3 column, the cells of each kind column_type decides on.
+
+        The classification runs over the distinct values of every column, a handful per column in UDS3 data.
+
+        Returns:
+            tuple: (list of stats dicts in usecols order, rows).
+        """
+        rows = con.execute(f"SELECT count(*) FROM {source}").fetchone()[0]
+        stats = {col: dict.fromkeys(STAT_NAMES, 0) for col in usecols}
+        if not usecols:
+            return [], rows
+
+        text = "uds3_text"
+        number = f"TRY_CAST({text} AS DOUBLE)"
+        integer = f"regexp_full_match({text}, {literal(INTEGER_PATTERN)})"
+        counts = {
+            "present": "true",
+            "numbers": f"regexp_full_match({text}, {literal(NUMBER_PATTERN)})",
+            "integers": integer,
+            "exact": f"{integer} AND TRY_CAST({text} AS BIGINT) IS NOT NULL",
+            "whole": f"isfinite({number}) AND {number} = floor({number}) AND abs({number}) < 9.223372036854776e18",
+            "infinite": f"isinf({number})",
+            "booleans": f"{text} IN ({', '.join(map(literal, BOOLEAN_VALUES))})",
+        }
+        cells = (f"SELECT uds3_column, {text}, count(*) AS cells FROM (UNPIVOT (SELECT {', '.join(map(quote, usecols))} "
+                 f"FROM {source}) ON COLUMNS(*) INTO NAME uds3_column VALUE {text}) GROUP BY ALL")
+        query = (f"SELECT uds3_column, " + ", ".join(f"coalesce(sum(cells) FILTER ({condition}), 0)" for condition in counts.values())
+                 + f" FROM ({cells}) GROUP BY uds3_column")
+        for col, *values in con.execute(query).fetchall():
+            stats[col] = dict(zip(counts, values))
+        return [dict(stats[col], rows=rows) for col in usecols], rows
+
+    def migrate_file(self, uds3_data_path, data_order_path, output_file, batch_rows=None, output_format="csv"):
+        """
+        Migrate a UDS3 CSV or Parquet export with DuckDB doing the scan, typing and column-wise rules.
+
+        One SELECT projects the referenced UDS3 columns, types them as a pandas read of the whole export
+        would and adds the SQL-compiled rules.  Its result is fetched in batches of `batch_rows` rows, each
+        batch runs through the remaining rules and data_crosscheck, and the batches are written by save_parts.
+        As in the chunked mode, the structured math guards, the output columns and the rendering of whole
+        numbers are decided on the whole export, so the output is the one a pandas run writes.
+
+        Returns:
+            int: The number of rows migrated.
+
+        Raises:
+            ValueError: A column pandas would read as booleans or as integers beyond int64.
+        """
+        batch_rows = batch_rows or self.batch_rows
+        read_options = self.read_options(uds3_data_path)
+        usecols, schema = read_options["usecols"], read_options["dtype"]
+        header = self.header(uds3_data_path)
+        source = scan_source(uds3_data_path, header)
+
+        with self.connect() as con:
+            stats, rows = self.scan_types(con, source, usecols)
+            types = {col: column_type(col_stats, schema.get(col)) for col, col_stats in zip(usecols, stats)}
+
+            # Schema columns the data does not fit make pandas drop the schema and infer every column
+            misfit = [col for col in schema if types[col] is None]
+            if misfit:
+                print(f"UDS3 data does not match the dictionary dtypes (e.g. column {misfit[0]}), reading with inferred types")
+                types = {col: column_type(col_stats, None) for col, col_stats in zip(usecols, stats)}
+            unsupported = [col for col, kind in types.items() if kind is None]
+            if unsupported:
+                raise ValueError(f"--engine duckdb cannot type columns {unsupported} as pandas does "
+                                 f"(booleans or integers beyond int64), migrate them with --engine pandas")
+            for col in [col for col, kind in types.items() if kind == 'float64']:
+                print(f"Skipping column '{col.lower()}' due to non-integer values.")
+
+            # Batches start on a parser block when a column mixes text and numbers
+            block_rows = parser_block_rows(len(header))
+            if 'mixed' in types.values() and not is_parquet(uds3_data_path):
+                batch_rows = -(-batch_rows // block_rows) * block_rows
+            self.check_memory("scan")
+
+            # Typed UDS3 columns, then the column-wise rules over them
+            typed = []
+            for i, col in enumerate(usecols):
+                text, kind = quote(col), types[col]
+                number = f"TRY_CAST({text} AS DOUBLE)"
+                if kind in ('text', 'mixed'):
+                    typed.append(f"{text} AS c{i}")
+                elif kind == 'int64':
+                    typed.append(f"TRY_CAST({text} AS BIGINT) AS c{i}")
+                elif kind in ('whole', 'Int64'):
+                    typed.append(f"CASE WHEN isinf({number}) THEN NULL ELSE CAST({number} AS BIGINT) END AS c{i}")
+                else:
+                    typed.append(f"CASE WHEN isinf({number}) THEN NULL ELSE {number} END AS c{i}")
+
+            # The rules read the values before format_uds3, so the zero-padded pdx codes and float text stay in pandas
+            references = {col.lower(): f"c{i}" for i, col in reversed(list(enumerate(usecols)))}
+            kinds = {col.lower(): types[col] for col in reversed(usecols)}
+            usable = {col: kinds[col] not in ('float64', 'mixed') and col not in PDX_COLUMNS for col in references}
+            integer = {col for col, kind in kinds.items() if kind in ('int64', 'whole', 'Int64')}
+            expressions = self.rule_expressions(SqlRules(references, integer), usable)
+            int_columns = {col for col, kind in kinds.items() if kind == 'Int64'}
+
+            typed_sql = f"WITH typed AS (SELECT {', '.join(typed)} FROM {source}) SELECT "
+            sql = (typed_sql + ", ".join([f"c{i}" for i in range(len(usecols))]
+                                         + [f"{expr} AS r{j}" for j, (_, expr) in enumerate(expressions)]) + " FROM typed")
+            print(f"UDS3_data has {rows} rows, {len(expressions)} rules run in DuckDB, streaming batches of {batch_rows} rows")
+
+            def frames(query, selected):
+                # The batches of a query as pandas frames of the selected UDS3 columns (its first columns)
+                done = 0
+                for batch in con.execute(query).to_arrow_reader(batch_rows):
+                    columns = {}
+                    for j, col in enumerate(selected):
+                        array, kind = batch.column(j), types[col]
+                        if kind == 'text':
+                            columns[col] = text_values(array)
+                        elif kind == 'mixed':
+                            columns[col] = text_values(array) if is_parquet(uds3_data_path) else parse_blocks(text_values(array), block_rows)
+                        elif kind == 'Int64':
+                            missing = array.is_null().to_numpy(zero_copy_only=False)
+                            values = array.fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+                            columns[col] = pd.arrays.IntegerArray(values, missing)
+                        elif kind == 'float64':
+                            columns[col] = array.to_numpy(zero_copy_only=False).astype(np.float64)
+                        else:
+                            columns[col] = array.to_numpy(zero_copy_only=False).astype(np.int64)
+                    yield batch, pd.DataFrame(columns, index=pd.RangeIndex(done, done + batch.num_rows))
+                    done += batch.num_rows
+
+            # The structured math guards of the whole export, from a scan of the columns they use
+            guards = {}
+            selected = [(i, col) for i, col in enumerate(usecols) if col.lower() in guard_columns(self.plan)]
+            if selected:
+                query = typed_sql + ", ".join(f"c{i}" for i, _ in selected) + " FROM typed"
+                for _, nacc in frames(query, [col for _, col in selected]):
+                    guards = math_guards(format_uds3(nacc, int_columns), self.plan, guards)
+
+            def batches():
+                done = 0
+                for i, (batch, nacc) in enumerate(frames(sql, usecols)):
+                    precomputed = {name: pd.Series(text_values(batch.column(len(usecols) + j)), index=nacc.index, dtype=object)
+                                   for j, (name, _) in enumerate(expressions)}
+                    self.check_memory("read")
+                    yield self.transform(nacc, int_columns, verbose=False, precomputed=precomputed, guards=guards)
+                    done += batch.num_rows
+                    print(f"  Batch {i + 1}: {done} of {rows} rows migrated")
+
+            save_parts(batches(), self, data_order_path, output_file, output_format)
+
+        return rows
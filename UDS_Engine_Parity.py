@@ -0,0 +1,295 @@
+import os, sys
+import io
+import argparse
+import contextlib
+import tempfile
+import warnings
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import UDS_Crosswalk_Parser as parser
+from UDS_Benchmark import column_profiles, generate_uds3
+from UDS_Crosswalk_Service import CSV_TYPE, CrosswalkService
+
+
+# Parity check shared by every --engine backend: each backend migrates the same UDS3 exports, in one run and in
+# small parts, and its output must match the pandas engine byte for byte (test_engine_parity.py runs it as a test).  Exports are given on the command line or generated from the
+# dictionaries like the benchmark data, once clean and once with edge-case text injected into the cells.
+
+# Cell values that stress the text rules: missing spellings, padded and non-canonical numbers, empty text
+EDGE_TEXTS = ["NA", "na", "nan", "<NA>", "None", "null", " 1", "1.0", "-0", "01", "Other text", "OTHER", "ñandú"]
+EDGE_COLUMN_RATE = 0.25
+EDGE_CELL_RATE = 0.05
+# (rows, seed) of the changed rows migrated incrementally, a few rows decide frame-wide rules unlike the full export
+CHANGED_ROWS = [(1, 0), (1, 1), (2, 0), (2, 1), (2, 2)]
+# Rows per chunk (--chunksize, DuckDB batches) and processes (--workers) of the runs migrating an export in parts,
+# small so an export is split in many parts that each see only some of its rows
+PART_ROWS = 100
+WORKERS = 8
+# Seeds of the requests sent to the service at once, the number of requests per seed and the rows of the
+# same-shaped requests
+SERVICE_SEEDS = [0, 1, 2]
+SERVICE_REQUESTS = 8
+SERVICE_ROWS = 20
+
+
+def inject_edges(uds3_df, numeric_columns, seed=0):
+    # A share of the columns gets edge-case text in a share of its cells, such columns are read back as text;
+    # numeric_columns are left alone (the pdx codes are zero-padded as numbers, pipe-merge pairs fill one from the other)
+    rng = np.random.default_rng(seed)
+    uds3_df = uds3_df.copy()
+    columns = uds3_df.columns[rng.random(len(uds3_df.columns)) < EDGE_COLUMN_RATE]
+    for col in [col for col in columns if col not in numeric_columns]:
+        cells = rng.random(len(uds3_df)) < EDGE_CELL_RATE
+        values = uds3_df[col].astype(object)
+        values[cells] = rng.choice(np.array(EDGE_TEXTS, dtype=object), int(cells.sum()))
+        uds3_df[col] = values
+    return uds3_df
+
+
+def numeric_sources(plan, profiles):
+    """
+    UDS3 columns that must stay numeric in a REDCap export: the pdx codes, MAX( columns, pipe-merge pairs
+    and the sources of UDS4 columns several rules write, which are filled from one another.
+    """
+    rules = list(plan.rules())
+    writers = Counter(rule.uds4_var for rule in rules)
+    columns = {col for col in profiles if col.endswith("pdx") or col.endswith("prdx")}
+    for rule in rules:
+        columns.update(rule.merge_columns or [])
+        columns.update(rule.max_columns or [])
+        if writers[rule.uds4_var] > 1:
+            columns.add(rule.uds3_var)
+    return columns
+
+
+def synthetic_exports(json_folder_path, plan, rows, seeds, work_dir):
+    # Generated UDS3 exports, a clean one and one with edge-case text per seed, written to work_dir
+    profiles = column_profiles(json_folder_path, plan)
+    merge_primaries = {rule.merge_columns[0] for rule in plan.rules() if rule.merge_columns}
+    numeric_columns = numeric_sources(plan, profiles)
+    csv_paths = []
+    for seed in seeds:
+        uds3_df = generate_uds3(profiles, merge_primaries, rows, seed)
+        for label, data in [("clean", uds3_df), ("edges", inject_edges(uds3_df, numeric_columns, seed))]:
+            csv_path = os.path.join(work_dir, f"synthetic_{label}_{rows}_{seed}.csv")
+            data.to_csv(csv_path, index=False)
+            csv_paths.append(csv_path)
+    return csv_paths
+
+
+def migrate(csv_path, engine, data_order_path, output_file, mode=None):
+    # One migration as the command line runs it, returns the output bytes or the error it stopped with; backends
+    # that read the file themselves (DuckDB) run their own pipeline.  mode 'chunksize' streams the export in chunks
+    # (DuckDB batches) of PART_ROWS rows, 'workers' splits it across WORKERS processes
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if hasattr(engine, "migrate_file"):
+                engine.migrate_file(csv_path, data_order_path, output_file, PART_ROWS if mode == "chunksize" else None)
+            elif mode == "chunksize":
+                parser.migrate_in_chunks(csv_path, engine, data_order_path, output_file, PART_ROWS)
+            else:
+                if mode == "workers":
+                    final_df = parser.migrate_in_parallel(csv_path, engine, WORKERS)
+                else:
+                    nacc = parser.read_uds3_csv(csv_path, engine.read_options(csv_path, verbose=False), verbose=False)
+                    final_df = engine.transform(nacc, verbose=False)
+                parser.process_and_save_data(data_order_path, final_df, output_file)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    with open(output_file, 'rb') as f:
+        return f.read()
+
+
+def migrate_changed(csv_path, engine, data_order_path, output_file, rows=2, seed=0):
+    # --incremental run after an earlier run over a version of the export where a few rows held other rows' values
+    # (keys kept): only those rows are migrated again, merged with the copied ones it must match a full run
+    uds3_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    rng = np.random.default_rng(seed)
+    changed = rng.choice(len(uds3_df), size=min(rows, len(uds3_df)), replace=False)
+    values = [col for col in uds3_df.columns if col.lower() not in parser.INCREMENTAL_KEYS]
+    earlier = uds3_df.copy()
+    earlier.loc[changed, values] = uds3_df.loc[rng.choice(len(uds3_df), size=len(changed)), values].to_numpy()
+    earlier_path = f"{os.path.splitext(output_file)[0]}.earlier.csv"
+    earlier.to_csv(earlier_path, index=False)
+
+    state_path = f"{os.path.splitext(output_file)[0]}.state.json"
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            parser.migrate_incrementally(earlier_path, engine, data_order_path, output_file, state_path)
+            parser.migrate_incrementally(csv_path, engine, data_order_path, output_file, state_path)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    with open(output_file, 'rb') as f:
+        return f.read()
+
+
+def serve_coalesced(csv_path, engine, data_order_path, seed=0, requests=SERVICE_REQUESTS):
+    # Requests sent to the service at once, one row of the export each with whole numbers taken from other rows so
+    # they are typed alike and migrated together; returns the outputs (or errors) of the requests migrated alone and coalesced
+    uds3_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    rng = np.random.default_rng(seed)
+    whole = uds3_df.apply(lambda values: values.str.fullmatch(r"-?\d+(\.0)?")).to_numpy()
+    row = int(rng.integers(len(uds3_df)))
+    bodies = []
+    for other in rng.integers(len(uds3_df), size=requests):
+        request = uds3_df.iloc[[row]].copy()
+        swap = whole[row] & whole[other] & (rng.random(uds3_df.shape[1]) < 0.5)
+        request.iloc[0, swap] = uds3_df.iloc[other, swap].to_numpy()
+        bodies.append(request.to_csv(index=False).encode("utf-8"))
+
+    return [serve(bodies, engine, data_order_path, window, requests)[0] for window in (0, 60)]
+
+
+def serve_same_shaped(csv_path, engine, data_order_path, seed=0, requests=SERVICE_REQUESTS, rows=SERVICE_ROWS):
+    # Requests sent to the service at once, the same block of rows of the export each with a few whole numbers
+    # blanked, so their integer columns differ only in gaps; returns the outputs (or errors) of the requests migrated
+    # alone and coalesced, and the number of transforms the coalesced requests took
+    uds3_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    rng = np.random.default_rng(seed)
+    block = uds3_df.iloc[:rows]
+    whole = block.apply(lambda values: values.str.fullmatch(r"-?\d+")).to_numpy()
+    bodies = []
+    for _ in range(requests):
+        request = block.copy()
+        blank = whole & (rng.random(block.shape) < 0.02)
+        request[blank] = ""
+        bodies.append(request.to_csv(index=False).encode("utf-8"))
+
+    alone, _ = serve(bodies, engine, data_order_path, 0, requests * rows)
+    coalesced, stats = serve(bodies, engine, data_order_path, 60, requests * rows)
+    return alone, coalesced, stats.batches
+
+
+def serve(bodies, engine, data_order_path, window, rows):
+    # Submit every body to a service at once, coalescing them all in one batch of `rows` rows when window > 0
+    service = CrosswalkService(engine, data_order_path, window=window, max_rows=rows)
+    with contextlib.redirect_stdout(io.StringIO()):
+        futures = [service.batches.submit(service.read_payload(body, CSV_TYPE)) for body in bodies]
+    results = []
+    for future in futures:
+        try:
+            results.append(service.render(future.result(), CSV_TYPE))
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    return results, service.stats
+
+
+def first_difference(expected_file, actual_file):
+    # Name the first column whose text differs, for the report
+    expected = pd.read_csv(expected_file, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    actual = pd.read_csv(actual_file, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    if not expected.columns.equals(actual.columns) or len(expected) != len(actual):
+        return f"columns or rows differ ({expected.shape} vs {actual.shape})"
+    for col in expected.columns:
+        differs = expected[col] != actual[col]
+        if differs.any():
+            row = int(np.flatnonzero(differs.to_numpy())[0])
+            return f"column {col}, row {row}: {expected[col].iloc[row]!r} vs {actual[col].iloc[row]!r}"
+    return "same text, different bytes"
+
+
+def parity_outputs(csv_path, engines, data_order_path, work_dir):
+    """
+    Migrate an export with every backend, in one run and in small chunks (pandas also across worker processes),
+    and incrementally after a few rows changed.
+
+    Returns:
+        dict: Run name -> (output file, output bytes or the error the run stopped with), 'pandas' is the reference.
+    """
+    outputs = {}
+    export = os.path.splitext(os.path.basename(csv_path))[0]
+    for name, engine in engines.items():
+        # Every backend also streams the export in small chunks, pandas splits it across worker processes too;
+        # the parts decide nothing on their own rows, so the output must be the same
+        modes = {name: None, f"{name} --chunksize {PART_ROWS}": "chunksize"}
+        if name == "pandas":
+            modes[f"pandas --workers {WORKERS}"] = "workers"
+        for label, mode in modes.items():
+            output_file = os.path.join(work_dir, f"{export}.{name}{f'_{mode}' if mode else ''}.csv")
+            outputs[label] = (output_file, migrate(csv_path, engine, data_order_path, output_file, mode))
+
+    # Rows migrated apart from the rest must come out as in the full run
+    for rows, seed in CHANGED_ROWS:
+        output_file = os.path.join(work_dir, f"{export}.incremental_{rows}_{seed}.csv")
+        outputs[f"pandas --incremental ({rows} changed rows, seed {seed})"] = (
+            output_file, migrate_changed(csv_path, engines["pandas"], data_order_path, output_file, rows, seed))
+    return outputs
+
+
+def check_parity(csv_paths, engines, data_order_path, work_dir):
+    """
+    Migrate every export as parity_outputs does and compare the outputs with the pandas engine, then compare
+    requests the service coalesces with the same requests migrated alone.
+
+    Args:
+        csv_paths (list): UDS3 CSV files.
+        engines (dict): Backend name -> engine, 'pandas' is the reference.
+        data_order_path (str): The UDS4 data order file.
+        work_dir (str): Folder for the outputs.
+
+    Returns:
+        int: The number of (export, backend) pairs whose output differs.
+    """
+    failures = 0
+    for csv_path in csv_paths:
+        outputs = parity_outputs(csv_path, engines, data_order_path, work_dir)
+        reference_file, reference = outputs["pandas"]
+        for name, (output_file, output) in outputs.items():
+            if name == "pandas":
+                continue
+            if output == reference:
+                print(f"{os.path.basename(csv_path)}: {name} IDENTICAL" +
+                      (f" (both stop with {reference})" if isinstance(reference, str) else ""))
+            else:
+                failures += 1
+                difference = (f"{reference!r} vs {output!r}" if isinstance(reference, str) or isinstance(output, str)
+                              else first_difference(reference_file, output_file))
+                print(f"{os.path.basename(csv_path)}: {name} DIFFERS - {difference}")
+
+        # Requests the service migrates together must get the output each gets alone
+        for seed in SERVICE_SEEDS:
+            alone, coalesced = serve_coalesced(csv_path, engines["pandas"], data_order_path, seed)
+            name = f"service coalescing ({SERVICE_REQUESTS} requests, seed {seed})"
+            if coalesced == alone:
+                print(f"{os.path.basename(csv_path)}: {name} IDENTICAL")
+            else:
+                failures += 1
+                print(f"{os.path.basename(csv_path)}: {name} DIFFERS from the requests migrated alone")
+    return failures
+
+
+########################### Main Process #############################################
+
+if __name__ == "__main__":
+
+    # Ignore all warnings
+    warnings.filterwarnings("ignore")
+
+    arg_parser = argparse.ArgumentParser(description="Check that every crosswalk backend writes the same output as pandas")
+    arg_parser.add_argument("json_folder_path", nargs="?", default="./Crosswalk")
+    arg_parser.add_argument("data_order_path", nargs="?", default="./UDS4Data_ColumnOrder.txt")
+    arg_parser.add_argument("--csv", nargs="+", default=[], help="UDS3 exports to check, besides the synthetic ones")
+    arg_parser.add_argument("--rows", type=int, default=2000, help="Rows of the synthetic exports, 0 skips them")
+    arg_parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1])
+    arg_parser.add_argument("--engines", nargs="+", default=[name for name in parser.ENGINES if name != "pandas"],
+                            choices=[name for name in parser.ENGINES if name != "pandas"])
+    args = arg_parser.parse_args()
+
+    engines = {"pandas": parser.CrosswalkEngine.from_folder(args.json_folder_path)}
+    for name in args.engines:
+        try:
+            engines[name] = parser.engine_class(name)(engines["pandas"].plan)
+        except ImportError as e:
+            print(f"Skipping --engine {name}, the {e.name} package is not installed")
+
+    with tempfile.TemporaryDirectory(prefix="uds_parity_") as work_dir:
+        csv_paths = list(args.csv)
+        if args.rows:
+            csv_paths += synthetic_exports(args.json_folder_path, engines["pandas"].plan, args.rows, args.seeds, work_dir)
+
+        failures = check_parity(csv_paths, engines, args.data_order_path, work_dir)
+
+    print(f"{failures} differing outputs" if failures else "Every backend matches the pandas engine")
+    sys.exit(1 if failures else 0)
@@ -1,15 +1,21 @@
-import os,sys
+import os
+import argparse
 import pandas as pd
+import numpy as np
 import json
 import re
+import hashlib
 from datetime import datetime
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
+from UDS_Rule_Compiler import BUNDLE_NAME, build_bundle
 
-# Define the folder containing the files, default to ./Crosswalk
-if len(sys.argv) > 1 and sys.argv[1].strip():
-    folder_path = sys.argv[1]  # Use the provided argument
-else:
-    folder_path = "./Crosswalk" 
+
+# Version of the generated JSON, bump it whenever a change here alters the output so the build manifest rebuilds every workbook
+MAKER_VERSION = "1"
+# Build manifest kept in the workbook folder, not named .json so the parser never loads it as rules
+MANIFEST_NAME = ".json_maker.manifest"
 
 
 ## FUNCTION DEFINITIONS
@@ -35,156 +41,352 @@ def clean_text(obj):
 
 # Classification of the columns in the template mappings for JSON processing
 def classify_variable(df):
-    def classify(group):
-      # Direct mapping in UDS4/UDS3 column names ending with "X", with no change in their data types(e.g. free text fields like primlangx)
-        if group['uds4 data element'].str.endswith('X').all() and group['uds3 data element'].str.endswith('X').all() and group['data type change'].eq('No').all():
-            return 'direct'
-      # Special structured mappings and mergings
-        if group['special mapping'].isin(['Structured', 'Merging', 'Merging; Calculated field']).any():
-            return 'sp'
-      # Conditional consistency for non-mergings on calculated fields
-        elif group['special mapping'].isin(['Calculated field']).any():
-            return 'cc'
-      # Special mappings catches using conformity
-        elif group['special mapping'].isna().all():
-          # If conformity or data type change exists, use conditional consistency
-            if group['conformity change'].eq('Yes').any() or group['data type change'].eq('Yes').any() or group['change in form'].eq('Yes').any():
-                return 'cc'
-          # If conformity change not in place for special mapping and the column names are the same in UDS4/UDS3, return direct mappings
-            elif group['uds4 data element'].iloc[0] == group['uds3 data element'].iloc[0]:
-                return 'direct'
-            else:
-                return 'cc'
-      # In all other cases, consider it as complex
-        else:
-            return 'complex'
+    """
+    Annotate the merged template mappings with the 'class' of each UDS4 variable.
+
+    Every predicate is computed for all rows at once and reduced per UDS4 variable with a
+    groupby all/any, instead of calling a Python function on each group.
+
+    Args:
+        df (DataFrame): Template mappings merged with the UDS4 dictionary, lower case columns.
+
+    Returns:
+        DataFrame: df with a 'class' column of 'direct', 'cc', 'sp' or 'complex'.
+    """
+    uds4_var = df['uds4 data element']
+    uds3_var = df['uds3 data element']
+    special = df['special mapping']
+
+    def group_all(mask):
+        return mask.groupby(uds4_var).all()
+
+    def group_any(mask):
+        return mask.groupby(uds4_var).any()
+
+  # Direct mapping in UDS4/UDS3 column names ending with "X", with no change in their data types(e.g. free text fields like primlangx)
+  # (non-text names are skipped, as Series.all skips the missing values .str gives them)
+    free_text = group_all(uds4_var.str.endswith('X').fillna(True).astype(bool)
+                          & uds3_var.str.endswith('X').fillna(True).astype(bool)
+                          & df['data type change'].eq('No'))
+  # Special structured mappings and mergings
+    structured = group_any(special.isin(['Structured', 'Merging', 'Merging; Calculated field']))
+  # Conditional consistency for non-mergings on calculated fields
+    calculated = group_any(special.isin(['Calculated field']))
+  # Special mappings catches using conformity, or data type change
+    no_special = group_all(special.isna())
+    changed = group_any(df['conformity change'].eq('Yes') | df['data type change'].eq('Yes') | df['change in form'].eq('Yes'))
+  # Column names the same in UDS4/UDS3 on the first row of the variable
+    first = df.drop_duplicates('uds4 data element')
+    same_name = pd.Series(first['uds4 data element'].to_numpy() == first['uds3 data element'].to_numpy(),
+                          index=first['uds4 data element']).reindex(free_text.index)
+
+  # First matching rule wins, in all other cases consider it as complex
+    classifications = pd.Series(np.select(
+        [free_text, structured, calculated, no_special & changed, no_special & same_name, no_special],
+        ['direct', 'sp', 'cc', 'cc', 'direct', 'cc'],
+        'complex'), index=free_text.index, dtype=object)
 
-    # Organize by UDS4 name, apply the classification grouping, and annotate the dataframe with new 'class' column
-    # Doing hard selection of column names to make sure the grouping column gets passed in pandas 3+
-    all_columns = df.columns.tolist()
-    classifications = df.groupby('uds4 data element')[all_columns].apply(classify)
+    # Annotate the dataframe with new 'class' column by UDS4 name
     df = df.merge(classifications.rename('class'), on='uds4 data element', how='left')
     return df
 
 
 # Function to categorize variables
 def categorize_variables(df):
-  # Initialize arrays by classification type
-    direct_mappings = []
-    conditional_consistency_mappings = []
-    structured_transformation_mappings = []
-    complex_mappings = []
-    
-    # For each UDS3 and UDS4 variable pair (allows for merging)
-    for (uds3_var, uds4_var), group in df.groupby(['uds3 data element', 'uds4 data element']):
-      
-      # Check class of the mapping 
-        variable_class = group['class'].iloc[0]
-      # Build common single mapping elements (UDS3 and UDS4 value, reversible from 3 to 4, any notes)
-        crosswalk_mappings = [
-            {
-                "mapping_type": row["mapping type"],
-                "mappings": [
-                    {
-                        "UDS3_value": row["uds3 value"],
-                        "UDS4_value": row["uds4 value"],
-                        "reversible": row["reversible to uds3"],
-                        "note": row.get("notes and discussion points", ""),
-                    }
-                ],
-            }
-          # Use iterrows to build and append this dictionary for each row
-            for _, row in group.iterrows()
-        ]
-
-      # Nest the mapping dictionary within the UDS3/UDS4 pairing
-        mapping_entry = {
-            "UDS3_variable": uds3_var,
-            "UDS4_variable": uds4_var,
-            "crosswalk_mappings": crosswalk_mappings,
+    """
+    Build the JSON mapping entries of every UDS3/UDS4 variable pair, organized by class.
+
+    Rows are ordered by their (UDS3, UDS4) group once and every mapping record is built from
+    whole columns, instead of a groupby loop calling iterrows on each group.
+
+    Args:
+        df (DataFrame): Classified template mappings from classify_variable.
+
+    Returns:
+        dict: Direct, conditional consistency, structured and complex mapping entries.
+    """
+  # For each UDS3 and UDS4 variable pair (allows for merging), in groupby order with rows in file order
+  # Pairs with a missing UDS3 or UDS4 name (group -1) are left out
+    pair = df.groupby(['uds3 data element', 'uds4 data element']).ngroup().to_numpy()
+    rows = np.flatnonzero(pair >= 0)
+    rows = rows[np.argsort(pair[rows], kind='stable')]
+    starts = np.flatnonzero(np.diff(pair[rows], prepend=-1))
+    ends = np.append(starts[1:], len(rows))
+
+  # Build common single mapping elements (UDS3 and UDS4 value, reversible from 3 to 4, any notes) for every row at once
+    def column(name):
+        return df[name].to_numpy(dtype=object)[rows].tolist() if name in df else [""] * len(rows)
+
+    crosswalk_mappings = [
+        {
+            "mapping_type": mapping_type,
+            "mappings": [
+                {
+                    "UDS3_value": uds3_value,
+                    "UDS4_value": uds4_value,
+                    "reversible": reversible,
+                    "note": note,
+                }
+            ],
         }
+        for mapping_type, uds3_value, uds4_value, reversible, note in zip(
+            column("mapping type"), column("uds3 value"), column("uds4 value"),
+            column("reversible to uds3"), column("notes and discussion points"))
+    ]
+
+  # Initialize arrays by classification type
+    all_mappings = {
+        "Direct_Mappings": [],
+        "Conditional_Consistency": [],
+        "Structured_Transformations": [],
+        "High_Complexity": [],
+    }
+    sections = {"direct": "Direct_Mappings", "cc": "Conditional_Consistency", "sp": "Structured_Transformations",
+                "complex": "High_Complexity"}
+    first_rows = rows[starts]
+    pairs = zip(df['uds3 data element'].to_numpy(dtype=object)[first_rows], df['uds4 data element'].to_numpy(dtype=object)[first_rows],
+                df['class'].to_numpy(dtype=object)[first_rows], starts, ends)
 
-      # Organize the built JSON pairing by the four classifications
-        if variable_class == "sp":
-            structured_transformation_mappings.append(mapping_entry)
-        elif variable_class == "cc":
-            conditional_consistency_mappings.append(mapping_entry)
-        elif variable_class == "complex":
-            complex_mappings.append(mapping_entry)
-        elif variable_class == "direct":
-                direct_mappings.append({
+  # Nest the mapping dictionary within the UDS3/UDS4 pairing and organize it by the four classifications
+    for uds3_var, uds4_var, variable_class, start, end in pairs:
+        if variable_class in sections:
+            all_mappings[sections[variable_class]].append({
                 "UDS3_variable": uds3_var,
                 "UDS4_variable": uds4_var,
-                "crosswalk_remappings": crosswalk_mappings,
+                "crosswalk_remappings" if variable_class == "direct" else "crosswalk_mappings": crosswalk_mappings[start:end],
             })
-            
-  # Final aggregation
-    all_mappings = {
-        "Direct_Mappings": direct_mappings,
-        "Conditional_Consistency": conditional_consistency_mappings,
-        "Structured_Transformations": structured_transformation_mappings,
-        "High_Complexity": complex_mappings,
-    }
     return all_mappings
 
 
+# pandas dtypes for the REDCap data types of the UDS3 dictionaries
+text_types = ['Character', 'Character factor']
+number_types = ['Numeric factor', 'Entry integer', 'Number with factor']
 
-## PRIMARY LOOP
 
-# Iterate over each UDS4 file in the folder from folder_path
-for file_name in os.listdir(folder_path):
-  
-  # Process file name
-    if file_name.endswith('.xlsx'):  # Process only Excel files
-        file_path = os.path.join(folder_path, file_name)
-        print(f"Processing file: {file_name}")
-
-      # Load data from the Excel file according to sheet
-      # Regexes for the table specific
-        uds3_pattern = re.compile(r'.*? UDS3 REDCap')
-        uds4_pattern = re.compile(r'.*? UDS4 REDCap')
-      # Get the sheet names
-        excel_file = pd.ExcelFile(file_path)
-        sheet_names = excel_file.sheet_names
+# Build the dtype schema the parser passes to the CSV reader for the UDS3 data
+def build_uds3_schema(uds3_rdcp):
+    schema = {}
+    for name, data_type, conformity, levels in uds3_rdcp[['uds3 data element name', 'data type', 'conformity', 'response levels']].itertuples(index=False):
+        if data_type in text_types:
+            dtype = 'str'
+      # Numeric fields whose conformity or levels allow decimals (e.g. FORMVER 3.1, CDR 0.5) are read as floats
+        elif data_type in number_types:
+            dtype = 'float64' if re.search(r'\d\.\d', f"{conformity} {levels}") else 'Int64'
+        else:
+            continue
+
+        name = str(name).strip().lower()
+      # Repeating family members are listed once with ### for the member number, other repeating fields are skipped
+        if name.startswith(('kid###', 'sib###')):
+            for i in range(1, 16 if name.startswith('kid') else 21):
+                schema[name.replace('###', str(i))] = dtype
+        elif '#' not in name:
+            schema[name] = dtype
+    return schema
+
+
+# Regexes for the dictionary sheets of each workbook
+uds3_pattern = re.compile(r'.*? UDS3 REDCap')
+uds4_pattern = re.compile(r'.*? UDS4 REDCap')
+# Simple hard name call for the templated mapping rules for processing
+template_sheet = 'Template Mappings REDCap'
+
+
+# Read the three sheets the JSON files are built from, opening and parsing the workbook once
+def read_workbook(file_path):
+    """
+    Read the template mappings and the UDS3/UDS4 REDCap dictionaries of a crosswalk workbook.
+
+    The workbook is opened once, read only, and only the three needed sheets are parsed.
+
+    Args:
+        file_path (str): Path to the crosswalk xlsx.
+
+    Returns:
+        tuple: The template mappings, UDS3 dictionary and UDS4 dictionary DataFrames.
+    """
+    with pd.ExcelFile(file_path, engine='openpyxl') as excel_file:
       # Get the regex matches for UDS3 and UDS4 dictionaries
+        sheet_names = excel_file.sheet_names
         uds3_sheet = [name for name in sheet_names if uds3_pattern.match(name)][0]
         uds4_sheet = [name for name in sheet_names if uds4_pattern.match(name)][0]
-      # Read in the dictionaries
-        uds3_rdcp = pd.read_excel(file_path, sheet_name=uds3_sheet, header=1)  # UDS3 REDCap dictionary
-        uds4_rdcp = pd.read_excel(file_path, sheet_name=uds4_sheet, header=1)  # UDS4 REDCap dictionary
-      # Simple hard name call for the templated mapping rules for processing
-        df = pd.read_excel(file_path, sheet_name='Template Mappings REDCap', header=1)
-
-      # Clean, lower, and rename columns
-        df.columns = df.columns.str.lower()
-        uds4_rdcp.columns = uds4_rdcp.columns.str.lower()
-        uds3_rdcp.columns = uds3_rdcp.columns.str.lower()
-        uds4_rdcp = uds4_rdcp.iloc[:, :12]
-        uds4_rdcp.rename(columns={"uds4 data element name": "uds4 data element"}, inplace=True)
-
-      # Merge template mappings with UDS4 dictionary
-        test = pd.merge(df, uds4_rdcp, on='uds4 data element')
-
-      # Apply classification and categorization of variable pairings
-        result = classify_variable(test)
-      # Ignore any variables that are missing a UDS3/UDS4 neighbor
-        result['uds3 value'] = result['uds3 value'].where(result['uds3 value'].notnull(), None)
-        result['uds4 value'] = result['uds4 value'].where(result['uds4 value'].notnull(), None)
-      # Fill in notes and reversible fields with NA as needed
-        result['notes and discussion points'] = result['notes and discussion points'].fillna("NA")
-        result['reversible to uds3'] = result['reversible to uds3'].fillna("NA")
-      # Recast <BLANK> REDCap LABELS as empty strings
-        result.loc[result['uds4 value'] == "<BLANK>", 'uds4 value'] = ""
-
-      # Apply the primary categorization and JSON-esque dictionary building function
-        all_mappings = categorize_variables(result)
-      # Clean text as described and format as JSON files
-        all_mappings = clean_text(all_mappings)
-        all_mappings = json.dumps(all_mappings, ensure_ascii=False, indent=4,default=json_serializer)
-
-      # Save output to JSON
-        output_path = os.path.join(folder_path, f"{os.path.splitext(file_name)[0]}_mappings.json")
-        with open(output_path, 'w', encoding='utf-8') as json_file:
-            json_file.write(all_mappings)
-      # Sanity tracker
-        print(f"Processed and saved: {output_path}")
+      # Read in the dictionaries and the mappings
+        uds3_rdcp = excel_file.parse(sheet_name=uds3_sheet, header=1)  # UDS3 REDCap dictionary
+        uds4_rdcp = excel_file.parse(sheet_name=uds4_sheet, header=1)  # UDS4 REDCap dictionary
+        df = excel_file.parse(sheet_name=template_sheet, header=1)
+    return df, uds3_rdcp, uds4_rdcp
+
+
+# Build the mappings and UDS3 schema JSON files of one workbook
+def compile_workbook(folder_path, file_name):
+    """
+    Compile one crosswalk workbook into its _mappings.json and _uds3_schema.json files.
+
+    Workbooks are independent of each other, so this runs in a worker process per workbook.
+
+    Args:
+        folder_path (str): Folder holding the workbook, the JSON files are written next to it.
+        file_name (str): The workbook's file name.
+
+    Returns:
+        list: (path, content hash, rewritten) of each JSON file.
+    """
+    file_path = os.path.join(folder_path, file_name)
+    df, uds3_rdcp, uds4_rdcp = read_workbook(file_path)
+
+  # Clean, lower, and rename columns
+    df.columns = df.columns.str.lower()
+    uds4_rdcp.columns = uds4_rdcp.columns.str.lower()
+    uds3_rdcp.columns = uds3_rdcp.columns.str.lower()
+    uds4_rdcp = uds4_rdcp.iloc[:, :12]
+    uds4_rdcp.rename(columns={"uds4 data element name": "uds4 data element"}, inplace=True)
+
+  # Merge template mappings with UDS4 dictionary
+    test = pd.merge(df, uds4_rdcp, on='uds4 data element')
+
+  # Apply classification and categorization of variable pairings
+    result = classify_variable(test)
+  # Ignore any variables that are missing a UDS3/UDS4 neighbor
+    result['uds3 value'] = result['uds3 value'].where(result['uds3 value'].notnull(), None)
+    result['uds4 value'] = result['uds4 value'].where(result['uds4 value'].notnull(), None)
+  # Fill in notes and reversible fields with NA as needed
+    result['notes and discussion points'] = result['notes and discussion points'].fillna("NA")
+    result['reversible to uds3'] = result['reversible to uds3'].fillna("NA")
+  # Recast <BLANK> REDCap LABELS as empty strings
+    result.loc[result['uds4 value'] == "<BLANK>", 'uds4 value'] = ""
+
+  # Apply the primary categorization and JSON-esque dictionary building function
+    all_mappings = categorize_variables(result)
+  # Clean text as described and format as JSON files
+    all_mappings = clean_text(all_mappings)
+    all_mappings = json.dumps(all_mappings, ensure_ascii=False, indent=4,default=json_serializer)
+
+  # Save output to JSON
+    output_path = os.path.join(folder_path, f"{os.path.splitext(file_name)[0]}_mappings.json")
+  # Save the UDS3 dtype schema next to the mappings
+    schema_path = os.path.join(folder_path, f"{os.path.splitext(file_name)[0]}_uds3_schema.json")
+    schema = json.dumps(build_uds3_schema(uds3_rdcp), indent=4)
+
+  # Only files whose content changed are rewritten
+    return [(path, text_sha256(text), write_if_changed(path, text))
+            for path, text in [(output_path, all_mappings), (schema_path, schema)]]
+
+
+# Build manifest: the content hash of every workbook and of the JSON files built from it
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    # Line endings are ignored, the committed mappings are CRLF while they are generated with LF
+    return hashlib.sha256(text.replace('\r\n', '\n').encode('utf-8')).hexdigest()
+
+
+def write_if_changed(path, text):
+    # Leave a file untouched (and its modification time alone) when it already holds this content
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            if f.read().replace('\r\n', '\n') == text:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return True
+
+
+def load_manifest(folder_path):
+    # Previous builds, empty when missing, unreadable or made by another version of the maker
+    try:
+        with open(os.path.join(folder_path, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MAKER_VERSION:
+            return manifest["workbooks"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_manifest(folder_path, workbooks):
+    # Written to a temporary file first so an interrupted build never leaves a partial manifest
+    manifest_path = os.path.join(folder_path, MANIFEST_NAME)
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": MAKER_VERSION, "workbooks": workbooks}, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+
+def is_current(folder_path, entry, workbook_sha256):
+    # Built from this exact workbook, and every JSON file built from it is still there unchanged
+    if not entry or entry.get("sha256") != workbook_sha256:
+        return False
+    for output_name, output_sha256 in entry.get("outputs", {}).items():
+        try:
+            with open(os.path.join(folder_path, output_name), 'r', encoding='utf-8', newline='') as f:
+                if text_sha256(f.read()) != output_sha256:
+                    return False
+        except (OSError, UnicodeDecodeError):
+            return False
+    return True
+
+
+## PRIMARY LOOP
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Build the crosswalk JSON files from the UDS4 crosswalk workbooks")
+    arg_parser.add_argument("folder_path", nargs="?", default="", help="Folder of crosswalk workbooks, default ./Crosswalk")
+    arg_parser.add_argument("--workers", type=int, default=None,
+                            help="Workbooks compiled in parallel, default one per CPU (1 compiles them in this process)")
+    arg_parser.add_argument("--force", action="store_true", help="Rebuild every workbook, ignoring the build manifest")
+    args = arg_parser.parse_args()
+
+  # Define the folder containing the files, default to ./Crosswalk
+    folder_path = args.folder_path if args.folder_path.strip() else "./Crosswalk"
+
+  # Every UDS4 Excel file in the folder from folder_path, sorted so builds always run in the same order
+    file_names = sorted(file_name for file_name in os.listdir(folder_path) if file_name.endswith('.xlsx'))
+
+  # Only workbooks that changed since the last build (or whose JSON files did) are compiled
+    previous = {} if args.force else load_manifest(folder_path)
+    hashes = {file_name: file_sha256(os.path.join(folder_path, file_name)) for file_name in file_names}
+    stale = [file_name for file_name in file_names if not is_current(folder_path, previous.get(file_name), hashes[file_name])]
+    workbooks = {file_name: previous[file_name] for file_name in file_names if file_name not in stale}
+    for file_name in workbooks:
+        print(f"Up to date: {file_name}")
+
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(stale)))
+
+  # Workbooks are compiled independently, results are reported in folder order
+    try:
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+            compile_all = executor.map if executor else map
+            for file_name, outputs in zip(stale, compile_all(compile_workbook, [folder_path] * len(stale), stale)):
+                print(f"Processing file: {file_name}")
+              # Sanity tracker
+                for output_path, _, rewritten in outputs:
+                    print(f"{'Processed and saved' if rewritten else 'Processed, unchanged'}: {output_path}")
+                workbooks[file_name] = {
+                    "sha256": hashes[file_name],
+                    "outputs": {os.path.basename(output_path): output_sha256 for output_path, output_sha256, _ in outputs},
+                }
+    finally:
+      # Record whatever was built, even when a later workbook fails
+        save_manifest(folder_path, dict(sorted(workbooks.items())))
+
+  # Compact execution-only bundle of every JSON file in the folder, loaded by the parser instead of the pretty JSON
+    bundle_path = os.path.join(folder_path, BUNDLE_NAME)
+    bundle = build_bundle(folder_path)
+    try:
+        with open(bundle_path, 'rb') as f:
+            rewritten = f.read() != bundle
+    except OSError:
+        rewritten = True
+    if rewritten:
+        with open(bundle_path, 'wb') as f:
+            f.write(bundle)
+    print(f"{'Processed and saved' if rewritten else 'Processed, unchanged'}: {bundle_path}")
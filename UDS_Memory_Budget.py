@@ -0,0 +1,105 @@
+import os
+import sys
+
+
+# Memory budget of a migration (--max-memory): an estimate checked before any data is read, and the process
+# memory checked after every stage so a run over budget stops with a clear message instead of being OOM-killed.
+
+# Peak bytes over the baseline per projected UDS3 cell, measured on real and synthetic exports: the CSV parse
+# takes about 43 B per cell, the UDS3/UDS4 frames and the CSV writer about 36 B per input and per output cell
+BYTES_PER_CELL = 72
+
+
+def peak_memory_mb():
+    # Peak resident set size of the process, None where the resource module is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def current_memory_mb():
+    # Resident set size now, from /proc on Linux, otherwise the peak so far
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError, IndexError):
+        return peak_memory_mb()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """The migration would need, or already took, more memory than --max-memory allows."""
+
+
+class MemoryBudget:
+    """
+    Per-stage resident memory of a migration, checked against a limit.
+
+    Every stage records the resident memory when it ends and the process peak up to then, summed
+    over chunks as the largest value seen.
+
+    Args:
+        limit_mb (float): The --max-memory budget in MB.
+    """
+
+    def __init__(self, limit_mb):
+        self.limit_mb = limit_mb
+        self.stages = {}
+
+    def estimate_mb(self, rows, columns):
+        # Expected peak of migrating `rows` rows of `columns` projected UDS3 columns, from the current baseline
+        return (current_memory_mb() or 0) + rows * columns * BYTES_PER_CELL / 1024 ** 2
+
+    def preflight(self, rows, columns, chunksize=None):
+        """
+        Fail before any data is read when the estimated peak does not fit the budget.
+
+        Args:
+            rows (int): Rows in the UDS3 export.
+            columns (int): UDS3 columns read, see uds3_read_options.
+            chunksize (int): Rows held at once in the chunked mode.
+
+        Raises:
+            MemoryBudgetExceeded: With the estimate and a chunk size that would fit.
+        """
+        held = min(rows, chunksize) if chunksize else rows
+        estimate = self.estimate_mb(held, columns)
+        if estimate <= self.limit_mb:
+            print(f"Estimated peak memory {estimate:.0f} MB for {held} rows x {columns} columns, "
+                  f"within the --max-memory budget of {self.limit_mb:.0f} MB")
+            return
+
+        baseline = current_memory_mb() or 0
+        fitting_rows = int((self.limit_mb - baseline) * 1024 ** 2 / (columns * BYTES_PER_CELL)) if columns else 0
+        advice = (f"run with --chunksize {fitting_rows} or less, or raise --max-memory" if fitting_rows >= 1 else
+                  f"the rules alone take about {baseline:.0f} MB, raise --max-memory")
+        raise MemoryBudgetExceeded(
+            f"Estimated peak memory of about {estimate:.0f} MB for {held} rows x {columns} columns exceeds the "
+            f"--max-memory budget of {self.limit_mb:.0f} MB: {advice}")
+
+    def check(self, stage):
+        """
+        Record the memory at the end of a stage and fail once the process went over the budget.
+
+        Raises:
+            MemoryBudgetExceeded: Naming the stage and the memory it reached.
+        """
+        rss, peak = current_memory_mb(), peak_memory_mb()
+        record = self.stages.setdefault(stage, {"calls": 0, "rss_mb": 0.0, "peak_mb": 0.0})
+        record["calls"] += 1
+        record["rss_mb"] = max(record["rss_mb"], rss or 0.0)
+        record["peak_mb"] = max(record["peak_mb"], peak or 0.0)
+
+        reached = max(rss or 0.0, peak or 0.0)
+        if reached > self.limit_mb:
+            raise MemoryBudgetExceeded(
+                f"Stopped after the {stage} stage: the process reached {reached:.0f} MB, over the --max-memory "
+                f"budget of {self.limit_mb:.0f} MB")
+
+    def report(self):
+        print(f"\nMemory by stage (--max-memory {self.limit_mb:.0f} MB)")
+        print(f"{'stage':<10} {'calls':>6} {'rss MB':>8} {'peak MB':>8}")
+        for stage, record in self.stages.items():
+            print(f"{stage:<10} {record['calls']:6d} {record['rss_mb']:8.0f} {record['peak_mb']:8.0f}")
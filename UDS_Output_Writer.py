@@ -0,0 +1,135 @@
+import os
+import pandas as pd
+
+
+# Output writers for the migrated UDS4 data.  Every writer receives frames that are already projected onto
+# the UDS4 column order with missing values written as 'NA', and can be fed one frame or many chunks.
+
+class OutputWriter:
+    extension = ""
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.rows = 0
+
+    def write(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvWriter(OutputWriter):
+    """
+    CSV output with 'NA' for missing values.
+
+    pandas' C writer is kept for CSV: pyarrow's CSV writer quotes every text field and formats
+    floats differently, which would change the bytes downstream REDCap imports see.
+    """
+    extension = ".csv"
+
+    def __init__(self, output_file, encoding='utf-8-sig'):
+        super().__init__(output_file)
+        self.encoding = encoding
+
+    def write(self, df):
+        # Chunks after the first are appended without a header or a second byte order mark
+        df.to_csv(self.output_file, index=False, na_rep="NA", encoding=self.encoding,
+                  mode='a' if self.rows else 'w', header=not self.rows)
+        self.rows += len(df)
+
+
+class ArrowWriter(OutputWriter):
+    """Base for the columnar targets, columns hold the CSV text with 'NA' stored as null."""
+
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self.writer = None
+
+    def open(self, schema):
+        raise NotImplementedError
+
+    def write(self, df):
+        table = to_arrow_table(df)
+        if self.writer is None:
+            self.writer = self.open(table.schema)
+        self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ParquetWriter(ArrowWriter):
+    extension = ".parquet"
+
+    def open(self, schema):
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(self.output_file, schema)
+
+
+class FeatherWriter(ArrowWriter):
+    extension = ".feather"
+
+    def open(self, schema):
+        # Feather V2 is the Arrow IPC file format, lz4 compressed like pyarrow.feather's default
+        import pyarrow as pa
+        compression = 'lz4' if pa.Codec.is_available('lz4') else None
+        return pa.ipc.new_file(self.output_file, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+
+OUTPUT_WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter, "feather": FeatherWriter}
+
+
+def to_arrow_table(df):
+    import pyarrow as pa
+
+    arrays = []
+    for col, values in df.items():
+        # Render to the same text the CSV holds, skipping columns that already are text
+        if pd.api.types.infer_dtype(values, skipna=False) != 'string':
+            values = values.astype(str)
+        arrays.append(pa.array(values.to_numpy(dtype=object), type=pa.string(), mask=(values == "NA").to_numpy()))
+
+    return pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+
+
+def open_writer(output_file, output_format="csv"):
+    """
+    Create the writer for an output format.
+
+    Args:
+        output_file (str): Path of the output file.
+        output_format (str): One of 'csv', 'parquet' or 'feather'.
+    """
+    if output_format not in OUTPUT_WRITERS:
+        raise ValueError(f"Unknown output format '{output_format}', use one of {list(OUTPUT_WRITERS)}")
+    return OUTPUT_WRITERS[output_format](output_file)
+
+
+def output_name(base_name, output_format="csv"):
+    # e.g. uds4_redcap_data_py -> uds4_redcap_data_py.parquet
+    return f"{os.path.splitext(base_name)[0]}{OUTPUT_WRITERS[output_format].extension}"
+
+
+def read_output(output_file, output_format="csv"):
+    """
+    Read a previous output back as text, with 'NA' for missing values, e.g. to merge new rows into it.
+
+    Args:
+        output_file (str): Path of the output file.
+        output_format (str): One of 'csv', 'parquet' or 'feather'.
+    """
+    if output_format == "csv":
+        return pd.read_csv(output_file, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+    if output_format == "parquet":
+        return pd.read_parquet(output_file).fillna("NA")
+    return pd.read_feather(output_file).fillna("NA")
@@ -0,0 +1,138 @@
+import operator
+from functools import reduce
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from UDS_Crosswalk_Parser import CrosswalkEngine, NA_SPELLINGS, column_rules, rule_inputs, text_column
+from UDS_Rule_Compiler import BoolOp, Missing
+
+
+# Polars execution backend (--engine polars).  The rules whose result only depends on the UDS3 columns they read
+# (see column_rules in UDS_Crosswalk_Parser.py) run as one lazy Polars select, evaluated in parallel across
+# columns.  Every other rule, and the order the columns are written in, stays with the pandas engine, so both
+# backends write byte-identical output.
+
+
+class PolarsRules:
+    """
+    Builds the Polars expressions of the selected rules over one UDS3 frame.
+
+    Args:
+        uds3_df (pd.DataFrame): The UDS3 data as formatted for the rules.
+    """
+
+    def __init__(self, uds3_df):
+        self.integer = {col for col in uds3_df.columns if pd.api.types.is_integer_dtype(uds3_df[col])}
+
+    def text(self, col):
+        # pandas astype(str)
+        if col in self.integer:
+            return pl.col(col).cast(pl.String).fill_null("<NA>")
+        return pl.col(col).fill_null("nan")
+
+    def equals(self, col, value):
+        # Rows whose text is exactly `value`, integer columns are compared as numbers
+        if col in self.integer:
+            if value == "<NA>":
+                return pl.col(col).is_null()
+            try:
+                number = int(value)
+            except ValueError:
+                return pl.lit(False)
+            if str(number) != value or abs(number) >= 2 ** 63:
+                return pl.lit(False)
+            return (pl.col(col) == number).fill_null(False)
+        if value == "nan":
+            return pl.col(col).is_null() | (pl.col(col) == value).fill_null(False)
+        return (pl.col(col) == value).fill_null(False)
+
+    def is_in(self, col, values):
+        return reduce(operator.or_, [self.equals(col, value) for value in dict.fromkeys(values)])
+
+    def condition(self, expression):
+        # Equals, Missing and BoolOp trees as CrosswalkRun.condition_mask evaluates them
+        if isinstance(expression, BoolOp):
+            return reduce(operator.or_ if expression.operator == "|" else operator.and_,
+                          [self.condition(operand) for operand in expression.operands])
+        if isinstance(expression, Missing):
+            col = pl.col(expression.col)
+            return col.is_null() if expression.col in self.integer else col.is_null() | col.is_in(NA_SPELLINGS).fill_null(False)
+        return self.equals(expression.col, expression.value)
+
+    def last_match(self, cases, otherwise):
+        # The output of the last matching (condition, value) case, Polars takes the first so they are reversed
+        cases = cases[::-1]
+        expression = pl.when(cases[0][0]).then(pl.lit(cases[0][1]))
+        for condition, value in cases[1:]:
+            expression = expression.when(condition).then(pl.lit(value))
+        return expression.otherwise(otherwise)
+
+    def levels(self, rule):
+        # Non-matching conformity: response levels, then grep() searches, then the unmapped UDS3 text
+        col = rule.uds3_var
+        cases = []
+        for uds3_value, uds4_value, values in rule.level_pairs:
+            if values is None:
+                cases.append((pl.col(col).is_null() if uds3_value == 'None' else self.equals(col, uds3_value), uds4_value))
+            elif not (col.endswith("sec") or col.endswith("ter")):
+                cases.append((self.is_in(col, values), uds4_value))
+        expression = self.last_match(cases, pl.lit(None, dtype=pl.String))
+
+        if rule.grep_rules:
+            lowered = self.text(col).str.to_lowercase()
+            cases = [(reduce(operator.or_, [lowered.str.contains(term, literal=True) for term in search_terms]), uds4_value)
+                     for search_terms, uds4_value in rule.grep_rules]
+            expression = self.last_match(cases, expression)
+
+        if rule.preserve_unmapped and col != 'cancer':
+            expression = (pl.when(expression.is_in(list(dict.fromkeys(rule.response_map.values()))))
+                          .then(expression).otherwise(self.text(col)))
+        return expression
+
+    def separator(self, rule):
+        struct_rule = rule.structured[0]
+        return (pl.when(self.condition(struct_rule.separator_expression))
+                .then(pl.lit(struct_rule.separator_value)).otherwise(pl.lit(None, dtype=pl.String)))
+
+    def paste(self, rule):
+        return pl.concat_str([self.text(col) for col in rule.structured[0].paste_columns[:3]], separator="/")
+
+
+class PolarsCrosswalkEngine(CrosswalkEngine):
+    """
+    CrosswalkEngine running the rules selected by column_rules as one parallel Polars query.
+
+    The results are handed to the pandas run as precomputed columns, typed as the pandas rules
+    would create them (object text with NaN for missing), so the output is the same byte for byte.
+    """
+
+    def __init__(self, plan, **kwargs):
+        super().__init__(plan, **kwargs)
+        self.column_rules = column_rules(plan)
+
+    def precompute(self, uds3_df):
+        builder = PolarsRules(uds3_df)
+        usable = {}
+        expressions, inputs = [], set()
+        for rule, kind in self.column_rules:
+            reads = rule_inputs(rule, kind)
+            for col in reads:
+                if col not in usable:
+                    usable[col] = col in uds3_df.columns and text_column(uds3_df, col)
+            # Missing or float inputs take the pandas path (no-op, fallback or float text)
+            if not all(usable[col] for col in reads):
+                continue
+            expressions.append(getattr(builder, kind)(rule).alias(rule.uds4_var))
+            inputs.update(reads)
+
+        if not expressions:
+            return {}
+        frame = pl.from_pandas(uds3_df[sorted(inputs)], include_index=False).lazy().select(expressions).collect()
+
+        precomputed = {}
+        for name in frame.columns:
+            values = frame[name].to_numpy().astype(object)
+            values[frame[name].is_null().to_numpy()] = np.nan
+            precomputed[name] = pd.Series(values, index=uds3_df.index, dtype=object)
+        return precomputed
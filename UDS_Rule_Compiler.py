@@ -0,0 +1,572 @@
+import re
+import ast
+import json
+import sys, os
+import hashlib
+import operator
+import pickle
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+# Bump whenever the compiled rule layout or the parsing below changes so cached plans are rebuilt
+PLAN_VERSION = "6"
+
+MAPPING_TYPES = ["Direct_Mappings", "Conditional_Consistency", "Structured_Transformations", "High_Complexity"]
+
+# Compact rule bundle written by UDS_JSON_Maker.py, bump BUNDLE_VERSION whenever its layout changes
+BUNDLE_NAME = "crosswalk_rules.bundle"
+BUNDLE_FORMAT = "uds-crosswalk-bundle"
+BUNDLE_VERSION = 1
+
+
+# Define the categories and their respective suffixes
+categories = {
+    'a': [1, 2, 3, 4,5],
+    'b': [1, 4, 5, 6, 7, 8, 9],
+    'c': [2],
+    'd': [1,2]
+}
+
+data_dict = {}
+
+for category, numbers in categories.items():
+    for num in numbers:
+        key_suffix = f"__{category}{num}"
+        data_dict[f'ptid{key_suffix}'] = 'adc_sub_id'
+        data_dict[f'formver{key_suffix}'] = 'form_ver_num'
+        data_dict[f'adcid{key_suffix}'] = 'adc_cntr_id'
+        data_dict[f'visitnum{key_suffix}'] = f'{category}{num}_visit_day'
+        data_dict[f'initials{key_suffix}'] = f'{category}{num}_ex_ini'
+
+struct_map1 = {'hrtattage':'cvhatt','strokage':'cbstroke','pdage':'pd','lasttbi':'tbi','pdothrage':'pdothr','tiaage':'cbtia'}
+
+a3_list = ['sib###yob', 'sib###agd','sib###pdx','sib###ago','sib###moe',
+           'kid###yob', 'kid###agd','kid###pdx','kid###ago','kid###moe']
+
+# Operators allowed in the structured arithmetic expressions
+math_operators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                  ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+## RULE OBJECTS
+
+@dataclass(frozen=True)
+class Equals:
+    """Rows whose UDS3 value, as text, is exactly `value`."""
+    col: str
+    value: str
+
+
+@dataclass(frozen=True)
+class Missing:
+    """Rows whose UDS3 value is missing or the text "NA" in any case."""
+    col: str
+
+
+@dataclass(frozen=True)
+class BoolOp:
+    """OR ("|") or AND ("&") of Equals, Missing or nested BoolOp operands.
+
+    Expressions are hashable and compare by value, so identical (sub-)conditions of different rules
+    and forms share one cached mask per run.
+    """
+    operator: str
+    operands: tuple
+
+
+def condition_columns(expression):
+    # UDS3 columns a condition reads
+    if isinstance(expression, BoolOp):
+        return {col for operand in expression.operands for col in condition_columns(operand)}
+    return {expression.col}
+
+
+@dataclass
+class Condition:
+    """A multi-column condition such as "1 | 1" or "NA & NA" paired column-by-column with the UDS3 variables."""
+    operator: str                       # "|" (OR) or "&" (AND)
+    terms: list                         # (uds3 column, value) pairs
+    uds3_value: str
+    uds4_value: str
+    expression: Optional[BoolOp] = None  # the terms compiled, "NA" and "None" values test for missing
+
+
+@dataclass
+class StructuredRule:
+    """One 'Structured mapping' entry with its IF, separator, math and paste() parts already parsed."""
+    uds3_value: str
+    uds4_value: str
+    # IF-ELSE rules, OR conditions are applied before AND conditions
+    or_conditions: list = field(default_factory=list)
+    and_conditions: list = field(default_factory=list)
+    # Multiple UDS3 variables combined by "|" or "&"
+    separator: Optional[str] = None
+    separator_columns: list = field(default_factory=list)
+    separator_terms: list = field(default_factory=list)
+    separator_value: Optional[str] = None
+    separator_expression: Optional[BoolOp] = None  # the separator terms compiled, all exact matches
+    # Arithmetic on UDS3 columns (e.g. "HATTYEAR – BIRTHYR")
+    math_columns: list = field(default_factory=list)
+    math_expression: Optional[str] = None
+    math_tree: Optional[ast.Expression] = None
+    math_struct_column: Optional[str] = None
+    # paste() of date parts with the *_form_dt fallback
+    paste_columns: list = field(default_factory=list)
+    paste_fallback: Optional[str] = None
+
+
+@dataclass
+class CrosswalkRule:
+    """A single UDS3 -> UDS4 variable mapping compiled from the JSON crosswalk."""
+    form: str
+    mapping_type: str
+    uds3_var: str
+    uds4_var: str
+    has_levels: bool
+    has_conformity: bool
+    response_map: dict                  # str(UDS3_value) -> str(UDS4_value), JSON order kept
+    exact_pairs: list                   # response_map items without "|" or "grep("
+    level_pairs: list                   # (uds3 value, uds4 value, values split on " | " or None when exact)
+    grep_rules: list                    # (search terms, uds4 value) in response_map order
+    float_values: dict                  # float(UDS3_value) for the exact pairs, where parsable
+    preserve_unmapped: bool             # keep unmapped UDS3 values after a conformity mismatch
+    conformity_match: bool
+    max_columns: Optional[list] = None
+    merge_columns: Optional[tuple] = None
+    is_repeating: bool = False
+    structured: list = field(default_factory=list)
+    # Search terms of every grep rule reading the same UDS3 column(s) and their combined pattern
+    grep_terms: list = field(default_factory=list)
+    grep_pattern: Optional[re.Pattern] = None
+
+
+@dataclass
+class RulePlan:
+    key: str
+    forms: dict                         # json file -> mapping type -> [CrosswalkRule]
+    schema: dict = field(default_factory=dict)  # lowercase UDS3 column -> dtype for the CSV reader
+    columns: set = field(default_factory=set)   # lowercase UDS3 columns referenced by any rule
+
+    def rules(self):
+        for mapping_types in self.forms.values():
+            for rules in mapping_types.values():
+                yield from rules
+
+
+## COMPILATION
+
+# UDS3 dtype schemas written by UDS_JSON_Maker.py next to the mapping files
+SCHEMA_SUFFIX = "_uds3_schema.json"
+
+
+def load_json_files(directory):
+    # Sorted so rules always apply in the same order regardless of the file system
+    json_files = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+    raw_data = {}
+
+    for json_file in json_files:
+        with open(os.path.join(directory, json_file), 'rb') as f:
+            raw_data[json_file] = f.read()
+
+    return raw_data
+
+
+def source_hashes(raw_data):
+    return {json_file: hashlib.sha256(content).hexdigest() for json_file, content in raw_data.items()}
+
+
+def executable_mapping(mapping, mapping_type):
+    # Only what compile_mapping reads: lowercase names and the response level, conformity (with its MAX( notes)
+    # and structured entries, without the field labels, question numbers, forms, data types or reversibility
+    key = "crosswalk_remappings" if mapping_type == 'Direct_Mappings' else "crosswalk_mappings"
+    remappings = []
+    for m in mapping[key]:
+        mapping_kind = m.get("mapping_type", "")
+        if mapping_kind == "Conformity":
+            items = [{"UDS3_value": item["UDS3_value"], "UDS4_value": item["UDS4_value"], "note": item["note"]}
+                     for item in m["mappings"]]
+        elif mapping_kind.startswith("Response LEVELS") or (mapping_kind == "Structured mapping" and key == "crosswalk_mappings"):
+            items = [{"UDS3_value": item["UDS3_value"], "UDS4_value": item["UDS4_value"]} for item in m["mappings"]]
+        else:
+            continue
+        remappings.append({"mapping_type": mapping_kind, "mappings": items})
+
+    return {"UDS3_variable": mapping["UDS3_variable"].lower(), "UDS4_variable": mapping["UDS4_variable"].lower(),
+            key: remappings}
+
+
+def build_bundle(directory):
+    """
+    Build the compact, execution-only rule bundle of a folder of JSON crosswalk files.
+
+    The first line is a header with the bundle version and the sha256 of every JSON file it was
+    built from, the second holds the minified mappings and schemas.
+
+    Args:
+        directory (str): Folder containing the JSON crosswalk files.
+
+    Returns:
+        bytes: The bundle.
+    """
+    raw_data = load_json_files(directory)
+    documents = {}
+    for json_file, content in raw_data.items():
+        json_data = json.loads(content.decode('utf-8'))
+        if not json_file.endswith(SCHEMA_SUFFIX):
+            json_data = {mapping_type: [executable_mapping(mapping, mapping_type) for mapping in json_data[mapping_type]]
+                         for mapping_type in MAPPING_TYPES if mapping_type in json_data}
+        documents[json_file] = json_data
+
+    header = {"format": BUNDLE_FORMAT, "version": BUNDLE_VERSION, "sources": source_hashes(raw_data)}
+    return b"\n".join(json.dumps(part, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                      for part in [header, documents]) + b"\n"
+
+
+def load_bundle(directory, raw_data):
+    # Decoded documents of the bundle, None when there is none or it was not built from exactly these JSON files
+    try:
+        with open(os.path.join(directory, BUNDLE_NAME), 'rb') as f:
+            header = json.loads(f.readline())
+            if (header.get("format") != BUNDLE_FORMAT or header.get("version") != BUNDLE_VERSION
+                    or header.get("sources") != source_hashes(raw_data)):
+                return None
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def plan_key(raw_data):
+    # Key made from the plan version and the content hash of every JSON file
+    digest = hashlib.sha256(PLAN_VERSION.encode())
+    for json_file, content in raw_data.items():
+        digest.update(json_file.encode('utf-8'))
+        digest.update(hashlib.sha256(content).digest())
+    return digest.hexdigest()
+
+
+def _conditions(response_map, uds3_vars, operator):
+    conditions = []
+    for uds3_value, uds4_value in response_map.items():
+        if operator in uds3_value:
+            values = uds3_value.split(f" {operator} ")
+            terms = list(zip(uds3_vars, values))
+            expression = BoolOp(operator, tuple(Missing(col) if value in ["NA", "None"] else Equals(col, value)
+                                                for col, value in terms))
+            conditions.append(Condition(operator, terms, uds3_value, uds4_value, expression))
+    return conditions
+
+
+def compile_expression(expression):
+    """
+    Parse an arithmetic UDS4_value expression (e.g. "hattyear - birthyr") into an AST.
+
+    Only column names, numbers, parentheses and + - * / are accepted, so the expression can be
+    evaluated without eval().
+
+    Raises:
+        SyntaxError, ValueError: The expression is not plain arithmetic.
+    """
+    tree = ast.parse(expression, mode='eval')
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)):
+            if type(node.op) not in math_operators:
+                raise ValueError(f"unsupported operator {type(node.op).__name__}")
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise ValueError(f"unsupported constant {node.value!r}")
+        elif not isinstance(node, (ast.Expression, ast.Name, ast.Load, *math_operators)):
+            raise ValueError(f"unsupported element {type(node).__name__}")
+
+    return tree
+
+
+def evaluate_expression(node, columns):
+    """
+    Evaluate a compiled expression over whole columns.
+
+    Args:
+        node (ast.AST): Tree from compile_expression.
+        columns (dict): Column name to NumPy array, all of the same length.
+
+    Returns:
+        np.ndarray: The computed column.
+    """
+    if isinstance(node, ast.Expression):
+        return evaluate_expression(node.body, columns)
+    if isinstance(node, ast.BinOp):
+        return math_operators[type(node.op)](evaluate_expression(node.left, columns),
+                                             evaluate_expression(node.right, columns))
+    if isinstance(node, ast.UnaryOp):
+        return math_operators[type(node.op)](evaluate_expression(node.operand, columns))
+    if isinstance(node, ast.Name):
+        return columns[node.id]
+    return node.value
+
+
+def compile_structured(uds3_var, uds4_var, uds3_value, uds4_value, response_map):
+    rule = StructuredRule(uds3_value, uds4_value)
+
+    # Handling conditional IF-ELSE structured mappings
+    if "IF(" in uds3_value:
+        uds3_vars = uds3_var.split(" | ")
+        rule.or_conditions = _conditions(response_map, uds3_vars, "|")
+        rule.and_conditions = _conditions(response_map, uds3_vars, "&")
+
+        # The separator, math and paste stages continue from the last IF condition processed
+        last = rule.and_conditions or rule.or_conditions
+        if last:
+            uds3_value, uds4_value = last[-1].uds3_value, last[-1].uds4_value
+
+    # Identify separator: OR ('|') or AND ('&')
+    if "|" in uds3_value:
+        rule.separator = "|"
+    elif "&" in uds3_value:
+        rule.separator = "&"
+
+    if rule.separator:
+        uds3_vars = [var.strip() for var in uds3_var.split(f" {rule.separator} ")]
+        uds3_values = [var.strip() for var in uds3_value.split(f" {rule.separator} ")]
+        rule.separator_columns = uds3_vars
+        rule.separator_terms = list(zip(uds3_vars, uds3_values))
+        rule.separator_expression = BoolOp(rule.separator, tuple(Equals(col, value) for col, value in rule.separator_terms))
+        rule.separator_value = uds4_value
+
+    # Structured mathematical mappings (e.g., "PDAGE + BIRTHYR" → "PDYR - BIRTHYR")
+    elif any(op in uds3_value for op in ["+", "-", "*", "/"]) and uds4_var in struct_map1:
+        rule.math_columns = [col.lower() for col in re.findall(r'[A-Za-z0-9_]+', uds4_value)]
+        rule.math_expression = uds4_value.replace("–", "-").strip().lower()
+        rule.math_struct_column = struct_map1[uds4_var]
+        try:
+            rule.math_tree = compile_expression(rule.math_expression)
+        except (SyntaxError, ValueError) as e:
+            print(f"Error parsing UDS4 expression {rule.math_expression}: {e}")
+
+    # paste() combines multiple columns into a single "/" separated string
+    if "paste(" in uds4_value:
+        comp_raw = uds4_value.replace("paste(", "").replace(")", "").split(',')
+        rule.paste_columns = [comp.strip().lower() for comp in comp_raw if any(c.isalnum() for c in comp.strip())]
+
+        # Fallback to the form date when the date parts are missing (e.g. 'a2' -> a2_form_dt, 'a5d2' -> d2_form_dt)
+        match = re.search(r'_{1,2}([a-d]\d*(d2)?)$', rule.paste_columns[1])
+        if match:
+            suffix = match.group(1)
+            rule.paste_fallback = "d2_form_dt" if 'd2' in suffix else f"{suffix}_form_dt"
+
+    return rule
+
+
+def compile_conformity(conformity):
+    # Extract all UDS3/UDS4 conformity values and notes into sets
+    uds3_conformity_values = set(item["UDS3_value"] for mapping in conformity for item in mapping["mappings"])
+    uds4_conformity_values = set(item["UDS4_value"] for mapping in conformity for item in mapping["mappings"])
+    note = set(item["note"] for mapping in conformity for item in mapping["mappings"])
+
+    uds3_processed_values = set()
+    for value in uds3_conformity_values:
+        value = str(value)
+        if "|" in value:
+            # Split and keep the first part
+            uds3_processed_values.add(value.split("|")[0].strip())
+        elif "Any" in value:
+            uds3_processed_values.add(value.rstrip("."))
+        else:
+            uds3_processed_values.add(value)
+
+    # Notes containing "MAX(" hold the UDS3 columns for a row-wise maximum e.g. MAX(INCALLS,INVISITS)
+    max_columns = None
+    if "MAX(" in str(note):
+        cols = re.findall(r'\b\w+\b', str(note).strip("{}'"))
+        max_columns = [col.lower() for col in cols[1:]]
+
+    return uds3_processed_values == uds4_conformity_values, max_columns
+
+
+def compile_mapping(form, mapping, mapping_type):
+    # Extract and normalize UDS3 and UDS4 variable names to lowercase
+    uds3_var = mapping["UDS3_variable"].lower()
+    uds4_var = mapping["UDS4_variable"].lower()
+
+    # Resolve UDS3 variable names using a data dictionary, if available
+    uds3_var = data_dict.get(uds3_var, uds3_var)
+
+    if mapping_type == 'Direct_Mappings':
+        remappings = mapping["crosswalk_remappings"]
+        structured_mappings = []
+    else:
+        remappings = mapping["crosswalk_mappings"]
+        structured_mappings = [m for m in remappings if m["mapping_type"] == "Structured mapping"]
+
+    response_levels = [m for m in remappings if m.get("mapping_type", "").startswith("Response LEVELS")]
+    conformity = [m for m in remappings if m["mapping_type"] == "Conformity"]
+
+    response_map = {str(item["UDS3_value"]): str(item["UDS4_value"])
+                    for m in response_levels for item in m["mappings"]}
+
+    exact_pairs = [(k, v) for k, v in response_map.items() if "|" not in k and "grep(" not in k]
+    level_pairs = [(k, v, None if (k, v) in exact_pairs else k.split(" | ")) for k, v in response_map.items()]
+    grep_rules = [(re.search(r'grep\("(.*?)",', k).group(1).lower().split(" or "), v)
+                  for k, v in response_map.items() if "grep(" in k]
+
+    float_values = {}
+    for k, _ in exact_pairs:
+        try:
+            float_values[k] = float(k)
+        except ValueError:
+            pass
+
+    conformity_match, max_columns = compile_conformity(conformity) if conformity else (False, None)
+
+    # Special Case: two columns separated by " | " are merged - useful for sheets like A5D2, B1 and B8
+    merge_columns = None
+    if "|" in uds3_var and not structured_mappings:
+        uds3_vars = uds3_var.split(" | ")
+        if len(uds3_vars) == 2:
+            merge_columns = (uds3_vars[0], uds3_vars[1])
+
+    structured = [compile_structured(uds3_var, uds4_var, entry["UDS3_value"], entry["UDS4_value"], response_map)
+                  for struct_map in structured_mappings for entry in struct_map["mappings"]]
+
+    return CrosswalkRule(
+        form=form,
+        mapping_type=mapping_type,
+        uds3_var=uds3_var,
+        uds4_var=uds4_var,
+        has_levels=bool(response_levels),
+        has_conformity=bool(conformity),
+        response_map=response_map,
+        exact_pairs=exact_pairs,
+        level_pairs=level_pairs,
+        grep_rules=grep_rules,
+        float_values=float_values,
+        preserve_unmapped=(mapping_type not in ['Structured_Transformations', 'High_Complexity']
+                           and bool(response_map) and "grep(" not in list(response_map)[-1]),
+        conformity_match=conformity_match,
+        max_columns=max_columns,
+        merge_columns=merge_columns,
+        is_repeating=uds3_var in a3_list,
+        structured=structured,
+    )
+
+
+def compile_plan(raw_data, key, documents=None):
+    # documents are the already decoded JSON files, e.g. from the bundle
+    if documents is None:
+        documents = {json_file: json.loads(content.decode('utf-8')) for json_file, content in raw_data.items()}
+
+    forms, schema = {}, {}
+    for json_file, json_data in documents.items():
+        if json_file.endswith(SCHEMA_SUFFIX):
+            schema.update(json_data)
+            continue
+        forms[json_file] = {mapping_type: [compile_mapping(json_file, mapping, mapping_type)
+                                           for mapping in json_data.get(mapping_type, [])]
+                            for mapping_type in MAPPING_TYPES}
+    plan = RulePlan(key, forms, schema)
+    link_grep_rules(plan)
+    plan.columns = referenced_columns(plan)
+    return plan
+
+
+def repeating_columns(uds3_var):
+    # kid###/sib### variables expand to every family member, as process_repeating_variables reads them
+    word = re.search(r'(kid|sib)', uds3_var).group(1)
+    base_var = uds3_var.replace(word, '').replace('#', '')
+    return [f"{word}{i}{base_var}" for i in range(1, (15 if word == 'kid' else 20) + 1)]
+
+
+def referenced_columns(plan):
+    """
+    Every UDS3 column a rule of the plan can read, found statically from the compiled rules.
+
+    Covers the UDS3 variables (data_dict aliases already applied), the " | " and " & " split pairs,
+    the kid/sib expansions, MAX( columns and the structured IF, separator, arithmetic and paste() columns.
+    """
+    columns = set()
+    for rule in plan.rules():
+        columns.update(repeating_columns(rule.uds3_var) if rule.is_repeating else [rule.uds3_var])
+        columns.update(rule.max_columns or [])
+
+        for struct_rule in rule.structured:
+            for cond in struct_rule.or_conditions + struct_rule.and_conditions:
+                columns.update(col for col, _ in cond.terms)
+            columns.update(struct_rule.separator_columns)
+            columns.update(struct_rule.math_columns)
+            columns.update(struct_rule.paste_columns)
+            columns.update(col for col in [struct_rule.math_struct_column, struct_rule.paste_fallback] if col)
+
+    # Pairs such as "alienlml | alienlmr" are read column by column
+    return {col.strip() for name in columns for part in name.split(" | ") for col in part.split(" & ")}
+
+
+def link_grep_rules(plan):
+    # Rules reading the same UDS3 column share its search terms so the column is matched once for all of them
+    column_terms = {}
+    for rule in plan.rules():
+        for col in (rule.merge_columns or [rule.uds3_var]) if rule.grep_rules else []:
+            terms = column_terms.setdefault(col, [])
+            terms += [term for search_terms, _ in rule.grep_rules for term in search_terms if term not in terms]
+
+    for rule in plan.rules():
+        if rule.grep_rules:
+            rule.grep_terms = list(dict.fromkeys(term for col in (rule.merge_columns or [rule.uds3_var])
+                                                 for term in column_terms[col]))
+            rule.grep_pattern = re.compile("|".join(re.escape(term) for term in rule.grep_terms))
+
+
+def compile_rules(directory, cache_dir=None):
+    """
+    Compile the folder of *_mappings.json files into a RulePlan, reusing a cached plan when available.
+
+    A current crosswalk_rules.bundle in the folder is decoded instead of the pretty JSON files.
+
+    Args:
+        directory (str): Folder containing the JSON crosswalk files.
+        cache_dir (str): Folder for compiled plans, defaults to '.plan_cache' inside the JSON folder.
+            Pass False to skip the cache entirely.
+
+    Returns:
+        RulePlan: The compiled rules grouped by JSON file and mapping type.
+    """
+    raw_data = load_json_files(directory)
+    key = plan_key(raw_data)
+
+    if cache_dir is False:
+        return compile_plan(raw_data, key, load_bundle(directory, raw_data))
+
+    cache_dir = cache_dir or os.path.join(directory, ".plan_cache")
+    cache_path = os.path.join(cache_dir, f"plan_{key[:32]}.pkl")
+
+    # Reuse the compiled plan if the JSON content has not changed
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                plan = pickle.load(f)
+            if plan.key == key:
+                return plan
+        except Exception as e:
+            print(f"Ignoring unreadable rule plan cache {cache_path}: {e}")
+
+    # The compact bundle skips decoding the pretty JSON whenever it is current
+    plan = compile_plan(raw_data, key, load_bundle(directory, raw_data))
+
+    # Write to a temporary file first so concurrent runs never read a partial plan
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not save the rule plan cache to {cache_dir}: {e}")
+
+    return plan
+
+
+if __name__ == "__main__":
+    # Precompile the rule plan e.g. python UDS_Rule_Compiler.py ./Crosswalk
+    json_folder_path = sys.argv[1] if len(sys.argv) > 1 else "./Crosswalk"
+    plan = compile_rules(json_folder_path)
+    print(f"Compiled {sum(1 for _ in plan.rules())} rules from {len(plan.forms)} JSON files "
+          f"reading {len(plan.columns)} UDS3 columns, with a dtype schema for {len(plan.schema)} (plan {plan.key[:12]})")
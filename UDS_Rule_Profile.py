@@ -0,0 +1,97 @@
+import json
+import time
+import numpy as np
+
+
+# Per-rule profile of a crosswalk run.  process_mappings only calls into it while a RuleProfile is set
+# (--profile), so normal runs pay for nothing but a None check per rule.
+
+class RuleProfile:
+    """
+    Wall time, rows and code path of every compiled rule, summed over chunks when the data is streamed.
+
+    rows_matched counts the rows a rule assigned (masked writes, or the non-missing rows of a whole
+    column write); rows_written counts the UDS4 cells whose value actually changed.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.rows_matched = 0
+        self.before = {}
+        self.started = None
+
+    def start(self):
+        self.rows_matched = 0
+        self.before = {}
+        self.started = time.perf_counter()
+
+    def before_write(self, col, values):
+        # The first state of each UDS4 column the rule touches, writes replace the Series so no copy is needed
+        self.before.setdefault(col, values)
+
+    def stop(self, rule, position, path, uds4_df):
+        seconds = time.perf_counter() - self.started
+        written = sum(changed_cells(before, uds4_df.data[col]) for col, before in self.before.items())
+
+        record = self.records.setdefault((rule.form, rule.mapping_type, position), {
+            "form": rule.form,
+            "mapping_type": rule.mapping_type,
+            "uds3_var": rule.uds3_var,
+            "uds4_var": rule.uds4_var,
+            "path": path,
+            "calls": 0,
+            "seconds": 0.0,
+            "rows_matched": 0,
+            "rows_written": 0,
+        })
+        record["calls"] += 1
+        record["seconds"] += seconds
+        record["rows_matched"] += self.rows_matched
+        record["rows_written"] += written
+
+    def rules(self):
+        # Slowest first
+        return sorted(self.records.values(), key=lambda record: record["seconds"], reverse=True)
+
+    def totals(self, field):
+        totals = {}
+        for record in self.records.values():
+            total = totals.setdefault(record[field], {"rules": 0, "seconds": 0.0, "rows_matched": 0, "rows_written": 0})
+            total["rules"] += 1
+            for key in ["seconds", "rows_matched", "rows_written"]:
+                total[key] += record[key]
+        return dict(sorted(totals.items(), key=lambda item: item[1]["seconds"], reverse=True))
+
+    def report(self):
+        return {
+            "seconds": sum(record["seconds"] for record in self.records.values()),
+            "paths": self.totals("path"),
+            "forms": self.totals("form"),
+            "mapping_types": self.totals("mapping_type"),
+            "rules": self.rules(),
+        }
+
+    def save(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=4)
+
+    def print_top(self, top=20):
+        print(f"\nSlowest {top} rules of {len(self.records)} ({sum(r['seconds'] for r in self.records.values()):.2f}s in all rules)")
+        print(f"{'seconds':>9} {'matched':>9} {'written':>9}  {'path':<22} {'form':<14} UDS3 -> UDS4")
+        for record in self.rules()[:top]:
+            print(f"{record['seconds']:9.3f} {record['rows_matched']:9d} {record['rows_written']:9d}  {record['path']:<22} "
+                  f"{record['form'].split('_UDS4')[0]:<14} {record['uds3_var']} -> {record['uds4_var']}")
+
+        print("\nBy code path")
+        for path, total in self.totals("path").items():
+            print(f"{total['seconds']:9.3f} {total['rows_matched']:9d} {total['rows_written']:9d}  {path} ({total['rules']} rules)")
+
+
+def changed_cells(before, after):
+    # UDS4 cells whose text differs, a column the rule created counts its non-missing cells
+    if before is None:
+        return int(after.notna().sum())
+    if before is after:
+        return 0
+    missing = before.isna().to_numpy() & after.isna().to_numpy()
+    return int(((before.astype(str).to_numpy() != after.astype(str).to_numpy()) & ~missing).sum())
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+import warnings
+
+import UDS_Crosswalk_Parser as parser
+from UDS_Engine_Parity import (SERVICE_SEEDS, first_difference, parity_outputs, serve_coalesced, serve_same_shaped,
+                               synthetic_exports)
+
+
+# Automated form of UDS_Engine_Parity.py: a clean and an edge-case synthetic export are migrated with every
+# installed backend, in one run, in small chunks, across worker processes and incrementally, and every output must
+# match the pandas engine byte for byte; requests the service coalesces must match the same requests migrated alone,
+# and same-shaped requests must share a batch.
+#   python -m unittest test_engine_parity
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+JSON_FOLDER = os.path.join(REPO_DIR, "Crosswalk")
+DATA_ORDER = os.path.join(REPO_DIR, "UDS4Data_ColumnOrder.txt")
+# More rows than a pandas parser block (512 at the UDS3 width), so the batches of the edge-case export split too
+ROWS = 600
+SEED = 0
+
+
+class EngineParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        warnings.filterwarnings("ignore")
+        cls.work_dir = tempfile.TemporaryDirectory(prefix="uds_parity_test_")
+        pandas_engine = parser.CrosswalkEngine.from_folder(JSON_FOLDER, cache_dir=cls.work_dir.name, verbose=False)
+        cls.engines = {"pandas": pandas_engine}
+        for name in [name for name in parser.ENGINES if name != "pandas"]:
+            try:
+                cls.engines[name] = parser.engine_class(name)(pandas_engine.plan)
+            except ImportError:
+                pass
+        clean, edges = synthetic_exports(JSON_FOLDER, pandas_engine.plan, ROWS, [SEED], cls.work_dir.name)
+        cls.exports = {"clean": clean, "edges": edges}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.work_dir.cleanup()
+
+    def check_export(self, label):
+        outputs = parity_outputs(self.exports[label], self.engines, DATA_ORDER, self.work_dir.name)
+        reference_file, reference = outputs.pop("pandas")
+        self.assertIsInstance(reference, bytes, f"the pandas engine stops with {reference}")
+        for name, (output_file, output) in outputs.items():
+            with self.subTest(run=name):
+                self.assertIsInstance(output, bytes, f"{name} stops with {output}")
+                if output != reference:
+                    self.fail(f"{name} differs from pandas: {first_difference(reference_file, output_file)}")
+
+    def test_clean_export(self):
+        self.check_export("clean")
+
+    def test_edge_case_export(self):
+        self.check_export("edges")
+
+    def test_service_coalescing(self):
+        for label, csv_path in self.exports.items():
+            for seed in SERVICE_SEEDS:
+                with self.subTest(export=label, seed=seed):
+                    alone, coalesced = serve_coalesced(csv_path, self.engines["pandas"], DATA_ORDER, seed)
+                    self.assertEqual(coalesced, alone)
+
+    def test_service_same_shaped_requests(self):
+        # Requests differing only in gaps of their integer columns share one transform
+        for seed in SERVICE_SEEDS:
+            with self.subTest(seed=seed):
+                alone, coalesced, batches = serve_same_shaped(self.exports["clean"], self.engines["pandas"], DATA_ORDER, seed)
+                self.assertEqual(batches, 1)
+                self.assertEqual(coalesced, alone)
+
+
+if __name__ == "__main__":
+    unittest.main()